@@ -0,0 +1,7 @@
+"""
+Benchmarks for the SAMAM meal booking system.
+
+Each module is a script run from the repository root, for example:
+
+    python -m benchmarks.passwords
+"""
@@ -0,0 +1,105 @@
+"""
+JSON API against HTML pages: payload size and request time.
+
+Seeds a synthetic academy (see seed.py) into a scratch SQLite database and, for
+each interaction a mobile or kiosk client needs, times the HTML path a browser
+takes (form POST, redirect and page render) against the /api/v1 equivalent
+(see website/api.py) through the Flask test client. Read endpoints are also
+timed with the ETag of the previous response in If-None-Match, which the API
+answers with an empty 304. Run with:
+
+    python -m benchmarks.api [--students 2000] [--iterations 200] [--batch 50]
+"""
+
+import argparse
+import json
+import os
+import sys
+import tempfile
+from time import perf_counter
+
+from benchmarks.seed import PASSWORD, STAFF, seed_academy, student_card, student_email
+
+
+def measure(client, iterations, method, path, **kwargs):
+    """Mean milliseconds and bytes of a request, and the last response."""
+    started = perf_counter()
+    size = 0
+    for _ in range(iterations):
+        response = client.open(path, method=method, **kwargs)
+        size += len(response.get_data())
+    return (perf_counter() - started) / iterations * 1000, size / iterations, response
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--students', type=int, default=2000)
+    parser.add_argument('--weeks', type=int, default=4)
+    parser.add_argument('--iterations', type=int, default=200, help='Requests per endpoint.')
+    parser.add_argument('--batch', type=int, default=50, help='Card swipes per gate batch.')
+    args = parser.parse_args()
+
+    scratch = tempfile.mkdtemp(prefix='samam-api-')
+    os.environ['TEST_DATABASE_URL'] = f'sqlite:///{os.path.join(scratch, "academy.db")}'
+    from website import create_app
+
+    app = create_app('testing')
+    seed_academy(app, args.students, args.weeks)
+
+    def logged_in(email):
+        client = app.test_client()
+        client.post('/login', data={'email': email, 'password': PASSWORD})
+        return client
+
+    student, manager, gate = logged_in(student_email(0)), logged_in(STAFF['manager']), logged_in(STAFF['access'])
+    form = {'breakfast': ['monday', 'wednesday'], 'supper': ['friday']}
+    cards = [student_card(i % args.students) for i in range(args.batch)]
+    n = args.iterations
+
+    rows = []
+
+    def pair(name, html, api, conditional=True):
+        html_ms, html_bytes, _ = html
+        api_ms, api_bytes, response = api
+        row = {'interaction': name, 'html_ms': html_ms, 'html_bytes': html_bytes, 'api_ms': api_ms,
+               'api_bytes': api_bytes}
+        if conditional and response.headers.get('ETag'):
+            client, path = conditional
+            row['api_304_ms'], row['api_304_bytes'], not_modified = measure(
+                client, n, 'GET', path, headers={'If-None-Match': response.headers['ETag']})
+            assert not_modified.status_code == 304, not_modified.status_code
+        rows.append(row)
+
+    pair('modify booking',
+         measure(student, n, 'POST', '/student/modify_bookings/', data=form, follow_redirects=True),
+         measure(student, n, 'PUT', '/api/v1/booking', json={'slots': form}), conditional=None)
+    pair('view booking',
+         measure(student, n, 'GET', '/student/view_bookings/'),
+         measure(student, n, 'GET', '/api/v1/booking'), (student, '/api/v1/booking'))
+    pair('menu',
+         measure(student, n, 'GET', '/student/menu/'),
+         measure(student, n, 'GET', '/api/v1/menu'), (student, '/api/v1/menu'))
+    pair('manager bookings page',
+         measure(manager, n, 'GET', '/manager/bookings/'),
+         measure(manager, n, 'GET', '/api/v1/manager/bookings'), (manager, '/api/v1/manager/bookings'))
+
+    # One swipe per request against one batch of swipes, per swipe
+    started = perf_counter()
+    size = 0
+    for i in range(n):
+        size += len(gate.post('/access/scan', data={'rfid_code': cards[i % len(cards)]}).get_data())
+    scan = ((perf_counter() - started) / n * 1000, size / n, None)
+    batch_ms, batch_bytes, _ = measure(gate, max(1, n // args.batch), 'POST', '/api/v1/gate/checks',
+                                       json={'cards': cards})
+    pair('gate check (per swipe)', scan, (batch_ms / args.batch, batch_bytes / args.batch, None), conditional=None)
+
+    print(f'{"interaction":<24} {"html ms":>8} {"api ms":>8} {"304 ms":>8} {"html B":>8} {"api B":>8} {"304 B":>6}')
+    for row in rows:
+        print(f'{row["interaction"]:<24} {row["html_ms"]:8.2f} {row["api_ms"]:8.2f} {row.get("api_304_ms", 0):8.2f} '
+              f'{row["html_bytes"]:8.0f} {row["api_bytes"]:8.0f} {row.get("api_304_bytes", 0):6.0f}')
+    print(json.dumps(rows, indent=2), file=sys.stderr)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,224 @@
+"""
+Capacity stress test: many students racing for the last seats of one meal.
+
+Seeds a scratch SQLite database where one meal of next week (supper on Friday by
+default) has --capacity seats and all but --free of them are already booked.
+Several worker processes, each with several threads, then log in as their own
+students and book that meal through the production app at the same time, each
+student submitting the booking form twice. It then checks that:
+
+- the meal holds exactly --capacity bookings and its head-count says so;
+- no student has two bookings for the week;
+- every student who missed a seat is on the waitlist;
+- when --release students drop the meal, the students who have waited longest
+  are booked in their place, in waitlist order;
+- the head-counts still match the bookings.
+
+Run with:
+
+    python -m benchmarks.capacity [--bookers 300] [--capacity 50] [--free 5] [--processes 4] [--threads 8]
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import sys
+import tempfile
+from time import perf_counter
+
+PASSWORD = 'load-test-password'
+
+
+def seed(holders, bookers, capacity, meal, day):
+    """Creates the students, the bookings already holding seats and the meal's capacity."""
+    from website import create_app, db
+    from website import slots
+    from website.capacity import set_capacity
+    from website.headcount import rebuild
+    from website.migrations import upgrade
+    from website.models import Booking, User
+    from website.passwords import hash_password
+    from website.views import get_booking_week
+
+    app = create_app('production')
+    with app.app_context():
+        upgrade()
+        hashed = hash_password(PASSWORD)
+        db.session.execute(User.__table__.insert(), [
+            {'initials': 'LT', 'surname': f'Student{i}', 'email': f'load{i}@academy.test',
+             'password': hashed, 'role': 'student'}
+            for i in range(holders + bookers)
+        ])
+        year, week = get_booking_week()
+        user_ids = [user_id for (user_id,) in db.session.query(User.user_id).order_by(User.user_id)]
+        db.session.execute(Booking.__table__.insert(), [
+            {'user_booking_id_fk': user_id, 'year': year, 'week': week,
+             'meal_slots': slots.encode([(meal, day)]), 'status': 'confirmed'}
+            for user_id in user_ids[:holders]
+        ])
+        db.session.commit()
+        rebuild(year, week)
+        set_capacity(year, week, meal, day, capacity)
+        db.session.commit()
+        return year, week
+
+
+def worker(students, threads, meal, day, results):
+    """Runs one WSGI worker process whose threads book the meal for their students."""
+    from concurrent.futures import ThreadPoolExecutor
+    from website import create_app
+
+    app = create_app('production')
+
+    def session(student):
+        client = app.test_client()
+        client.post('/login', data={'email': f'load{student}@academy.test', 'password': PASSWORD})
+        latencies, errors = [], []
+        for _ in range(2):
+            started = perf_counter()
+            try:
+                response = client.post('/student/', data={meal: [day]})
+                if response.status_code >= 400:
+                    errors.append(f'/student/ returned {response.status_code}')
+            except Exception as error:
+                errors.append(f'/student/ raised {error}')
+            latencies.append(perf_counter() - started)
+        return latencies, errors
+
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        outcomes = list(pool.map(session, students))
+    results.put(([l for latencies, _ in outcomes for l in latencies],
+                 [e for _, errors in outcomes for e in errors]))
+
+
+def check(year, week, meal, day):
+    """Reads the meal's head-count, capacity, bookings and waitlist; must run in an app context."""
+    from sqlalchemy import func
+    from website import db
+    from website import slots
+    from website.models import Booking, Meal_Count, Waitlist
+
+    index = slots.SLOT_INDEX[(meal, day)]
+    count = Meal_Count.query.filter(Meal_Count.year == year, Meal_Count.week == week, Meal_Count.meal == meal,
+                                    Meal_Count.day == day).one()
+    holding = db.session.query(func.count(Booking.booking_id)).filter(
+        Booking.year == year, Booking.week == week, Booking.meal_slots.op('&')(1 << index) != 0).scalar()
+    duplicates = db.session.query(Booking.user_booking_id_fk).filter(Booking.year == year, Booking.week == week) \
+        .group_by(Booking.user_booking_id_fk).having(func.count() > 1).count()
+    waiting = [user_id for (user_id,) in db.session.query(Waitlist.user_waitlist_fk).filter(
+        Waitlist.year == year, Waitlist.week == week, Waitlist.slot == index).order_by(Waitlist.waitlist_id)]
+    return {'head_count': count.head_count, 'capacity': count.capacity, 'bookings_holding': holding,
+            'duplicate_bookings': duplicates, 'waiting': waiting}
+
+
+def release(year, week, meal, day, students):
+    """Has students drop the meal through the app; returns the students booked in their place."""
+    from website import create_app
+    from website import slots
+    from website.models import Booking
+
+    app = create_app('production')
+    index = slots.SLOT_INDEX[(meal, day)]
+    with app.app_context():
+        before = check(year, week, meal, day)['waiting']
+    for student in students:
+        client = app.test_client()
+        client.post('/login', data={'email': f'load{student}@academy.test', 'password': PASSWORD})
+        client.post('/student/modify_bookings/', data={})
+    with app.app_context():
+        after = check(year, week, meal, day)['waiting']
+        promoted = [user_id for user_id in before if user_id not in after]
+        booked = {user_id for (user_id, meal_slots) in Booking.query.with_entities(
+            Booking.user_booking_id_fk, Booking.meal_slots).filter(
+            Booking.year == year, Booking.week == week, Booking.user_booking_id_fk.in_(promoted))
+            if meal_slots >> index & 1}
+    return before, promoted, booked
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--bookers', type=int, default=300, help='Students racing for the free seats.')
+    parser.add_argument('--capacity', type=int, default=50)
+    parser.add_argument('--free', type=int, default=5, help='Seats still free when the race starts.')
+    parser.add_argument('--release', type=int, default=3, help='Seated students who then drop the meal.')
+    parser.add_argument('--processes', type=int, default=4)
+    parser.add_argument('--threads', type=int, default=8)
+    parser.add_argument('--meal', default='supper')
+    parser.add_argument('--day', default='friday')
+    args = parser.parse_args()
+
+    scratch = tempfile.mkdtemp(prefix='samam-capacity-')
+    os.environ['DATABASE_URL'] = f'sqlite:///{os.path.join(scratch, "academy.db")}'
+    os.environ['SESSION_COOKIE_SECURE'] = '0'
+    os.environ.setdefault('SECRET_KEY', 'benchmark')
+    os.environ.setdefault('PASSWORD_SCRYPT_COST', '10')
+
+    holders = args.capacity - args.free
+    year, week = seed(holders, args.bookers, args.capacity, args.meal, args.day)
+
+    context = multiprocessing.get_context('spawn')
+    results = context.Queue()
+    bookers = list(range(holders, holders + args.bookers))
+    started = perf_counter()
+    processes = [context.Process(target=worker,
+                                 args=(bookers[p::args.processes], args.threads, args.meal, args.day, results))
+                 for p in range(args.processes)]
+    for process in processes:
+        process.start()
+    outcomes = [results.get() for _ in processes]
+    for process in processes:
+        process.join()
+    elapsed = perf_counter() - started
+
+    latencies = sorted(l for latencies, _ in outcomes for l in latencies)
+    errors = [e for _, errors in outcomes for e in errors]
+
+    from website import create_app
+    from website.headcount import rebuild
+    with create_app('production').app_context():
+        raced = check(year, week, args.meal, args.day)
+    waited, promoted, booked = release(year, week, args.meal, args.day, range(args.release))
+    with create_app('production').app_context():
+        released = check(year, week, args.meal, args.day)
+        drift = rebuild(check_only=True)
+
+    failures = []
+    if not raced['head_count'] == raced['bookings_holding'] == args.capacity:
+        failures.append(f"after the race {raced['bookings_holding']} booking(s) hold the meal, head-count "
+                        f"{raced['head_count']}, capacity {args.capacity}")
+    if len(raced['waiting']) != args.bookers - args.free:
+        failures.append(f"{len(raced['waiting'])} student(s) waiting, expected {args.bookers - args.free}")
+    if promoted != waited[:args.release] or set(promoted) != booked:
+        failures.append(f'promoted {promoted}, expected the first {args.release} of the waitlist')
+    if not released['head_count'] == released['bookings_holding'] == args.capacity:
+        failures.append(f"after the release {released['bookings_holding']} booking(s) hold the meal, head-count "
+                        f"{released['head_count']}")
+    if raced['duplicate_bookings'] or released['duplicate_bookings']:
+        failures.append('students with more than one booking for the week')
+
+    def percentile(fraction):
+        return latencies[min(len(latencies) - 1, int(fraction * len(latencies)))] * 1000 if latencies else 0.0
+
+    report = {
+        'bookers': args.bookers,
+        'capacity': args.capacity,
+        'free_seats': args.free,
+        'requests': len(latencies),
+        'errors': len(errors),
+        'seconds': elapsed,
+        'p50_ms': percentile(0.50),
+        'p95_ms': percentile(0.95),
+        'p99_ms': percentile(0.99),
+        'waitlisted': len(raced['waiting']),
+        'promoted': len(promoted),
+        'head_count_drift': len(drift),
+    }
+    for message in errors[:10] + failures:
+        print(message, file=sys.stderr)
+    print(json.dumps(report, indent=2))
+    return 1 if errors or failures or drift else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,158 @@
+"""
+Concurrent booking write load test.
+
+Seeds a scratch SQLite database, then runs several worker processes, each with
+several threads, that log in as their own student and repeatedly book and
+modify next week's meals through the production app, as a multi-worker
+deployment would. It reports write throughput and latency, fails if any request
+errors (for example with "database is locked"), and finally checks that the
+kitchen head-counts still match the bookings. With --tenants N the students are
+spread over N tenants, each with its own SQLite file (see website/tenants.py)
+and reached through its own host name, to compare write throughput against a
+single database. Run with:
+
+    python -m benchmarks.concurrent_writes [--processes 4] [--threads 4] [--iterations 25] [--tenants 1]
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import random
+import sys
+import tempfile
+from time import perf_counter
+
+PASSWORD = 'load-test-password'
+
+
+def tenant_host(student):
+    """Host name of the tenant a student belongs to."""
+    tenant_names = ['default', *json.loads(os.environ.get('TENANT_DATABASES') or '{}')]
+    tenant = tenant_names[student % len(tenant_names)]
+    return 'localhost' if tenant == 'default' else f'{tenant}.localhost'
+
+
+def seed(students):
+    """Creates the schema and the student accounts in every tenant's scratch database."""
+    from website import create_app, db, tenants
+    from website.migrations import upgrade
+    from website.models import User
+    from website.passwords import hash_password
+
+    app = create_app('production')
+    with app.app_context():
+        hashed = hash_password(PASSWORD)
+        tenant_names = tenants.names()
+        for index, name in enumerate(tenant_names):
+            with tenants.using(name):
+                upgrade()
+                db.session.execute(User.__table__.insert(), [
+                    {'initials': 'LT', 'surname': f'Student{i}', 'email': f'load{i}@academy.test',
+                     'password': hashed, 'role': 'student'}
+                    for i in range(index, students, len(tenant_names))
+                ])
+                db.session.commit()
+
+
+def worker(first_student, threads, iterations, results):
+    """Runs one WSGI worker process with several request threads."""
+    from concurrent.futures import ThreadPoolExecutor
+    from website import create_app
+    from website import slots
+
+    app = create_app('production')
+
+    def session(student):
+        client = app.test_client()
+        client.environ_base['HTTP_HOST'] = tenant_host(student)
+        client.post('/login', data={'email': f'load{student}@academy.test', 'password': PASSWORD})
+        latencies, errors = [], []
+        for iteration in range(iterations):
+            choice = random.getrandbits(slots.SLOT_COUNT)
+            form = {}
+            for meal, day in slots.slots_of(choice):
+                form.setdefault(meal, []).append(day)
+            path = '/student/' if iteration == 0 else '/student/modify_bookings/'
+            started = perf_counter()
+            try:
+                response = client.post(path, data=form)
+                if response.status_code >= 400:
+                    errors.append(f'{path} returned {response.status_code}')
+            except Exception as error:
+                errors.append(f'{path} raised {error}')
+            latencies.append(perf_counter() - started)
+        return latencies, errors
+
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        outcomes = list(pool.map(session, range(first_student, first_student + threads)))
+    results.put(([l for latencies, _ in outcomes for l in latencies],
+                 [e for _, errors in outcomes for e in errors]))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--processes', type=int, default=4)
+    parser.add_argument('--threads', type=int, default=4)
+    parser.add_argument('--iterations', type=int, default=25, help='Writes per student.')
+    parser.add_argument('--tenants', type=int, default=1, help='Databases the students are spread over.')
+    args = parser.parse_args()
+
+    scratch = tempfile.mkdtemp(prefix='samam-load-')
+    os.environ['DATABASE_URL'] = f'sqlite:///{os.path.join(scratch, "academy.db")}'
+    os.environ['TENANT_DATABASES'] = json.dumps({f'tenant{t}': f'sqlite:///{os.path.join(scratch, f"tenant{t}.db")}'
+                                                 for t in range(1, args.tenants)})
+    os.environ['SESSION_COOKIE_SECURE'] = '0'
+    os.environ.setdefault('SECRET_KEY', 'benchmark')
+    os.environ.setdefault('PASSWORD_SCRYPT_COST', '10')
+
+    students = args.processes * args.threads
+    seed(students)
+
+    context = multiprocessing.get_context('spawn')
+    results = context.Queue()
+    started = perf_counter()
+    processes = [context.Process(target=worker, args=(p * args.threads, args.threads, args.iterations, results))
+                 for p in range(args.processes)]
+    for process in processes:
+        process.start()
+    outcomes = [results.get() for _ in processes]
+    for process in processes:
+        process.join()
+    elapsed = perf_counter() - started
+
+    latencies = sorted(l for latencies, _ in outcomes for l in latencies)
+    errors = [e for _, errors in outcomes for e in errors]
+
+    from website import create_app, tenants
+    from website.headcount import rebuild
+    with create_app('production').app_context():
+        drift = []
+        for name in tenants.names():
+            with tenants.using(name):
+                drift += rebuild(check_only=True)
+
+    def percentile(fraction):
+        return latencies[min(len(latencies) - 1, int(fraction * len(latencies)))] * 1000 if latencies else 0.0
+
+    report = {
+        'processes': args.processes,
+        'threads': args.threads,
+        'tenants': args.tenants,
+        'writes': len(latencies),
+        'errors': len(errors),
+        'seconds': elapsed,
+        'writes_per_second': len(latencies) / elapsed if elapsed else 0.0,
+        'p50_ms': percentile(0.50),
+        'p95_ms': percentile(0.95),
+        'p99_ms': percentile(0.99),
+        'head_count_drift': len(drift),
+    }
+    for error in errors[:10]:
+        print(error, file=sys.stderr)
+    print(json.dumps(report, indent=2))
+    return 1 if errors or drift else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
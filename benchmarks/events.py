@@ -0,0 +1,161 @@
+"""
+Live event stream benchmark: many dashboards on /manager/events.
+
+Seeds a synthetic academy (see seed.py) into a scratch SQLite database and
+connects --subscribers manager dashboards to the event stream, each read by its
+own thread through the Flask test client. A gate terminal then swipes every
+card for a meal of the current week through POST /api/v1/gate/checks, one card
+per request. The run reports:
+
+- delivery latency from the gate request to each dashboard receiving the
+  admission event (median, p99 and max);
+- process CPU time per second while every dashboard is connected and idle;
+- whether every dashboard's served and booked counters, kept only from the
+  snapshot and the events, match the Admission rows and head-counts in the
+  database afterwards.
+
+Run with:
+
+    python -m benchmarks.events [--students 1000] [--subscribers 100] [--idle 5]
+"""
+
+import argparse
+import json
+import os
+import statistics
+import sys
+import tempfile
+import threading
+from datetime import date, datetime, timedelta
+from time import perf_counter, process_time, sleep
+
+from benchmarks.seed import PASSWORD, STAFF, seed_academy, student_card
+
+STOP = 'benchmark-stop'
+
+
+def read_events(response):
+    """Yields (event_type, data) from a server-sent events response."""
+    for chunk in response.iter_encoded():
+        for message in chunk.decode().split('\n\n'):
+            fields = dict(line.split(': ', 1) for line in message.split('\n') if ': ' in line
+                          and not line.startswith(':'))
+            if 'event' in fields:
+                yield fields['event'], json.loads(fields['data'])
+
+
+def serving_time(slot):
+    """A time this week at which the slot is being served."""
+    from website import slots
+
+    meal, day = slots.SLOTS[slot]
+    start, _ = slots.MEAL_TIMES[meal]
+    monday = date.today() - timedelta(days=date.today().weekday())
+    return datetime.combine(monday + timedelta(days=slots.DAYS.index(day)), start) + timedelta(minutes=1)
+
+
+def subscriber(client, ready, result):
+    """Keeps one dashboard's counters from the stream until the stop event."""
+    response = client.get('/manager/events')
+    live, arrivals = None, []
+    for event_type, data in read_events(response):
+        if event_type == 'snapshot':
+            live = data
+            ready.set()
+        elif event_type == 'admission' and live and (data['year'], data['week']) == (live['year'], live['week']):
+            live['served'][data['slot']] += 1
+            arrivals.append(perf_counter())
+        elif event_type == 'booking' and live and (data['year'], data['week']) == (live['year'], live['week']):
+            for index in range(len(live['slots'])):
+                live['booked'][index] += (data['added'] >> index & 1) - (data['removed'] >> index & 1)
+        elif event_type == STOP:
+            break
+    response.close()
+    result.update(live=live, arrivals=arrivals)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--students', type=int, default=1000)
+    parser.add_argument('--subscribers', type=int, default=100)
+    parser.add_argument('--idle', type=float, default=5.0, help='Seconds to measure idle CPU over.')
+    parser.add_argument('--slot', type=int, default=0, help='Slot of the current week the cards are swiped for.')
+    args = parser.parse_args()
+
+    scratch = tempfile.mkdtemp(prefix='samam-events-')
+    os.environ['TEST_DATABASE_URL'] = f'sqlite:///{os.path.join(scratch, "academy.db")}'
+    from website import create_app, db, events, gate, headcount
+    from website.models import Admission
+
+    app = create_app('testing')
+    # The swipes replay a meal of this week that may not be being served right now
+    app.config['GATE_CHECK_WINDOW'] = 7 * 24 * 3600
+    # One thread per dashboard here, so every one of them may stream
+    app.config['EVENT_MAX_STREAMS'] = args.subscribers
+    seed_academy(app, args.students, weeks=2)
+
+    def logged_in(email):
+        client = app.test_client()
+        client.post('/login', data={'email': email, 'password': PASSWORD})
+        return client
+
+    # Connect every dashboard before the first swipe
+    results = [{} for _ in range(args.subscribers)]
+    ready = [threading.Event() for _ in range(args.subscribers)]
+    threads = [threading.Thread(target=subscriber, args=(logged_in(STAFF['manager']), ready[i], results[i]))
+               for i in range(args.subscribers)]
+    for thread in threads:
+        thread.start()
+    for event in ready:
+        event.wait()
+
+    # Idle dashboards should only wake for keep-alives
+    sleep(0.5)
+    cpu, started = process_time(), perf_counter()
+    sleep(args.idle)
+    idle_cpu = (process_time() - cpu) / (perf_counter() - started)
+
+    terminal = logged_in(STAFF['access'])
+    when = serving_time(args.slot).isoformat(timespec='seconds')
+    sent = []
+    for i in range(args.students):
+        request_started = perf_counter()
+        verdict = terminal.post('/api/v1/gate/checks', json={'cards': [[student_card(i), when]]}).json['verdicts'][0]
+        if verdict['granted']:
+            sent.append(request_started)
+    sleep(0.5)
+    events.bus.publish(STOP, {})
+    for thread in threads:
+        thread.join()
+
+    with app.app_context():
+        gate.admissions.flush()
+        year, week = date.today().isocalendar()[:2]
+        served = [0] * len(results[0]['live']['served'])
+        for slot, count in db.session.query(Admission.slot, db.func.count()).filter(
+                Admission.year == year, Admission.week == week).group_by(Admission.slot):
+            served[slot] = count
+        booked = headcount.weekly_totals(year, week)
+
+    latencies = sorted((arrival - sent[index]) * 1000 for result in results
+                       for index, arrival in enumerate(result['arrivals']))
+    drift = sum(result['live']['served'] != served or result['live']['booked'] != booked for result in results)
+    summary = {
+        'subscribers': args.subscribers,
+        'admissions': len(sent),
+        'deliveries': len(latencies),
+        'latency_median_ms': statistics.median(latencies) if latencies else None,
+        'latency_p99_ms': latencies[int(len(latencies) * 0.99) - 1] if latencies else None,
+        'latency_max_ms': latencies[-1] if latencies else None,
+        'idle_cpu_seconds_per_second': idle_cpu,
+        'dashboards_out_of_sync': drift,
+    }
+    print(json.dumps(summary, indent=2))
+    failed = drift or len(latencies) != len(sent) * args.subscribers
+    if failed:
+        print('Dashboards missed events or drifted from the database', file=sys.stderr)
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,57 @@
+"""
+Kitchen forecast refit benchmark.
+
+Builds synthetic week x slot history (bookings drifting with the cohort size,
+dish effects and gate admissions with a no-show rate) and times `fit()` on it,
+so the cost of refitting on years of history can be checked without a
+database. Run with:
+
+    python -m benchmarks.forecast [--years 10] [--students 5000] [--dishes 200] [--repeat 5]
+
+Needs NumPy, like the forecast itself.
+"""
+
+import argparse
+import json
+from time import perf_counter
+import numpy as np
+from website import slots
+from website.forecast import fit
+
+
+def synthetic_history(years, students, dishes, seed=0):
+    """Returns load_history()-shaped matrices covering the given number of years."""
+    rng = np.random.default_rng(seed)
+    weeks = years * 52
+    ages = np.arange(weeks, 0, -1, dtype=float)
+    cohort = students * (1 + 0.1 * np.sin(np.arange(weeks) / 52 * 2 * np.pi))
+    popularity = rng.uniform(0.6, 0.95, slots.SLOT_COUNT)
+    dish_ids = rng.integers(-1, dishes, (weeks, slots.SLOT_COUNT))
+    dish_effect = np.append(rng.uniform(0.8, 1.2, dishes), 1.0)
+    booked = rng.poisson(cohort[:, None] * popularity * dish_effect[dish_ids]).astype(float)
+    admitted = rng.binomial(booked.astype(int), 0.85).astype(float)
+    admitted[:weeks // 2] = np.nan
+    return {'ages': ages, 'booked': booked, 'admitted': admitted, 'dishes': dish_ids,
+            'target_dishes': rng.integers(-1, dishes, slots.SLOT_COUNT)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--years', type=int, default=10)
+    parser.add_argument('--students', type=int, default=5000)
+    parser.add_argument('--dishes', type=int, default=200)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    history = synthetic_history(args.years, args.students, args.dishes)
+    timings = []
+    for _ in range(args.repeat):
+        started = perf_counter()
+        model = fit(history)
+        timings.append(perf_counter() - started)
+    print(json.dumps({'weeks': len(history['ages']), 'slots': slots.SLOT_COUNT,
+                      'fit_ms': min(timings) * 1000, 'no_show_mean': float(model['no_show'].mean())}, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,246 @@
+"""
+Reproducible benchmark harness for the booking, gate and reporting paths.
+
+Seeds a synthetic academy (see seed.py) into a scratch SQLite database, then
+drives the main endpoints twice:
+
+- through the Flask test client, one request at a time, to measure the cost
+  of a single request without network overhead;
+- through a multi-threaded HTTP load generator against a real threaded WSGI
+  server, to measure throughput and tail latency under concurrency.
+
+For every endpoint it reports p50/p95/p99 latency, throughput and the number
+of SQL statements per request, and saves the results as JSON. A previous
+results file can be compared against to catch regressions:
+
+    python -m benchmarks.harness --students 2000 --output results.json
+    python -m benchmarks.harness --students 2000 --compare results.json
+"""
+
+import argparse
+import http.cookiejar
+import json
+import logging
+import os
+import platform
+import sys
+import tempfile
+import threading
+import urllib.parse
+import urllib.request
+from datetime import datetime
+from time import perf_counter
+
+from benchmarks.seed import PASSWORD, STAFF, seed_academy, student_card, student_email
+
+# (name, role, method, path, payload builder taking the student index)
+ENDPOINTS = (
+    ('auth.login', None, 'POST', '/login', None),
+    ('views.student', 'student', 'POST', '/student/',
+     lambda i: {'breakfast': ['monday', 'wednesday'], 'supper': ['friday']}),
+    ('views.modify', 'student', 'POST', '/student/modify_bookings/',
+     lambda i: {'lunch': ['tuesday'], 'brunch': ['saturday'], 'supper': ['sunday']}),
+    ('views.bookings', 'manager', 'GET', '/manager/bookings/', None),
+    ('auth.access', 'access', 'POST', '/access', lambda i: {'user_id': str(i + 4)}),
+    ('auth.scan', 'access', 'POST', '/access/scan', lambda i: {'rfid_code': student_card(i)}),
+)
+
+
+def summarise(latencies, statements, elapsed):
+    """Reduces raw samples to the reported statistics."""
+    latencies = sorted(latencies)
+
+    def percentile(fraction):
+        return latencies[min(len(latencies) - 1, int(fraction * len(latencies)))] * 1000 if latencies else 0.0
+
+    return {
+        'requests': len(latencies),
+        'p50_ms': percentile(0.50),
+        'p95_ms': percentile(0.95),
+        'p99_ms': percentile(0.99),
+        'throughput_rps': len(latencies) / elapsed if elapsed else 0.0,
+        'sql_statements': sum(statements) / len(statements) if statements else 0.0,
+    }
+
+
+def instrument(app):
+    """Counts SQL statements per request and returns them in a response header."""
+    from flask import g, has_request_context
+    from sqlalchemy import event
+    from website import db
+
+    with app.app_context():
+        @event.listens_for(db.engine, 'before_cursor_execute')
+        def count_statement(*args):
+            if has_request_context():
+                g.sql_statements = g.get('sql_statements', 0) + 1
+
+    @app.after_request
+    def report_statements(response):
+        response.headers['X-SQL-Statements'] = str(g.get('sql_statements', 0))
+        return response
+
+
+def login_email(role, index):
+    """Account used for a role; students rotate through the seeded cohort."""
+    return student_email(index) if role in (None, 'student') else STAFF[role]
+
+
+def run_test_client(app, students, iterations):
+    """Runs every endpoint sequentially through the Flask test client."""
+    results = {}
+    for name, role, method, path, payload in ENDPOINTS:
+        client = app.test_client()
+        if role:
+            client.post('/login', data={'email': login_email(role, 0), 'password': PASSWORD})
+        latencies, statements = [], []
+        started = perf_counter()
+        for i in range(iterations):
+            index = i % students
+            if role is None:
+                client = app.test_client()
+                data = {'email': login_email(None, index), 'password': PASSWORD}
+            else:
+                data = payload(index) if payload else None
+            request_started = perf_counter()
+            response = client.open(path, method=method, data=data)
+            latencies.append(perf_counter() - request_started)
+            statements.append(int(response.headers.get('X-SQL-Statements', 0)))
+        results[name] = summarise(latencies, statements, perf_counter() - started)
+    return results
+
+
+def run_http(app, students, threads, iterations):
+    """Runs every endpoint from several client threads against a threaded WSGI server."""
+    from werkzeug.serving import make_server
+
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+    server = make_server('127.0.0.1', 0, app, threaded=True)
+    base = f'http://127.0.0.1:{server.server_port}'
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    def opener():
+        return urllib.request.build_opener(urllib.request.HTTPCookieProcessor(http.cookiejar.CookieJar()))
+
+    def call(session, method, path, data):
+        body = urllib.parse.urlencode(data, doseq=True).encode() if data is not None else None
+        request = urllib.request.Request(base + path, data=body, method=method)
+        try:
+            with session.open(request) as response:
+                response.read()
+                return int(response.headers.get('X-SQL-Statements', 0)), None
+        except urllib.error.HTTPError as error:
+            return int(error.headers.get('X-SQL-Statements', 0)), error.code
+
+    results = {}
+    try:
+        for name, role, method, path, payload in ENDPOINTS:
+            samples = [[] for _ in range(threads)]
+            errors = [0] * threads
+
+            def client(worker):
+                session = opener()
+                if role:
+                    call(session, 'POST', '/login', {'email': login_email(role, worker), 'password': PASSWORD})
+                for i in range(iterations):
+                    index = (worker * iterations + i) % students
+                    if role is None:
+                        session = opener()
+                        data = {'email': login_email(None, index), 'password': PASSWORD}
+                    else:
+                        data = payload(index) if payload else None
+                    request_started = perf_counter()
+                    statements, error = call(session, method, path, data)
+                    samples[worker].append((perf_counter() - request_started, statements))
+                    errors[worker] += error is not None
+
+            workers = [threading.Thread(target=client, args=(w,)) for w in range(threads)]
+            started = perf_counter()
+            for worker in workers:
+                worker.start()
+            for worker in workers:
+                worker.join()
+            elapsed = perf_counter() - started
+
+            flat = [sample for worker_samples in samples for sample in worker_samples]
+            results[name] = summarise([s[0] for s in flat], [s[1] for s in flat], elapsed)
+            results[name]['errors'] = sum(errors)
+    finally:
+        server.shutdown()
+    return results
+
+
+def compare(current, baseline, tolerance):
+    """Prints p95 latency changes and returns the regressed (mode, endpoint) pairs."""
+    regressions = []
+    for mode, endpoints in current['results'].items():
+        for name, stats in endpoints.items():
+            before = baseline.get('results', {}).get(mode, {}).get(name)
+            if not before or not before['p95_ms']:
+                continue
+            ratio = stats['p95_ms'] / before['p95_ms']
+            flag = 'REGRESSION' if ratio > tolerance else ''
+            print(f'{mode:<11} {name:<15} p95 {before["p95_ms"]:8.2f} -> {stats["p95_ms"]:8.2f} ms '
+                  f'({ratio:5.2f}x)  sql {before["sql_statements"]:.1f} -> {stats["sql_statements"]:.1f} {flag}')
+            if flag:
+                regressions.append((mode, name))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--students', type=int, default=2000)
+    parser.add_argument('--weeks', type=int, default=4)
+    parser.add_argument('--iterations', type=int, default=200, help='Requests per endpoint (per thread over HTTP).')
+    parser.add_argument('--threads', type=int, default=8, help='HTTP load generator threads.')
+    parser.add_argument('--output', default=None, help='Write results JSON to this file.')
+    parser.add_argument('--compare', default=None, help='Baseline results JSON to compare against.')
+    parser.add_argument('--tolerance', type=float, default=1.25, help='p95 ratio flagged as a regression.')
+    args = parser.parse_args()
+
+    scratch = tempfile.mkdtemp(prefix='samam-bench-')
+    os.environ['TEST_DATABASE_URL'] = f'sqlite:///{os.path.join(scratch, "academy.db")}'
+    from website import create_app
+
+    app = create_app('testing')
+    app.config['PROPAGATE_EXCEPTIONS'] = False
+    seed_academy(app, args.students, args.weeks)
+    instrument(app)
+
+    results = {
+        'meta': {
+            'date': datetime.now().isoformat(timespec='seconds'),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'students': args.students,
+            'weeks': args.weeks,
+            'iterations': args.iterations,
+            'threads': args.threads,
+        },
+        'results': {
+            'testclient': run_test_client(app, args.students, args.iterations),
+            'http': run_http(app, args.students, args.threads, args.iterations),
+        },
+    }
+
+    for mode, endpoints in results['results'].items():
+        print(f'\n{mode}')
+        print(f'{"endpoint":<15} {"p50 ms":>8} {"p95 ms":>8} {"p99 ms":>8} {"req/s":>8} {"sql":>6}')
+        for name, stats in endpoints.items():
+            print(f'{name:<15} {stats["p50_ms"]:8.2f} {stats["p95_ms"]:8.2f} {stats["p99_ms"]:8.2f} '
+                  f'{stats["throughput_rps"]:8.1f} {stats["sql_statements"]:6.1f}')
+
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(results, output, indent=2)
+
+    if args.compare:
+        with open(args.compare) as baseline:
+            print()
+            if compare(results, json.load(baseline), args.tolerance):
+                return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,66 @@
+"""
+Password hashing throughput benchmark.
+
+Measures how many logins per second one core can verify at each hash cost, and
+the throughput of the shared verification pool with all workers busy, so the
+service can be sized for the start of meal periods. Run with:
+
+    python -m benchmarks.passwords [--method scrypt] [--costs 12 13 14 15] [--seconds 2] [--workers N]
+
+For scrypt the cost is log2 of the work factor N; for pbkdf2_sha256 it is the
+iteration count.
+"""
+
+import argparse
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+from time import perf_counter
+from website.passwords import DEFAULT_COSTS, hash_password, verify_password
+
+
+def measure(function, seconds):
+    """Calls function repeatedly for about the given time, returning calls per second."""
+    calls = 0
+    started = perf_counter()
+    while perf_counter() - started < seconds:
+        function()
+        calls += 1
+    return calls / (perf_counter() - started)
+
+
+def measure_pool(stored, workers, seconds):
+    """Runs verifications on a pool of threads, returning verifications per second."""
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        batch = max(workers * 4, 8)
+        calls = 0
+        started = perf_counter()
+        while perf_counter() - started < seconds:
+            list(pool.map(lambda _: verify_password(stored, 'correct horse battery'), range(batch)))
+            calls += batch
+        return calls / (perf_counter() - started)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--method', default='scrypt', choices=sorted(DEFAULT_COSTS))
+    parser.add_argument('--costs', type=int, nargs='+', default=None)
+    parser.add_argument('--seconds', type=float, default=2.0, help='Measurement time per cost.')
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1)
+    args = parser.parse_args()
+
+    costs = args.costs or ([12, 13, 14, 15] if args.method == 'scrypt' else [200000, 400000, 600000])
+    results = []
+    print(f'{"cost":>8} {"ms/login":>9} {"logins/s/core":>14} {"pool logins/s":>14}')
+    for cost in costs:
+        stored = hash_password('correct horse battery', args.method, cost)
+        per_core = measure(lambda: verify_password(stored, 'correct horse battery'), args.seconds)
+        pooled = measure_pool(stored, args.workers, args.seconds)
+        results.append({'method': args.method, 'cost': cost, 'workers': args.workers,
+                        'logins_per_second_per_core': per_core, 'pool_logins_per_second': pooled})
+        print(f'{cost:>8} {1000 / per_core:>9.1f} {per_core:>14.1f} {pooled:>14.1f}')
+    print(json.dumps(results))
+
+
+if __name__ == '__main__':
+    main()
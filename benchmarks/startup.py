@@ -0,0 +1,137 @@
+"""
+Cold start benchmark: time from process start to the first served request.
+
+Migrates a scratch SQLite database once, then starts several fresh Python
+processes as a new WSGI worker would. Each imports the app, builds it with
+`create_app('production')` and serves its first requests (the login page, then
+a logged-in JSON API read) through the Flask test client. The parent measures
+each process from spawn to the first response; the child reports where the
+time went and every SQL statement it ran. The run fails if the median time to
+first request exceeds --budget-ms, or if any worker issued DDL (start-up must
+leave schema changes to `flask migrate`). Run with:
+
+    python -m benchmarks.startup [--runs 7] [--budget-ms 1500]
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+from time import perf_counter
+
+PASSWORD = 'load-test-password'
+EMAIL = 'startup@academy.test'
+
+# Runs in each fresh worker process; prints one JSON line once the first requests are served
+WORKER = '''
+import json, sys
+from time import perf_counter
+started = perf_counter()
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+statements = []
+event.listen(Engine, 'before_cursor_execute', lambda *args: statements.append(args[2]))
+from website import create_app
+imported = perf_counter()
+app = create_app('production')
+created = perf_counter()
+client = app.test_client()
+login_page = client.get('/login')
+first = perf_counter()
+client.post('/api/v1/session', json={'email': sys.argv[1], 'password': sys.argv[2]})
+booking = client.get('/api/v1/booking')
+api = perf_counter()
+print(json.dumps({
+    'status': [login_page.status_code, booking.status_code],
+    'import_ms': (imported - started) * 1000,
+    'create_app_ms': (created - imported) * 1000,
+    'first_request_ms': (first - created) * 1000,
+    'first_api_ms': (api - first) * 1000,
+    'statements': statements,
+}), flush=True)
+'''
+
+DDL = ('CREATE ', 'ALTER ', 'DROP ')
+
+
+def prepare():
+    """Migrates the scratch database and creates the account the worker logs in with."""
+    from website import create_app, db
+    from website.migrations import upgrade
+    from website.models import User
+    from website.passwords import hash_password
+
+    app = create_app('production')
+    with app.app_context():
+        upgrade()
+        db.session.add(User(initials='ST', surname='Startup', email=EMAIL, password=hash_password(PASSWORD),
+                            role='student'))
+        db.session.commit()
+
+
+def run_worker():
+    """Starts one worker process and returns its report with the wall time to its first response."""
+    spawned = perf_counter()
+    process = subprocess.Popen([sys.executable, '-c', WORKER, EMAIL, PASSWORD], stdout=subprocess.PIPE, text=True)
+    line = process.stdout.readline()
+    wall = perf_counter() - spawned
+    process.wait()
+    if process.returncode or not line:
+        raise RuntimeError(f'worker exited with status {process.returncode}')
+    report = json.loads(line)
+    report['wall_ms'] = wall * 1000
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--runs', type=int, default=7)
+    parser.add_argument('--budget-ms', type=float, default=1500.0,
+                        help='Median time from spawn to the first served request allowed.')
+    args = parser.parse_args()
+
+    scratch = tempfile.mkdtemp(prefix='samam-startup-')
+    os.environ['DATABASE_URL'] = f'sqlite:///{os.path.join(scratch, "academy.db")}'
+    os.environ['SESSION_COOKIE_SECURE'] = '0'
+    os.environ.setdefault('SECRET_KEY', 'benchmark')
+    os.environ.setdefault('PASSWORD_SCRYPT_COST', '10')
+    prepare()
+
+    # The first run also writes the bytecode caches, as a deployment's first worker would
+    reports = [run_worker() for _ in range(args.runs + 1)][1:]
+    ddl = sorted({statement.split('(')[0].strip() for report in reports for statement in report['statements']
+                  if statement.lstrip().upper().startswith(DDL)})
+    errors = sorted({status for report in reports for status in report['status'] if status >= 400})
+
+    def median(key):
+        return statistics.median(report[key] for report in reports)
+
+    summary = {
+        'runs': args.runs,
+        'wall_to_first_request_ms': median('wall_ms'),
+        'wall_max_ms': max(report['wall_ms'] for report in reports),
+        'import_ms': median('import_ms'),
+        'create_app_ms': median('create_app_ms'),
+        'first_request_ms': median('first_request_ms'),
+        'first_api_ms': median('first_api_ms'),
+        'statements_at_startup': median_count(reports),
+        'ddl_statements': ddl,
+        'budget_ms': args.budget_ms,
+    }
+    print(json.dumps(summary, indent=2))
+    failed = summary['wall_to_first_request_ms'] > args.budget_ms or ddl or errors
+    if failed:
+        print(f'Start-up over budget, issued DDL or failed requests {errors}', file=sys.stderr)
+    return 1 if failed else 0
+
+
+def median_count(reports):
+    """Median number of SQL statements a worker ran up to its first API response."""
+    return statistics.median(len(report['statements']) for report in reports)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -2,71 +2,96 @@
 This script sets up a Flask application for an academy management system.
 
 It includes:
-- Flask app initialization with secret key and database configuration.
-- SQLAlchemy integration for managing the SQLite database.
+- Flask app initialization from a configuration profile (see config.py).
+- SQLite tuning: WAL journal, busy timeout and pragmas on every connection.
+- SQLAlchemy integration for managing the SQLite database, with one database
+  per tenant selected per request (see tenants.py).
 - Flask-Login setup for user authentication.
-- Blueprint registration for organizing routes.
-- Database creation upon app context creation.
-- Definition of a user loader function for Flask-Login.
+- Blueprint registration for organizing routes, including the JSON API (see api.py).
+- No schema work at start-up: tables are created and migrated only by
+  `flask migrate` (see migrations.py), so starting a worker never issues DDL.
+- CLI command registration (see commands.py).
+- Opt-in request instrumentation and /metrics (see instrumentation.py).
+- Definition of a cached user loader function for Flask-Login.
 
 Functions:
-- create_app(): Initializes the Flask application with necessary configurations.
-- create_database(app): Creates the SQLite database if it doesn't exist.
+- create_app(config_name=None): Initializes the Flask application with necessary configurations.
 
 Modules Imported:
 - Flask: For creating the web application.
 - SQLAlchemy: For database management.
-- path from os: For file path operations.
 - LoginManager from flask_login: For user authentication.
 """
 
 # Import necessary modules
+import os
 from flask import Flask
 from flask_sqlalchemy import SQLAlchemy
-from os import path
+from sqlalchemy import event
 from flask_login import LoginManager
+from .tenants import TenantSession
 
-# Create SQLAlchemy database instance
-db = SQLAlchemy()
+# Create SQLAlchemy database instance; its session binds statements to the current tenant's database
+db = SQLAlchemy(session_options={'class_': TenantSession})
 
-# Define the name of the SQLite database
-DB_NAME = "academy.db"
-
-def create_app():
+def create_app(config_name=None):
     """
     Initializes the Flask application with necessary configurations.
 
+    Args:
+        config_name (str, optional): 'development', 'production' or 'testing';
+            defaults to the SAMAM_CONFIG environment variable, then 'development'.
+
     Returns:
         Flask: Initialized Flask application.
+
+    Raises:
+        ValueError: If the profile has no SECRET_KEY, e.g. 'production' without one in the environment.
     """
     # Initialize Flask app
     app = Flask(__name__)
 
-    # Set secret key for session management
-    app.config['SECRET_KEY'] = 'owenvwvibwecnaxcdibvccan'
-
-    # Set database URI for SQLAlchemy
-    app.config['SQLALCHEMY_DATABASE_URI'] = f'sqlite:///{DB_NAME}'
-
+    # Load the configuration profile (secret key, database URI, pool and cache settings)
+    from .config import CONFIGS, engine_options, sqlite_pragmas
+    app.config.from_object(CONFIGS[config_name or os.environ.get('SAMAM_CONFIG', 'development')])
+    if not app.config.get('SECRET_KEY'):
+        # Only the production profile has no built-in key, so sessions cannot be signed with a public one
+        raise ValueError('SECRET_KEY must be set in the environment for this configuration')
+    app.config.setdefault('SQLALCHEMY_ENGINE_OPTIONS', engine_options(app.config))
+
+    # Declare one database bind per tenant and route requests to the tenant of their host
+    from . import tenants
+    tenants.init_app(app)
+    
     # Initialize SQLAlchemy with the Flask app
     db.init_app(app)
     
-    # Import views and authentication blueprints
+    # Enable WAL, busy_timeout and tuned pragmas on every SQLite connection, in every tenant's database
+    with app.app_context():
+        for engine in db.engines.values():
+            if engine.dialect.name == 'sqlite':
+                event.listen(engine, 'connect', sqlite_pragmas(app.config['DB_BUSY_TIMEOUT']))
+    
+    # Import views, authentication and JSON API blueprints
     from .views import views
     from .auth import auth
+    from .api import api
     
     # Register blueprints with app
     app.register_blueprint(views, url_prefix='/')
     app.register_blueprint(auth, url_prefix='/')
+    app.register_blueprint(api, url_prefix='/api/v1')
     
-    # Import models
-    from .models import User, Booking, Weekly_menu, Access_Card, Reminder, Booking_Modification_Log
+    # Register CLI commands such as `flask migrate`
+    from .commands import register_commands
+    register_commands(app)
     
-    # Create database tables within app context
-    with app.app_context():
-        db.create_all()
+    # Record per-request SQL, template and wall time when INSTRUMENTATION is enabled
+    from . import instrumentation
+    instrumentation.init_app(app)
     
-    # Initialize Flask-Login
+    # Initialize Flask-Login, loading users through the cross-request cache
+    from . import user_cache
     login_manager = LoginManager()
     login_manager.login_view = 'auth.login'
     login_manager.init_app(app)
@@ -80,25 +105,12 @@ def create_app():
             id (int): User ID.
 
         Returns:
-            User: User object corresponding to the given ID.
+            CachedUser: Cached copy of the user with the given ID (see user_cache.py),
+            or None if the login session belongs to another tenant.
         """
-        return User.query.get(int(id))
+        if not tenants.session_matches():
+            return None
+        return user_cache.users.get(int(id))
     
     # Return the initialized app
     return app
-     
-
-def create_database(app):
-    """
-    Creates the SQLite database if it doesn't exist.
-
-    Args:
-        app (Flask): Flask application.
-
-    Returns:
-        None
-    """
-    if not path.exists('website/' + DB_NAME):
-        # Create all database tables within app context
-        db.create_all(app=app)
-        print('Created Database!')
@@ -0,0 +1,299 @@
+"""
+Versioned JSON API for the mobile and kiosk clients.
+
+The `api` blueprint is mounted at /api/v1 and answers with compact JSON only:
+no templates, flash messages or redirects. Meal choices travel as slot bitmaps
+(bit i is slots.SLOTS[i], listed once by GET /api/v1/slots) instead of one
+field per meal and day.
+
+Readable resources carry a weak ETag built from row versions: Booking and
+Weekly_menu have a version column that SQLAlchemy increments on every update
+(version_id_col). A client sending the ETag back in If-None-Match gets an empty
+304 when nothing changed, decided before the response body is built. A week's
+booking pages are tagged with the week's revision, which every booking change
+increments (see headcount.touch()). PUT
+/api/v1/booking accepts If-Match and answers 412 if the booking changed since
+the client read it.
+
+Routes:
+- POST /api/v1/session: Logs in with {"email", "password"}; DELETE logs out.
+- GET /api/v1/slots: The slot order used by every bitmap.
+- GET /api/v1/booking: The student's booking of a week (?year=&week=, next week by default).
+- PUT /api/v1/booking: Books or changes next week's meals with {"slots": bitmap}
+  or {"slots": {"meal": ["day", ...]}}.
+- GET /api/v1/menu: A week's menu (?year=&week=, next week by default).
+- GET /api/v1/manager/bookings: One page of a week's bookings, as /manager/bookings.json.
+- POST /api/v1/gate/checks: Checks a batch of card swipes, {"cards": ["rfid", ...]}
+  or {"cards": [["rfid", "2026-03-02T12:31:00"], ...]}, recording granted ones.
+  A swipe more than GATE_CHECK_WINDOW seconds (default 300) from the server's
+  clock is refused as 'invalid_time', and a card already admitted to the meal,
+  earlier in the batch or before, as 'already_admitted'. Offline swipes are
+  replayed with gate_offline.py instead.
+
+Errors are {"error": message} with the HTTP status.
+
+Functions:
+- api_login_required(*roles): Decorator answering 401/403 as JSON instead of redirecting.
+"""
+
+import zlib
+from datetime import datetime, timedelta
+from functools import wraps
+from flask import Blueprint, Response, current_app, jsonify, request
+from flask_login import current_user, login_user, logout_user
+from sqlalchemy import func, literal, select
+from sqlalchemy.orm.exc import StaleDataError
+from . import db
+from . import slots
+from . import gate
+from . import capacity
+from . import headcount
+from . import pagination
+from . import week_archive
+from .models import Booking, User, Waitlist
+from .passwords import check_password, hash_password, needs_rehash
+from .menu_cache import menus as menu_cache
+from .views import get_booking_week, get_locked_booking, is_iso_week, update_booking
+
+api = Blueprint('api', __name__)
+
+# Swipes accepted in one POST /api/v1/gate/checks body
+MAX_BATCH_SIZE = 500
+
+
+def api_login_required(*roles):
+    """
+    Requires a logged-in user, and one of the given roles if any.
+
+    Args:
+        *roles (str): Roles allowed; any role if none are given.
+
+    Returns:
+        function: Decorator answering 401 or 403 JSON errors.
+    """
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            if not current_user.is_authenticated:
+                return _error('Login required', 401)
+            if roles and current_user.role not in roles:
+                return _error('Not allowed for this role', 403)
+            return view(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def _error(message, status):
+    """JSON error response."""
+    return jsonify(error=message), status
+
+
+def _not_modified(tag):
+    """Empty 304 response if the client already holds the ETag, otherwise None."""
+    if request.if_none_match.contains_weak(tag):
+        response = Response(status=304)
+        response.set_etag(tag, weak=True)
+        return response
+    return None
+
+
+def _tagged(body, tag):
+    """JSON response carrying the ETag."""
+    response = jsonify(body)
+    response.set_etag(tag, weak=True)
+    return response
+
+
+def _swipe(card, now):
+    """Reads a card of a gate batch as (rfid_code, time); None if it is malformed."""
+    if isinstance(card, str):
+        rfid_code, when = card, now
+    elif isinstance(card, list) and len(card) == 2 and isinstance(card[0], str) and isinstance(card[1], str):
+        try:
+            rfid_code, when = card[0], datetime.fromisoformat(card[1])
+        except ValueError:
+            return None
+    else:
+        return None
+    if when.tzinfo is not None:
+        when = when.astimezone().replace(tzinfo=None)
+    rfid_code = rfid_code.strip()
+    return (rfid_code, when) if rfid_code else None
+
+
+def _requested_slots(payload):
+    """Reads a slot bitmap from a request body; None if it is malformed."""
+    choice = payload.get('slots') if isinstance(payload, dict) else None
+    if isinstance(choice, bool):
+        return None
+    if isinstance(choice, int):
+        return choice if 0 <= choice <= slots.FULL_MASK else None
+    if isinstance(choice, dict) and all(isinstance(days, list) for days in choice.values()):
+        return slots.encode((meal, day) for meal, days in choice.items() for day in days)
+    return None
+
+
+def _booking_tag(booking, waiting):
+    """ETag of a student's booking: its row version and the slots they wait for."""
+    if booking is None:
+        return f'none.{waiting}'
+    return f'{booking.booking_id}.{booking.version}.{waiting}'
+
+
+def _booking_body(year, week, booking, waiting):
+    """JSON body of a student's booking."""
+    return {'year': year, 'week': week, 'booking_id': booking.booking_id if booking else None,
+            'version': booking.version if booking else None,
+            'slots': booking.meal_slots if booking else 0, 'waiting': waiting}
+
+
+# Route logging a client in or out
+@api.route('/session', methods=['POST', 'DELETE'])
+def session():
+    if request.method == 'DELETE':
+        logout_user()
+        return '', 204
+
+    payload = request.get_json(silent=True)
+    payload = payload if isinstance(payload, dict) else {}
+    email, password = payload.get('email'), payload.get('password')
+    if not email or not password:
+        return _error('email and password are required', 400)
+    user = User.query.filter_by(email=email).first()
+    if not user or not check_password(user.password, password):
+        return _error('Incorrect email or password', 401)
+    # Upgrade legacy plain-text rows and outdated hash parameters
+    if needs_rehash(user.password):
+        user.password = hash_password(password)
+        db.session.commit()
+    login_user(user, remember=True)
+    return jsonify(user_id=user.user_id, role=user.role)
+
+
+# Route listing the slot behind each bit of the slot bitmaps
+@api.route('/slots')
+def slot_order():
+    tag = f'slots.{slots.SLOT_COUNT}'
+    return _not_modified(tag) or _tagged({'slots': [f'{meal}:{day}' for meal, day in slots.SLOTS]}, tag)
+
+
+# Route reading, or booking and changing, the student's booking
+@api.route('/booking', methods=['GET', 'PUT'])
+@api_login_required('student')
+def booking():
+    if request.method == 'GET':
+        default_year, default_week = get_booking_week()
+        year = request.args.get('year', default_year, type=int)
+        week = request.args.get('week', default_week, type=int)
+        # One statement reads the booking's version and slots with the slots waited for
+        waited = select(func.coalesce(func.sum(literal(1).op('<<')(Waitlist.slot)), 0)).where(
+            Waitlist.user_waitlist_fk == current_user.user_id, Waitlist.year == year, Waitlist.week == week)
+        current_booking = db.session.execute(
+            select(Booking.booking_id, Booking.version, Booking.meal_slots, waited.scalar_subquery().label('waiting'))
+            .where(Booking.user_booking_id_fk == current_user.user_id, Booking.year == year, Booking.week == week)
+        ).first()
+        waiting = current_booking.waiting if current_booking else db.session.execute(waited).scalar()
+        tag = _booking_tag(current_booking, waiting)
+        return _not_modified(tag) or _tagged(_booking_body(year, week, current_booking, waiting), tag)
+
+    meal_slots = _requested_slots(request.get_json(silent=True))
+    if meal_slots is None:
+        return _error('slots must be a bitmap or an object of meal to days', 400)
+
+    # Only next week is open for booking
+    year, week = get_booking_week()
+    if request.if_match:
+        # Compare with the booking as it is now, before one is created for a first booking
+        existing = Booking.query.filter(Booking.user_booking_id_fk == current_user.user_id, Booking.year == year,
+                                        Booking.week == week).with_for_update().first()
+        waiting = capacity.waiting_slots(current_user.user_id, year, week)
+        if not request.if_match.contains_weak(_booking_tag(existing, waiting)):
+            db.session.rollback()
+            return _error('The booking has changed', 412)
+    current_booking = get_locked_booking(current_user.user_id, year, week)
+    try:
+        update_booking(current_booking, meal_slots)
+    except StaleDataError:
+        db.session.rollback()
+        return _error('The booking was changed at the same time, try again', 409)
+
+    waiting = capacity.waiting_slots(current_user.user_id, year, week)
+    return _tagged(_booking_body(year, week, current_booking, waiting), _booking_tag(current_booking, waiting))
+
+
+# Route returning a week's menu from the rendered-menu cache
+@api.route('/menu')
+@api_login_required()
+def menu():
+    default_year, default_week = get_booking_week()
+    year = request.args.get('year', default_year, type=int)
+    week = request.args.get('week', default_week, type=int)
+    if not is_iso_week(year, week):
+        return _error(f'{year} has no ISO week {week}', 400)
+    cached = menu_cache.get(year, week)
+    tag = f"menu.{year}.{week}.{cached['version']}"
+    not_modified = _not_modified(tag)
+    if not_modified:
+        return not_modified
+    response = Response(cached['json'], mimetype='application/json')
+    response.set_etag(tag, weak=True)
+    return response
+
+
+# Route returning one page of a week's bookings to managers
+@api.route('/manager/bookings')
+@api_login_required('manager')
+def manager_bookings():
+    default_year, default_week = get_booking_week()
+    year = request.args.get('year', default_year, type=int)
+    week = request.args.get('week', default_week, type=int)
+
+    # Every booking added, removed or updated in the week bumps its revision (see headcount.touch())
+    stamp = 'archived' if week_archive.is_archived(year, week) else headcount.revision(year, week)
+    tag = f'bookings.{year}.{week}.{stamp}.{zlib.crc32(request.query_string):x}'
+    not_modified = _not_modified(tag)
+    if not_modified:
+        return not_modified
+
+    try:
+        page = pagination.booking_page(
+            year, week, after=request.args.get('after') or None,
+            limit=request.args.get('limit', pagination.DEFAULT_PAGE_SIZE, type=int),
+            **{name: request.args.get(name) or None for name in ('meal', 'day', 'surname')})
+    except ValueError as error:
+        return _error(str(error), 400)
+    return _tagged({'year': year, 'week': week, 'bookings': page['bookings'], 'next': page['next']}, tag)
+
+
+# Route checking a batch of card swipes at the gate
+@api.route('/gate/checks', methods=['POST'])
+@api_login_required('access', 'manager')
+def gate_checks():
+    payload = request.get_json(silent=True)
+    cards = payload.get('cards') if isinstance(payload, dict) else None
+    if not isinstance(cards, list) or not cards:
+        return _error('cards must be a non-empty list', 400)
+    if len(cards) > MAX_BATCH_SIZE:
+        return _error(f'At most {MAX_BATCH_SIZE} cards per request', 413)
+
+    now = datetime.now()
+    window = timedelta(seconds=current_app.config.get('GATE_CHECK_WINDOW', 300))
+    swipes = [_swipe(card, now) for card in cards]
+    # Cards already admitted, queued in this process or written, so a card cannot pass back in
+    admitted = gate.admissions.admitted({(rfid_code, *when.isocalendar()[:2])
+                                         for rfid_code, when in filter(None, swipes)})
+    verdicts = []
+    for swipe in swipes:
+        if swipe is None:
+            verdicts.append({'granted': False, 'reason': 'invalid'})
+            continue
+        rfid_code, when = swipe
+        if abs(when - now) > window:
+            verdicts.append({'granted': False, 'reason': 'invalid_time'})
+            continue
+        verdict = gate.check(rfid_code, when, admitted)
+        if verdict['granted']:
+            admitted.add((rfid_code, *when.isocalendar()[:2], slots.SLOT_INDEX[(verdict['meal'], verdict['day'])]))
+            gate.admissions.record(rfid_code, verdict, when)
+        verdicts.append(verdict)
+    return jsonify(verdicts=verdicts)
@@ -1,7 +1,12 @@
-from flask import Blueprint, render_template, request, flash, redirect, url_for
+from flask import Blueprint, render_template, request, flash, redirect, url_for, jsonify
 from .models import User, Booking
-from .views import get_iso_week_number as wk
+from .views import get_booking_week
 from . import db 
+from . import gate
+from . import events
+from .user_cache import users as user_cache
+from .provisioning import validate_profile, read_rows, import_users
+from .passwords import check_password, hash_password, needs_rehash
 from flask_login import login_user, login_required, logout_user, current_user
 from datetime import datetime, date
 
@@ -21,7 +26,11 @@ def login():
         
         user = User.query.filter_by(email=email).first()
         if user:
-            if user.password == password:
+            if check_password(user.password, password):
+                # Upgrade legacy plain-text rows and outdated hash parameters
+                if needs_rehash(user.password):
+                    user.password = hash_password(password)
+                    db.session.commit()
                 flash('Logged in successfully!', category='success')
                 login_user(user, remember=True)
                 if user.role == "student":
@@ -65,31 +74,45 @@ def sign_up():
         role = request.form.get('role')
         
         user = User.query.filter_by(email=email1).first()
+        error = validate_profile(initials, surname, email1, email2, password1, password2, role)
         if user:
             flash('Email already exists.', category='error')
-        elif len(initials) == 0:
-            flash('Enter valid initials', category='error')
-        elif len(surname) < 2:
-            flash('Enter valid surname', category='error')
-        elif email1 != email2:
-            flash('Emails do not match', category='error')
-        elif len(email1) < 4:
-            flash('Enter valid email', category='error')
-        elif password1 != password2:
-            flash('Passwords do not match', category='error')
-        elif len(password1) < 8:
-            flash('Password characters must be more than 7', category='error')
-        elif len(role) < 1:
-            flash('Enter valid role', category='error')
+        elif error:
+            flash(error, category='error')
         else:
-            new_user = User(initials=initials, surname=surname, email=email1, password=password1, role=role)
+            new_user = User(initials=initials, surname=surname, email=email1, password=hash_password(password1), role=role)
             db.session.add(new_user)
             db.session.commit()
+            user_cache.invalidate(new_user.user_id)
             flash('User profile created!', category='success')
             return redirect(url_for('auth.login'))
         
     return render_template("sign_up.html", user=current_user)
 
+@auth.route('/accommodation/import', methods=['GET', 'POST'])
+@login_required
+def import_accounts():
+    """
+    Bulk imports user profiles.
+
+    On GET request, renders the import page.
+    On POST request, streams the uploaded CSV or JSONL file into the database in
+    batched transactions and reports the rows that could not be imported.
+    """
+    report = None
+    if request.method == 'POST':
+        upload = request.files.get('file')
+        if not upload or not upload.filename:
+            flash('Choose a CSV or JSONL file to import', category='error')
+        else:
+            report = import_users(read_rows(upload.stream, upload.filename))
+            user_cache.invalidate()
+            if request.accept_mimetypes.best == 'application/json':
+                return jsonify(report)
+            flash(f"Imported {report['created']} of {report['rows']} profiles", category='success')
+
+    return render_template("import_users.html", user=current_user, report=report)
+
 @auth.route('/access', methods=['GET', 'POST'])
 @login_required
 def access():
@@ -100,13 +123,35 @@ def access():
     On POST request, checks if the user has access based on booking information.
     """
     if request.method =='POST':
-        date_m = date.today()
-        week =  wk(date_m.year, date_m.month, date_m.day) 
+        year, week = get_booking_week()
         user_id = request.form.get("user_id")
-        booking_of_interest = Booking.query.filter(Booking.user_booking_id_fk == str(user_id), Booking.week == week+1).all()
+        booking_of_interest = Booking.query.filter(Booking.user_booking_id_fk == str(user_id), Booking.year == year, Booking.week == week).all()
         
+        events.access_checked(user_id, bool(booking_of_interest), datetime.now())
         if booking_of_interest:
             flash('Booking confirmed, access granted', category='success')
         else:
             flash('Booking not found, contact management for enquiries, Access Denied', category='error')
     return render_template("access.html", user=current_user)
+
+@auth.route('/access/scan', methods=['POST'])
+@login_required
+def scan():
+    """
+    Checks an RFID card swiped at the dining-hall gate.
+
+    Accepts `rfid_code` as form data or JSON and returns a JSON verdict for the
+    meal being served now, answered from the warm entitlement map in gate.py.
+    A card already admitted to the meal is refused; granted swipes are recorded
+    as admissions.
+    """
+    payload = request.get_json(silent=True) or request.form
+    rfid_code = (payload.get('rfid_code') or '').strip()
+    if not rfid_code:
+        return jsonify(error='rfid_code is required'), 400
+
+    when = datetime.now()
+    verdict = gate.check(rfid_code, when)
+    if verdict['granted']:
+        gate.admissions.record(rfid_code, verdict, when)
+    return jsonify(verdict)
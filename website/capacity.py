@@ -0,0 +1,304 @@
+"""
+Meal capacities, atomic seat reservation and the waitlist.
+
+Every Meal_Count row carries the capacity of its slot, empty for unlimited. New
+weeks take MEAL_CAPACITY (default unlimited) and `flask set-capacity` changes
+one slot of one week. A seat is taken with a single conditional update,
+
+    UPDATE meal__count SET head_count = head_count + 1
+    WHERE year = ? AND week = ? AND meal = ? AND day = ?
+      AND (capacity IS NULL OR head_count < capacity)
+
+so the database decides atomically which request gets the last seat and no
+read-then-write race can oversubscribe a sitting. Booking has a unique
+(user, year, week) index, so concurrent first bookings by one student cannot
+create two rows either.
+
+Slots that are full go on the Waitlist in arrival order. When a booking change,
+a capacity increase or an account removal frees seats, the oldest waiting
+students get them in the same transaction: each seat is taken with the same
+conditional update and the slot is added to the student's booking. After the
+commit, `after_commit()` brings the gate map and the booking change log up to
+date for the students promoted.
+
+The standing-order rollover takes its seats with `reserve_many()`, which
+waitlists the students who do not fit; only the head-count rebuild counts
+bookings as they are.
+
+Functions:
+- reserve(year, week, wanted): Takes a seat in every wanted slot that has one free.
+- reserve_many(year, week, wanted): Seats many students at once, waitlisting those who do not fit.
+- release(year, week, freed): Gives back the seats of freed slots.
+- change(user_id, year, week, old_slots, requested): Applies a student's booking change.
+- promote(year, week, freed): Seats waiting students in freed slots.
+- set_capacity(year, week, meal, day, capacity): Changes the capacity of a slot.
+- waiting_slots(user_id, year, week): Slots a student is waiting for.
+- unqueue(user_id, year, week, slots_left): Takes a student off the waitlist of some slots.
+- after_commit(year, week, promoted): Updates the gate map and change log for promoted students.
+"""
+
+from datetime import date
+from sqlalchemy import delete, or_, select, update
+from . import db
+from . import slots
+from . import headcount
+from . import gate
+from . import events
+from .changelog import writer as changelog_writer
+from .models import Booking, Meal_Count, Waitlist
+
+
+def reserve(year, week, wanted):
+    """
+    Takes one seat in every wanted slot that still has one, with a conditional
+    update per slot. Does not commit.
+
+    Args:
+        year (int): ISO year.
+        week (int): ISO week number.
+        wanted (int): Slot bitmap to reserve.
+
+    Returns:
+        int: Bitmap of the slots reserved; the others are full.
+    """
+    if not wanted:
+        return 0
+    headcount.ensure_week(year, week)
+    granted = 0
+    for index in range(slots.SLOT_COUNT):
+        if wanted >> index & 1 and _take_seat(year, week, index):
+            granted |= 1 << index
+    return granted
+
+
+def _slot_filter(year, week, index):
+    """WHERE clauses selecting the Meal_Count row of one slot."""
+    meal, day = slots.SLOTS[index]
+    return Meal_Count.year == year, Meal_Count.week == week, Meal_Count.meal == meal, Meal_Count.day == day
+
+
+def _take_seat(year, week, index):
+    """Takes one seat in a slot if it has one free; True if it did."""
+    return bool(db.session.execute(
+        update(Meal_Count)
+        .where(*_slot_filter(year, week, index),
+               or_(Meal_Count.capacity.is_(None), Meal_Count.head_count < Meal_Count.capacity))
+        .values(head_count=Meal_Count.head_count + 1)
+    ).rowcount)
+
+
+def reserve_many(year, week, wanted):
+    """
+    Takes seats for many students at once, e.g. for the standing-order
+    rollover. A slot of unlimited capacity is counted for all of them with one
+    update; in a limited slot each seat is taken with the conditional update of
+    reserve(), in the order of `wanted`, until the slot is full. Slots that do
+    not fit are waitlisted. Does not commit.
+
+    Args:
+        year (int): ISO year.
+        week (int): ISO week number.
+        wanted (dict): Slot bitmap wanted by each user id, in the order seats are given.
+
+    Returns:
+        dict: (booked slots, waitlisted slots) by user id.
+    """
+    headcount.ensure_week(year, week)
+    headcount.touch(year, week)
+    booked = dict.fromkeys(wanted, 0)
+    for index in range(slots.SLOT_COUNT):
+        user_ids = [user_id for user_id, requested in wanted.items() if requested >> index & 1]
+        if not user_ids:
+            continue
+        unlimited = db.session.execute(
+            update(Meal_Count)
+            .where(*_slot_filter(year, week, index), Meal_Count.capacity.is_(None))
+            .values(head_count=Meal_Count.head_count + len(user_ids))
+        ).rowcount
+        for user_id in user_ids:
+            if not unlimited and not _take_seat(year, week, index):
+                break
+            booked[user_id] |= 1 << index
+
+    seated = {}
+    for user_id, requested in wanted.items():
+        waiting = requested & ~booked[user_id]
+        if waiting:
+            _queue(user_id, year, week, waiting)
+        seated[user_id] = (booked[user_id], waiting)
+    return seated
+
+
+def release(year, week, freed):
+    """
+    Gives back one seat in every freed slot. Does not commit.
+
+    Args:
+        year (int): ISO year.
+        week (int): ISO week number.
+        freed (int): Slot bitmap released.
+    """
+    headcount.apply_change(year, week, freed, 0)
+
+
+def waiting_slots(user_id, year, week):
+    """
+    Returns the slots a student is on the waitlist for.
+
+    Args:
+        user_id (int): Student.
+        year (int): ISO year.
+        week (int): ISO week number.
+
+    Returns:
+        int: Slot bitmap.
+    """
+    return slots.encode(slots.SLOTS[slot] for (slot,) in db.session.query(Waitlist.slot).filter(
+        Waitlist.user_waitlist_fk == user_id, Waitlist.year == year, Waitlist.week == week))
+
+
+def unqueue(user_id, year, week, slots_left):
+    """
+    Takes a student off the waitlist of some slots. Does not commit.
+
+    Args:
+        user_id (int): Student.
+        year (int): ISO year.
+        week (int): ISO week number.
+        slots_left (int): Slot bitmap the student no longer waits for.
+    """
+    dropped = [index for index in range(slots.SLOT_COUNT) if slots_left >> index & 1]
+    if dropped:
+        db.session.execute(delete(Waitlist).where(Waitlist.user_waitlist_fk == user_id, Waitlist.year == year,
+                                                  Waitlist.week == week, Waitlist.slot.in_(dropped)))
+
+
+def _queue(user_id, year, week, waiting):
+    """Leaves the student queued for exactly the waiting slots, keeping their place in existing queues."""
+    queued = waiting_slots(user_id, year, week)
+    unqueue(user_id, year, week, queued & ~waiting)
+    joined = [{'user_waitlist_fk': user_id, 'year': year, 'week': week, 'slot': index}
+              for index in range(slots.SLOT_COUNT) if (waiting & ~queued) >> index & 1]
+    if joined:
+        db.session.execute(Waitlist.__table__.insert(), joined)
+
+
+def promote(year, week, freed):
+    """
+    Gives the seats of freed slots to the students who have waited longest,
+    adding each slot to the student's booking. Weeks that have already started
+    are left alone. Does not commit.
+
+    Args:
+        year (int): ISO year.
+        week (int): ISO week number.
+        freed (int): Bitmap of slots where seats may have come free.
+
+    Returns:
+        list: (user_id, booking_id, old_slots, new_slots) per promotion, for after_commit().
+    """
+    promoted = []
+    if not freed or (year, week) < tuple(date.today().isocalendar()[:2]):
+        return promoted
+    for index in range(slots.SLOT_COUNT):
+        if not freed >> index & 1:
+            continue
+        while True:
+            entry = db.session.execute(
+                select(Waitlist.waitlist_id, Waitlist.user_waitlist_fk)
+                .where(Waitlist.year == year, Waitlist.week == week, Waitlist.slot == index)
+                .order_by(Waitlist.waitlist_id).limit(1)
+            ).first()
+            if entry is None or not reserve(year, week, 1 << index):
+                break
+            waitlist_id, user_id = entry
+            if not db.session.execute(delete(Waitlist).where(Waitlist.waitlist_id == waitlist_id)).rowcount:
+                # A concurrent transaction promoted this student first
+                release(year, week, 1 << index)
+                continue
+
+            booking = Booking.query.filter(Booking.user_booking_id_fk == user_id, Booking.year == year,
+                                           Booking.week == week).first()
+            if booking is None:
+                booking = Booking(user_booking_id_fk=user_id, year=year, week=week, meal_slots=0, status='confirmed')
+                db.session.add(booking)
+                db.session.flush()
+            old_slots = booking.meal_slots
+            booking.meal_slots = old_slots | 1 << index
+            promoted.append((user_id, booking.booking_id, old_slots, booking.meal_slots))
+    if promoted:
+        headcount.touch(year, week)
+    return promoted
+
+
+def change(user_id, year, week, old_slots, requested):
+    """
+    Applies a student's booking change to the seats and the waitlist: seats of
+    dropped slots are released and offered to waiting students, new slots are
+    reserved if free and waitlisted otherwise. The caller stores the returned
+    slots on the booking and commits. Does not commit.
+
+    Args:
+        user_id (int): Student changing their booking.
+        year (int): ISO year of the booking.
+        week (int): ISO week of the booking.
+        old_slots (int): Slots the booking holds, 0 for a new booking.
+        requested (int): Slots the student asked for.
+
+    Returns:
+        tuple: (booked slots, waitlisted slots, promotions for after_commit()).
+    """
+    old_slots = old_slots or 0
+    headcount.touch(year, week)
+    removed = old_slots & ~requested
+    release(year, week, removed)
+    booked = (old_slots & requested) | reserve(year, week, requested & ~old_slots)
+    waiting = requested & ~booked
+    _queue(user_id, year, week, waiting)
+    return booked, waiting, promote(year, week, removed)
+
+
+def set_capacity(year, week, meal, day, capacity):
+    """
+    Changes the capacity of one slot of a week, seating waiting students if
+    it grew. Does not commit.
+
+    Args:
+        year (int): ISO year.
+        week (int): ISO week number.
+        meal (str): Meal name.
+        day (str): Day name.
+        capacity (int): Seats, or None for unlimited.
+
+    Returns:
+        list: Promotions for after_commit().
+
+    Raises:
+        ValueError: If the slot does not exist.
+    """
+    index = slots.SLOT_INDEX.get((meal, day))
+    if index is None:
+        raise ValueError(f'No {meal} is served on {day}')
+    headcount.ensure_week(year, week)
+    db.session.execute(
+        update(Meal_Count)
+        .where(Meal_Count.year == year, Meal_Count.week == week, Meal_Count.meal == meal, Meal_Count.day == day)
+        .values(capacity=capacity)
+    )
+    return promote(year, week, 1 << index)
+
+
+def after_commit(year, week, promoted):
+    """
+    Records promotions in the gate map, the booking change log and the live
+    event stream once their transaction has committed.
+
+    Args:
+        year (int): ISO year.
+        week (int): ISO week number.
+        promoted (list): Promotions returned by promote(), change() or set_capacity().
+    """
+    for user_id, booking_id, old_slots, new_slots in promoted:
+        gate.entitlements.update_user(user_id, year, week, new_slots)
+        changelog_writer.record(booking_id, user_id, old_slots, new_slots)
+        events.booking_changed(year, week, user_id, booking_id, old_slots, new_slots)
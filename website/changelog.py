@@ -0,0 +1,176 @@
+"""
+Append-only booking change log.
+
+Every change to a booking is recorded in `Booking_Modification_Log` as a
+compact diff: the bitmap of meal slots added and the bitmap of slots removed
+(see slots.py). Diffs are queued in memory by `ModificationLogWriter` and
+written with one bulk insert per batch, on a connection of their own after the
+booking itself has committed, so logging never lengthens the booking
+transaction. A batch is written once CHANGELOG_BATCH_SIZE diffs are queued,
+from a timer thread once the oldest queued diff is CHANGELOG_FLUSH_SECONDS old
+(even if no other booking changes), and when the process exits; diffs still
+queued when a process is killed are lost.
+
+A booking's state at any moment is rebuilt backwards from its current slots by
+undoing the diffs logged after that moment. Bookings written before the log
+existed have no creation entry, so before their first logged change they show
+their original choices.
+
+Configuration (app.config):
+- CHANGELOG_BATCH_SIZE: Diffs per bulk insert (default 50).
+- CHANGELOG_FLUSH_SECONDS: Maximum age of a queued diff (default 5).
+
+Classes:
+- ModificationLogWriter: Buffered, batched writer of log rows.
+
+Functions:
+- history(booking_id): Logged diffs of a booking in order.
+- state_at(booking_id, when): Slots a booking held at a moment.
+"""
+
+import atexit
+from datetime import datetime
+from threading import Lock, Timer
+from flask import current_app
+from . import db
+from . import tenants
+from .models import Booking, Booking_Modification_Log
+
+
+class ModificationLogWriter:
+    """Queues booking diffs and writes them to the log in batches."""
+
+    def __init__(self):
+        self._lock = Lock()
+        self._pending = []
+        self._timer = None
+        self._app = None
+        self._tenant = None
+        atexit.register(self.flush)
+
+    def record(self, booking_id, user_id, old_slots, new_slots, when=None):
+        """
+        Queues the diff between two states of a booking. Call it after the
+        booking change has committed. Must be called inside an application context.
+
+        Args:
+            booking_id (int): Booking changed.
+            user_id (int): User who made the change.
+            old_slots (int): Slot bitmap before the change, 0 for a new booking.
+            new_slots (int): Slot bitmap after the change.
+            when (datetime, optional): Time of the change, defaults to now.
+
+        Returns:
+            bool: False if the change left the slots unchanged and nothing was queued.
+        """
+        added, removed = new_slots & ~old_slots, old_slots & ~new_slots
+        if not (added or removed):
+            return False
+        app = current_app._get_current_object()
+        with self._lock:
+            self._app, self._tenant = app, tenants.current()
+            self._pending.append({
+                'log_booking_fk': booking_id,
+                'log_user_id_fk': user_id,
+                'modification_date': when or datetime.now(),
+                'slots_added': added,
+                'slots_removed': removed,
+            })
+            due = len(self._pending) >= app.config.get('CHANGELOG_BATCH_SIZE', 50)
+            self._schedule(app)
+        if due:
+            self.flush()
+        return True
+
+    def flush(self):
+        """
+        Writes every queued diff in one bulk insert. On failure the diffs are
+        queued again for the next flush and the error is logged.
+
+        Returns:
+            int: Number of log rows written.
+        """
+        with self._lock:
+            rows, app, tenant = self._pending, self._app, self._tenant
+            self._pending = []
+        if not rows:
+            return 0
+        with app.app_context():
+            try:
+                with tenants.engine(tenant).begin() as connection:
+                    connection.execute(Booking_Modification_Log.__table__.insert(), rows)
+            except Exception:
+                app.logger.exception('Writing %d booking log rows failed, will retry', len(rows))
+                with self._lock:
+                    self._pending[:0] = rows
+                    self._schedule(app)
+                return 0
+        return len(rows)
+
+    def _schedule(self, app):
+        """Starts the timer flushing the queue in CHANGELOG_FLUSH_SECONDS, unless one is running. Hold the lock."""
+        if self._timer is None:
+            self._timer = Timer(app.config.get('CHANGELOG_FLUSH_SECONDS', 5), self._flush_on_timer)
+            self._timer.daemon = True
+            self._timer.start()
+
+    def _flush_on_timer(self):
+        """Writes the diffs queued since the timer started."""
+        with self._lock:
+            self._timer = None
+        self.flush()
+
+    def pending(self):
+        """Number of diffs waiting to be written."""
+        with self._lock:
+            return len(self._pending)
+
+
+# Process-wide writers used by the views, one per tenant
+writer = tenants.PerTenant(ModificationLogWriter)
+
+
+def history(booking_id):
+    """
+    Lists the logged diffs of a booking, oldest first, including diffs still
+    queued in this process.
+
+    Args:
+        booking_id (int): Booking ID.
+
+    Returns:
+        list: Booking_Modification_Log rows ordered by date.
+    """
+    writer.flush()
+    return (Booking_Modification_Log.query
+            .filter(Booking_Modification_Log.log_booking_fk == booking_id)
+            .order_by(Booking_Modification_Log.modification_date, Booking_Modification_Log.log_entry_id)
+            .all())
+
+
+def state_at(booking_id, when):
+    """
+    Rebuilds the slots a booking held at a moment by undoing, newest first, the
+    diffs logged after it.
+
+    Args:
+        booking_id (int): Booking ID.
+        when (datetime): Moment to rebuild.
+
+    Returns:
+        int: Slot bitmap at that moment, 0 if the booking was created later,
+            or None if the booking does not exist.
+    """
+    writer.flush()
+    booking = db.session.get(Booking, booking_id)
+    if booking is None:
+        return None
+    state = booking.meal_slots
+    later = (db.session.query(Booking_Modification_Log.slots_added, Booking_Modification_Log.slots_removed)
+             .filter(Booking_Modification_Log.log_booking_fk == booking_id,
+                     Booking_Modification_Log.modification_date > when)
+             .order_by(Booking_Modification_Log.modification_date.desc(),
+                       Booking_Modification_Log.log_entry_id.desc()))
+    for added, removed in later:
+        state = (state & ~added) | removed
+    return state
@@ -0,0 +1,301 @@
+"""
+Flask CLI commands for operating the academy database.
+
+Commands are registered on the app by `create_app()` and run with the Flask CLI,
+for example:
+
+    flask --app main migrate
+
+Every command but `migrate` and `tenant-report` works on one tenant's database
+(see tenants.py): the default tenant, or the one named by `--tenant` or the
+SAMAM_TENANT environment variable.
+
+Commands:
+- migrate: Creates missing tables and applies pending schema migrations, for every tenant.
+- rebuild-meal-counts: Recomputes the kitchen head-counts from Booking.
+- export-gate-snapshot: Writes next week's entitlement snapshot for offline gates.
+- upload-gate-journal: Bulk uploads an offline gate's admission journal.
+- import-users: Bulk imports user profiles from a CSV or JSONL file.
+- rollover-bookings: Repeats last week's bookings for students with a standing order.
+- schedule-reminders: Creates the booking and meal reminders for a week.
+- run-reminders: Delivers reminders as they fall due until interrupted.
+- remove-users: Removes and archives accounts, e.g. a graduating cohort.
+- archive-weeks: Moves closed weeks' bookings into the per-term archive files.
+- set-capacity: Sets the seats of one meal of a week and seats waiting students.
+- tenant-report: Prints a week's bookings and head-counts of every tenant, queried in parallel.
+"""
+
+from functools import wraps
+import click
+from flask.cli import with_appcontext
+
+
+def tenant_option(command):
+    """Adds --tenant to a command and runs it against that tenant's database."""
+    @click.option('--tenant', default=None, envvar='SAMAM_TENANT',
+                  help='Tenant whose database to use, defaults to the default tenant.')
+    @wraps(command)
+    def wrapper(*args, tenant=None, **kwargs):
+        from .tenants import default, names, using
+
+        if tenant and tenant not in names():
+            raise click.BadParameter(f'expected one of {", ".join(names())}', param_hint='--tenant')
+        with using(tenant or default()):
+            return command(*args, **kwargs)
+    return wrapper
+
+
+@click.command('migrate')
+@click.option('--tenant', default=None, help='Only migrate this tenant\'s database.')
+@with_appcontext
+def migrate_command(tenant):
+    """Create missing tables and apply pending schema migrations."""
+    from .migrations import upgrade
+    from .tenants import names, using
+
+    if tenant and tenant not in names():
+        raise click.BadParameter(f'expected one of {", ".join(names())}', param_hint='--tenant')
+    for name in [tenant] if tenant else names():
+        with using(name):
+            applied = upgrade()
+        for migration_name in applied:
+            click.echo(f'{name}: applied {migration_name}')
+        click.echo(f'{name}: database is up to date ({len(applied)} migration(s) applied).')
+
+
+@click.command('rebuild-meal-counts')
+@click.option('--year', type=int, default=None, help='ISO year of --week, defaults to the current one.')
+@click.option('--week', type=int, default=None, help='Only rebuild this ISO week.')
+@click.option('--check', is_flag=True, help='Report differences without writing them.')
+@with_appcontext
+@tenant_option
+def rebuild_meal_counts_command(year, week, check):
+    """Recompute Meal_Count from Booking and report any drift."""
+    from .headcount import rebuild
+
+    mismatches = rebuild(year=year, week=week, check_only=check)
+    for mismatch_year, mismatch_week, meal, day, stored, live in mismatches:
+        click.echo(f'Week {mismatch_week} of {mismatch_year} {meal} {day}: stored {stored}, live {live}')
+    if not mismatches:
+        click.echo('Meal counts match the bookings.')
+    elif check:
+        raise SystemExit(1)
+    else:
+        click.echo(f'Corrected {len(mismatches)} meal count(s).')
+
+
+@click.command('export-gate-snapshot')
+@click.argument('path')
+@click.option('--year', type=int, default=None, help='ISO year of the week, defaults to next week\'s.')
+@click.option('--week', type=int, default=None, help='ISO week to export, defaults to next week.')
+@with_appcontext
+@tenant_option
+def export_gate_snapshot_command(path, year, week):
+    """Write the entitlement snapshot read by offline gates."""
+    from .gate_offline import export_snapshot
+    from .views import get_booking_week
+
+    next_year, next_week = get_booking_week()
+    year, week = year or next_year, week or next_week
+    count = export_snapshot(path, year, week)
+    click.echo(f'Wrote {count} card(s) for week {week} of {year} to {path}')
+
+
+@click.command('upload-gate-journal')
+@click.argument('path')
+@with_appcontext
+@tenant_option
+def upload_gate_journal_command(path):
+    """Bulk insert an offline gate's admission journal into the database."""
+    from .gate_offline import upload_journal
+
+    inserted, skipped = upload_journal(path)
+    click.echo(f'Uploaded {inserted} admission(s), skipped {skipped} already on record.')
+
+
+@click.command('import-users')
+@click.argument('file', type=click.File('rb'))
+@click.option('--chunk-size', type=int, default=1000, show_default=True, help='Rows per transaction.')
+@with_appcontext
+@tenant_option
+def import_users_command(file, chunk_size):
+    """Bulk import user profiles from a CSV or JSONL file."""
+    from .provisioning import read_rows, import_users
+
+    report = import_users(read_rows(file, file.name), chunk_size=chunk_size)
+    for line_number, email, error in report['errors']:
+        click.echo(f'Line {line_number} ({email or "-"}): {error}', err=True)
+    click.echo(f"Imported {report['created']} of {report['rows']} profile(s) in {report['seconds']:.2f}s.")
+
+
+@click.command('rollover-bookings')
+@click.option('--year', type=int, default=None, help='ISO year of the week, defaults to next week\'s.')
+@click.option('--week', type=int, default=None, help='ISO week to book, defaults to next week.')
+@click.option('--chunk-size', type=int, default=1000, show_default=True, help='Standing orders per transaction.')
+@with_appcontext
+@tenant_option
+def rollover_bookings_command(year, week, chunk_size):
+    """Book the coming week for every student with a standing order."""
+    from .rollover import rollover
+    from .views import get_booking_week
+
+    next_year, next_week = get_booking_week()
+    year, week = year or next_year, week or next_week
+
+    def progress(report):
+        click.echo(f"{report['orders']} order(s) examined, {report['created']} booking(s) created", err=True)
+
+    report = rollover(year, week, chunk_size=chunk_size, progress=progress)
+    click.echo(f"Week {week} of {year}: created {report['created']} booking(s), skipped {report['skipped']}, "
+               f"waitlisted {report['waitlisted']}, {report['seconds']:.2f}s ({report['rows_per_second']:.0f} rows/s).")
+
+
+@click.command('schedule-reminders')
+@click.option('--year', type=int, default=None, help='ISO year of the week, defaults to next week\'s.')
+@click.option('--week', type=int, default=None, help='ISO week to remind about, defaults to next week.')
+@with_appcontext
+@tenant_option
+def schedule_reminders_command(year, week):
+    """Create the booking reminders and meal reminders for a week."""
+    from .reminders import schedule_week
+    from .views import get_booking_week
+
+    next_year, next_week = get_booking_week()
+    year, week = year or next_year, week or next_week
+
+    created = schedule_week(week, year)
+    click.echo(f'Week {week} of {year}: {created["book_next_week"]} booking reminder(s), '
+               f'{created["meal_soon"]} meal reminder(s) scheduled.')
+
+
+@click.command('run-reminders')
+@with_appcontext
+@tenant_option
+def run_reminders_command():
+    """Deliver reminders as they fall due, until interrupted."""
+    from flask import current_app
+    from .reminders import ReminderScheduler
+
+    scheduler = ReminderScheduler(current_app._get_current_object())
+    click.echo('Delivering reminders, press Ctrl+C to stop.')
+    try:
+        scheduler.run()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        scheduler.stop()
+        click.echo(f'Sent {scheduler.sent} reminder(s), {scheduler.failed} failed.')
+
+
+@click.command('remove-users')
+@click.option('--id', 'user_ids', type=int, multiple=True, help='User ID to remove (repeatable).')
+@click.option('--ids-file', type=click.File('r'), default=None, help='File with one user ID per line.')
+@click.option('--role', default=None, help='Only users with this role.')
+@click.option('--email-like', default=None, help="SQL LIKE pattern on the email, e.g. '%@class2024.test'.")
+@click.option('--no-archive', is_flag=True, help='Delete without copying rows to the archive tables.')
+@click.option('--chunk-size', type=int, default=500, show_default=True, help='Users per transaction.')
+@click.option('--dry-run', is_flag=True, help='Only count the matching users.')
+@with_appcontext
+@tenant_option
+def remove_users_command(user_ids, ids_file, role, email_like, no_archive, chunk_size, dry_run):
+    """Remove accounts with their bookings, cards, reminders and logs."""
+    from .deletion import remove_users, select_users
+
+    ids = set(user_ids)
+    if ids_file:
+        ids.update(int(line) for line in ids_file if line.strip())
+    if not (ids or role or email_like):
+        raise click.UsageError('Give --id, --ids-file, --role or --email-like.')
+
+    matching = select_users(role=role, email_like=email_like, user_ids=ids or None)
+    click.echo(f'{len(matching)} user(s) match.')
+    if dry_run or not matching:
+        return
+
+    def progress(done, total, seconds):
+        click.echo(f'{done}/{total} users removed ({seconds:.1f}s)')
+
+    report = remove_users(matching, archive=not no_archive, chunk_size=chunk_size, progress=progress)
+    for table, count in report['rows'].items():
+        click.echo(f'{table}: {count} row(s)')
+    click.echo(f"Removed {report['users']} user(s) in {report['seconds']:.2f}s.")
+
+
+@click.command('archive-weeks')
+@click.option('--chunk-size', type=int, default=5000, show_default=True, help='Rows read from the database at a time.')
+@with_appcontext
+@tenant_option
+def archive_weeks_command(chunk_size):
+    """Move every week before the current one into its term's archive file."""
+    from .week_archive import archive_closed_weeks, term_path
+
+    def progress(year, week, moved):
+        click.echo(f'Week {week} of {year}: {moved} booking(s) moved to {term_path(year, week)}', err=True)
+
+    report = archive_closed_weeks(chunk_size=chunk_size, progress=progress)
+    click.echo(f"Archived {len(report['weeks'])} week(s) in {report['seconds']:.2f}s.")
+
+
+@click.command('set-capacity')
+@click.option('--year', type=int, default=None, help='ISO year of the week, defaults to next week\'s.')
+@click.option('--week', type=int, default=None, help='ISO week, defaults to next week.')
+@click.option('--meal', required=True, help='Meal, e.g. supper.')
+@click.option('--day', required=True, help='Day, e.g. friday.')
+@click.option('--capacity', type=int, default=None, help='Seats; omit for unlimited.')
+@with_appcontext
+@tenant_option
+def set_capacity_command(year, week, meal, day, capacity):
+    """Set the seats of one meal of a week and give freed seats to waiting students."""
+    from . import db
+    from .capacity import after_commit, set_capacity
+    from .views import get_booking_week
+
+    next_year, next_week = get_booking_week()
+    year, week = year or next_year, week or next_week
+    try:
+        promoted = set_capacity(year, week, meal.lower(), day.lower(), capacity)
+    except ValueError as error:
+        raise click.BadParameter(str(error))
+    db.session.commit()
+    after_commit(year, week, promoted)
+    seats = 'unlimited' if capacity is None else capacity
+    click.echo(f'{meal} on {day}, week {week} of {year}: {seats} seat(s), {len(promoted)} waiting student(s) booked.')
+
+
+@click.command('tenant-report')
+@click.option('--year', type=int, default=None, help='ISO year of the week, defaults to next week\'s.')
+@click.option('--week', type=int, default=None, help='ISO week to report, defaults to next week.')
+@with_appcontext
+def tenant_report_command(year, week):
+    """Print a week's bookings and head-counts of every tenant, queried in parallel."""
+    from .headcount import tenant_totals
+    from .views import get_booking_week
+
+    next_year, next_week = get_booking_week()
+    year, week = year or next_year, week or next_week
+    report = tenant_totals(year, week)
+    click.echo(f'Week {week} of {year}, {len(report["tenants"])} tenant(s) in {report["seconds"]:.2f}s')
+    click.echo(f'{"tenant":<20} {"bookings":>9} {"meals":>9}')
+    for name, totals in [*report['tenants'].items(), ('total', report['total'])]:
+        click.echo(f'{name:<20} {totals["bookings"]:>9} {sum(totals["meals"]):>9}')
+
+
+def register_commands(app):
+    """
+    Registers the CLI commands on the Flask app.
+
+    Args:
+        app (Flask): Flask application.
+    """
+    app.cli.add_command(migrate_command)
+    app.cli.add_command(rebuild_meal_counts_command)
+    app.cli.add_command(export_gate_snapshot_command)
+    app.cli.add_command(upload_gate_journal_command)
+    app.cli.add_command(import_users_command)
+    app.cli.add_command(rollover_bookings_command)
+    app.cli.add_command(schedule_reminders_command)
+    app.cli.add_command(run_reminders_command)
+    app.cli.add_command(remove_users_command)
+    app.cli.add_command(archive_weeks_command)
+    app.cli.add_command(set_capacity_command)
+    app.cli.add_command(tenant_report_command)
@@ -0,0 +1,216 @@
+"""
+Configuration profiles for the academy app.
+
+`create_app()` loads one of the profiles below, chosen by its `config_name`
+argument or the SAMAM_CONFIG environment variable (default 'development').
+Deployment-specific values come from the environment:
+
+- SECRET_KEY: Session signing key (required in production: create_app()
+  raises ValueError if it is not set).
+- DATABASE_URL: SQLAlchemy database URI (default sqlite:///academy.db in the
+  instance folder).
+- DB_POOL_SIZE, DB_MAX_OVERFLOW, DB_POOL_TIMEOUT, DB_POOL_RECYCLE: Connection
+  pool sizing and timeouts (seconds).
+- DB_BUSY_TIMEOUT: Milliseconds a SQLite connection waits for a write lock
+  before raising "database is locked" (default 15000).
+- PASSWORD_HASH_METHOD, PASSWORD_SCRYPT_COST, PASSWORD_PBKDF2_ITERATIONS,
+  PASSWORD_WORKERS: See passwords.py.
+- USER_CACHE_SIZE, USER_CACHE_TTL, MENU_CACHE_SIZE, MENU_CACHE_TTL,
+  GATE_CACHE_TTL: See user_cache.py, menu_cache.py and gate.py.
+- CHANGELOG_BATCH_SIZE, CHANGELOG_FLUSH_SECONDS: See changelog.py.
+- REMINDER_SENDER, REMINDER_FILE, SMTP_HOST, SMTP_PORT, SMTP_USERNAME,
+  SMTP_PASSWORD, MAIL_FROM, REMINDER_WORKERS, REMINDER_HORIZON,
+  REMINDER_MEAL_LEAD: See reminders.py.
+- ARCHIVE_DIR, ARCHIVE_TERM_WEEKS: See week_archive.py.
+- ADMISSION_BATCH_SIZE, ADMISSION_FLUSH_SECONDS, ADMISSION_QUEUE_LIMIT: See gate.py.
+- GATE_CHECK_WINDOW: Seconds a swipe sent to the gate API may be from the
+  server's clock (default 300); see api.py.
+- MEAL_CAPACITY: Default seats per meal slot for new weeks (unlimited if
+  unset); see capacity.py.
+- FORECAST_HALF_LIFE, FORECAST_CACHE_SIZE, FORECAST_CACHE_TTL: See forecast.py.
+- EVENT_KEEPALIVE_SECONDS, EVENT_RESYNC_SECONDS, EVENT_HISTORY, EVENT_MAX_STREAMS,
+  EVENT_STREAM_SECONDS: See events.py.
+- TENANT_DATABASES (JSON object of tenant name to database URI), DEFAULT_TENANT,
+  TENANT_WORKERS: See tenants.py.
+- INSTRUMENTATION ('1' to enable), SLOW_REQUEST_MS, SLOW_REQUEST_LOG,
+  N_PLUS_ONE_THRESHOLD, METRICS_TOKEN: See instrumentation.py.
+
+SQLite connections are opened in WAL mode with a busy timeout and tuned pragmas
+(see `sqlite_pragmas()`), so readers never block the writer and concurrent
+booking writes queue instead of failing.
+
+Classes:
+- Config: Settings shared by every profile.
+- DevelopmentConfig, ProductionConfig, TestingConfig: Profiles.
+
+Functions:
+- engine_options(config, uri=None): SQLAlchemy engine options for a loaded config.
+- sqlite_pragmas(busy_timeout): Connect hook that tunes SQLite connections.
+"""
+
+import json
+import os
+
+
+def _env_int(name, default):
+    """Reads an integer from the environment."""
+    value = os.environ.get(name)
+    return int(value) if value else default
+
+
+def _env_json(name, default):
+    """Reads a JSON value from the environment."""
+    value = os.environ.get(name)
+    return json.loads(value) if value else default
+
+
+class Config:
+    """Settings shared by every profile."""
+
+    SECRET_KEY = os.environ.get('SECRET_KEY', 'owenvwvibwecnaxcdibvccan')
+    SQLALCHEMY_DATABASE_URI = os.environ.get('DATABASE_URL', 'sqlite:///academy.db')
+
+    DB_POOL_SIZE = _env_int('DB_POOL_SIZE', 10)
+    DB_MAX_OVERFLOW = _env_int('DB_MAX_OVERFLOW', 20)
+    DB_POOL_TIMEOUT = _env_int('DB_POOL_TIMEOUT', 30)
+    DB_POOL_RECYCLE = _env_int('DB_POOL_RECYCLE', 3600)
+    DB_BUSY_TIMEOUT = _env_int('DB_BUSY_TIMEOUT', 15000)
+
+    PASSWORD_HASH_METHOD = os.environ.get('PASSWORD_HASH_METHOD', 'scrypt')
+    PASSWORD_SCRYPT_COST = _env_int('PASSWORD_SCRYPT_COST', None)
+    PASSWORD_PBKDF2_ITERATIONS = _env_int('PASSWORD_PBKDF2_ITERATIONS', None)
+    PASSWORD_WORKERS = _env_int('PASSWORD_WORKERS', None)
+
+    USER_CACHE_SIZE = _env_int('USER_CACHE_SIZE', 10000)
+    USER_CACHE_TTL = _env_int('USER_CACHE_TTL', 60)
+    MENU_CACHE_SIZE = _env_int('MENU_CACHE_SIZE', 64)
+    MENU_CACHE_TTL = _env_int('MENU_CACHE_TTL', 300)
+    GATE_CACHE_TTL = _env_int('GATE_CACHE_TTL', 300)
+
+    CHANGELOG_BATCH_SIZE = _env_int('CHANGELOG_BATCH_SIZE', 50)
+    CHANGELOG_FLUSH_SECONDS = _env_int('CHANGELOG_FLUSH_SECONDS', 5)
+
+    REMINDER_SENDER = os.environ.get('REMINDER_SENDER', 'file')
+    REMINDER_FILE = os.environ.get('REMINDER_FILE')
+    SMTP_HOST = os.environ.get('SMTP_HOST', 'localhost')
+    SMTP_PORT = _env_int('SMTP_PORT', 587)
+    SMTP_USERNAME = os.environ.get('SMTP_USERNAME')
+    SMTP_PASSWORD = os.environ.get('SMTP_PASSWORD')
+    SMTP_STARTTLS = os.environ.get('SMTP_STARTTLS', '1') == '1'
+    MAIL_FROM = os.environ.get('MAIL_FROM', 'samam@localhost')
+    REMINDER_WORKERS = _env_int('REMINDER_WORKERS', 16)
+    REMINDER_BATCH_SIZE = _env_int('REMINDER_BATCH_SIZE', 100)
+    REMINDER_HORIZON = _env_int('REMINDER_HORIZON', 600)
+    REMINDER_MEAL_LEAD = _env_int('REMINDER_MEAL_LEAD', 30)
+    REMINDER_BOOKING_DAY = _env_int('REMINDER_BOOKING_DAY', 3)
+    REMINDER_BOOKING_HOUR = _env_int('REMINDER_BOOKING_HOUR', 12)
+
+    ARCHIVE_DIR = os.environ.get('ARCHIVE_DIR')
+    ARCHIVE_TERM_WEEKS = _env_int('ARCHIVE_TERM_WEEKS', 13)
+
+    MEAL_CAPACITY = _env_int('MEAL_CAPACITY', None)
+
+    ADMISSION_BATCH_SIZE = _env_int('ADMISSION_BATCH_SIZE', 100)
+    ADMISSION_FLUSH_SECONDS = _env_int('ADMISSION_FLUSH_SECONDS', 5)
+    ADMISSION_QUEUE_LIMIT = _env_int('ADMISSION_QUEUE_LIMIT', 10000)
+    GATE_CHECK_WINDOW = _env_int('GATE_CHECK_WINDOW', 300)
+
+    FORECAST_HALF_LIFE = _env_int('FORECAST_HALF_LIFE', 8)
+    FORECAST_CACHE_SIZE = _env_int('FORECAST_CACHE_SIZE', 16)
+    FORECAST_CACHE_TTL = _env_int('FORECAST_CACHE_TTL', 3600)
+
+    EVENT_KEEPALIVE_SECONDS = _env_int('EVENT_KEEPALIVE_SECONDS', 15)
+    EVENT_RESYNC_SECONDS = _env_int('EVENT_RESYNC_SECONDS', 300)
+    EVENT_HISTORY = _env_int('EVENT_HISTORY', 1000)
+    EVENT_MAX_STREAMS = _env_int('EVENT_MAX_STREAMS', 1)
+    EVENT_STREAM_SECONDS = _env_int('EVENT_STREAM_SECONDS', 300)
+
+    TENANT_DATABASES = _env_json('TENANT_DATABASES', {})
+    DEFAULT_TENANT = os.environ.get('DEFAULT_TENANT', 'default')
+    TENANT_WORKERS = _env_int('TENANT_WORKERS', 8)
+
+    INSTRUMENTATION = os.environ.get('INSTRUMENTATION', '0') == '1'
+    SLOW_REQUEST_MS = _env_int('SLOW_REQUEST_MS', 500)
+    SLOW_REQUEST_LOG = os.environ.get('SLOW_REQUEST_LOG')
+    N_PLUS_ONE_THRESHOLD = _env_int('N_PLUS_ONE_THRESHOLD', 5)
+    METRICS_TOKEN = os.environ.get('METRICS_TOKEN')
+
+
+class DevelopmentConfig(Config):
+    """Local development with the Flask debugger."""
+
+    DEBUG = True
+
+
+class ProductionConfig(Config):
+    """Multi-worker production deployment behind a WSGI server."""
+
+    DEBUG = False
+    # No fallback: create_app() refuses to start without a key from the environment
+    SECRET_KEY = os.environ.get('SECRET_KEY')
+    SESSION_COOKIE_SECURE = os.environ.get('SESSION_COOKIE_SECURE', '1') == '1'
+
+
+class TestingConfig(Config):
+    """Automated tests and benchmarks against a scratch database."""
+
+    TESTING = True
+    SQLALCHEMY_DATABASE_URI = os.environ.get('TEST_DATABASE_URL', 'sqlite://')
+    PASSWORD_SCRYPT_COST = _env_int('PASSWORD_SCRYPT_COST', 10)
+    PASSWORD_PBKDF2_ITERATIONS = _env_int('PASSWORD_PBKDF2_ITERATIONS', 100000)
+
+
+CONFIGS = {
+    'development': DevelopmentConfig,
+    'production': ProductionConfig,
+    'testing': TestingConfig,
+}
+
+
+def engine_options(config, uri=None):
+    """
+    Builds the SQLAlchemy engine options for a loaded config.
+
+    Args:
+        config (Config): Flask app.config.
+        uri (str, optional): Database URI, SQLALCHEMY_DATABASE_URI if omitted (e.g. a tenant's database).
+
+    Returns:
+        dict: Value for SQLALCHEMY_ENGINE_OPTIONS.
+    """
+    uri = uri or config['SQLALCHEMY_DATABASE_URI']
+    if uri in ('sqlite://', 'sqlite:///:memory:'):
+        # In-memory databases live in a single shared connection
+        return {}
+    options = {
+        'pool_size': config['DB_POOL_SIZE'],
+        'max_overflow': config['DB_MAX_OVERFLOW'],
+        'pool_timeout': config['DB_POOL_TIMEOUT'],
+        'pool_recycle': config['DB_POOL_RECYCLE'],
+    }
+    if uri.startswith('sqlite'):
+        options['connect_args'] = {'timeout': config['DB_BUSY_TIMEOUT'] / 1000}
+    else:
+        options['pool_pre_ping'] = True
+    return options
+
+
+def sqlite_pragmas(busy_timeout):
+    """
+    Builds the connect hook that tunes every new SQLite connection.
+
+    Args:
+        busy_timeout (int): Milliseconds to wait for a lock.
+
+    Returns:
+        function: Listener for the engine 'connect' event.
+    """
+    def set_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        cursor.execute('PRAGMA journal_mode=WAL')
+        cursor.execute(f'PRAGMA busy_timeout={int(busy_timeout)}')
+        cursor.execute('PRAGMA synchronous=NORMAL')
+        cursor.execute('PRAGMA temp_store=MEMORY')
+        cursor.execute('PRAGMA cache_size=-20000')
+        cursor.close()
+    return set_pragmas
@@ -0,0 +1,147 @@
+"""
+Bulk removal of user accounts with their dependent rows.
+
+`remove_users()` removes a list of accounts, such as a graduating cohort chosen
+with `select_users()`, together with everything that references them:
+bookings, access cards, reminders, booking change logs, gate admissions,
+standing orders and waitlist entries. Each chunk of users is handled in one transaction with
+set-based statements, one `INSERT INTO archived_<table> SELECT ... WHERE ... IN`
+and one `DELETE ... WHERE ... IN` per table, so the cost grows with the number
+of chunks rather than the number of rows. The kitchen head-counts are reduced
+by the removed bookings in the same transaction, and the seats they free go to
+waiting students (see capacity.py).
+
+Archived copies keep every column except the password, plus the archive date
+(see `ARCHIVE_TABLES` in models.py); pass archive=False to delete outright.
+
+Functions:
+- select_users(role=None, email_like=None, user_ids=None): IDs of the users matching a filter.
+- remove_users(user_ids, archive=True, chunk_size=500, progress=None): Removes accounts in chunks.
+"""
+
+from datetime import datetime
+from time import perf_counter
+from sqlalchemy import func, insert, literal, null, or_, select
+from . import db
+from . import slots
+from . import headcount
+from . import gate
+from . import capacity
+from .changelog import writer as changelog_writer
+from .models import (ARCHIVE_TABLES, Access_Card, Admission, Booking, Booking_Modification_Log, Reminder,
+                     Standing_Order, User, Waitlist)
+from .user_cache import users as user_cache
+
+REMOVAL_CHUNK_SIZE = 500
+
+# Dependent tables and the column referencing the user, removed before the users themselves
+DEPENDENTS = (
+    (Booking_Modification_Log, Booking_Modification_Log.log_user_id_fk),
+    (Admission, Admission.admission_user_fk),
+    (Reminder, Reminder.user__reminder_fk),
+    (Access_Card, Access_Card.user_card_id_fk),
+    (Standing_Order, Standing_Order.user_standing_fk),
+    (Waitlist, Waitlist.user_waitlist_fk),
+    (Booking, Booking.user_booking_id_fk),
+    (User, User.user_id),
+)
+
+
+def select_users(role=None, email_like=None, user_ids=None):
+    """
+    Lists the IDs of the users matching every given filter.
+
+    Args:
+        role (str, optional): Only users with this role.
+        email_like (str, optional): SQL LIKE pattern on the email, e.g. '%@class2024.test'.
+        user_ids (iterable, optional): Only these user IDs.
+
+    Returns:
+        list: Matching user IDs in ascending order.
+    """
+    query = select(User.user_id).order_by(User.user_id)
+    if role:
+        query = query.where(User.role == role)
+    if email_like:
+        query = query.where(User.email.like(email_like))
+    if user_ids is not None:
+        query = query.where(User.user_id.in_(list(user_ids)))
+    return list(db.session.execute(query).scalars())
+
+
+def _condition(model, column, chunk):
+    """Rows of a table that belong to a chunk of users."""
+    if model is Booking_Modification_Log:
+        # Log rows written by the users, or about their bookings
+        own_bookings = select(Booking.booking_id).where(Booking.user_booking_id_fk.in_(chunk))
+        return or_(column.in_(chunk), Booking_Modification_Log.log_booking_fk.in_(own_bookings))
+    return column.in_(chunk)
+
+
+def _release_head_counts(chunk):
+    """Subtracts the chunk's bookings from the head-counts, one query per chunk, returning the freed slots per week."""
+    columns = [func.sum(Booking.meal_slots.op('>>')(index).op('&')(1)) for index in range(slots.SLOT_COUNT)]
+    rows = db.session.execute(
+        select(Booking.year, Booking.week, *columns).where(Booking.user_booking_id_fk.in_(chunk))
+        .group_by(Booking.year, Booking.week)
+    ).all()
+    freed = {}
+    for year, week, *totals in rows:
+        headcount.apply_totals(year, week, [-(total or 0) for total in totals])
+        headcount.touch(year, week)
+        freed[(year, week)] = sum(1 << index for index, total in enumerate(totals) if total)
+    return freed
+
+
+def remove_users(user_ids, archive=True, chunk_size=REMOVAL_CHUNK_SIZE, progress=None):
+    """
+    Removes users and every row that references them, a chunk of users per
+    transaction. Must be called inside an application context.
+
+    Args:
+        user_ids (iterable): IDs of the users to remove; unknown IDs are ignored.
+        archive (bool, optional): Copy the rows to the archive tables first.
+        chunk_size (int, optional): Users per transaction.
+        progress (callable, optional): Called after each chunk with
+            (users_done, users_total, seconds_elapsed).
+
+    Returns:
+        dict: 'users' removed, 'rows' removed per table and 'seconds' taken.
+    """
+    started = perf_counter()
+    user_ids = sorted(set(int(user_id) for user_id in user_ids))
+    rows = {model.__tablename__: 0 for model, _ in DEPENDENTS}
+
+    # Log rows still queued for these users' bookings must land before they are moved
+    changelog_writer.flush()
+
+    for start in range(0, len(user_ids), chunk_size):
+        chunk = user_ids[start:start + chunk_size]
+        archived_date = datetime.now()
+        freed = _release_head_counts(chunk)
+        for model, column in DEPENDENTS:
+            condition = _condition(model, column, chunk)
+            if archive:
+                table = model.__table__
+                archive_table = ARCHIVE_TABLES[model]
+                names = [column.name for column in table.columns]
+                values = [null() if model is User and name == 'password' else table.c[name] for name in names]
+                db.session.execute(insert(archive_table).from_select(
+                    names + ['archived_date'],
+                    select(*values, literal(archived_date, type_=archive_table.c.archived_date.type))
+                    .where(condition)
+                ))
+            rows[model.__tablename__] += db.session.execute(model.__table__.delete().where(condition)).rowcount
+        promoted = {key: capacity.promote(*key, mask) for key, mask in freed.items()}
+        db.session.commit()
+        for (year, week), week_promoted in promoted.items():
+            capacity.after_commit(year, week, week_promoted)
+
+        # Forget the removed users in this process's caches
+        gate.entitlements.forget_users(set(chunk))
+        for user_id in chunk:
+            user_cache.invalidate(user_id)
+        if progress:
+            progress(min(start + chunk_size, len(user_ids)), len(user_ids), perf_counter() - started)
+
+    return {'users': rows[User.__tablename__], 'rows': rows, 'seconds': perf_counter() - started}
@@ -0,0 +1,402 @@
+"""
+Live event stream of gate admissions and booking changes for dashboards.
+
+Booking changes (student(), modify(), the JSON API and waitlist promotions),
+gate admissions (the scan endpoint and API gate checks) and manual access
+checks are published to `bus`, an in-process pub/sub with one bus per tenant
+(see tenants.py), so a dashboard only sees its own tenant. Published events go into
+one shared ring buffer of the last EVENT_HISTORY events (default 1000) with
+consecutive IDs, so publishing costs the same for one dashboard as for
+hundreds: every subscriber reads the buffer from its own cursor. Idle
+subscribers block on a condition variable and only wake to send a keep-alive
+comment every EVENT_KEEPALIVE_SECONDS (default 15), so they cost no CPU
+between events.
+
+`stream()` formats the events as server-sent events for `/manager/events`. A
+new connection first gets a `snapshot` of the current week's booked and served
+counters per slot, then incremental events:
+
+- snapshot: {"year", "week", "slots", "booked", "served"}
+- booking: {"year", "week", "user_id", "booking_id", "added", "removed"} (slot bitmaps)
+- admission: {"year", "week", "user_id", "slot", "time"}
+- access: {"user_id", "granted", "time"}
+
+The counters (`counters`) are kept in this process from the same events, so
+connecting a dashboard runs no query. Each worker process has its own bus:
+changes made through another worker are picked up when the counters are
+reloaded from the database, at most every EVENT_RESYNC_SECONDS (default 300)
+and once for all of this process's subscribers, then sent as a new snapshot;
+so are bulk changes that publish no events (standing orders, account removal
+and the CLI).
+A client that reconnects with Last-Event-ID continues where it left off if the
+events are still in the buffer, and gets a snapshot otherwise.
+
+Each open stream holds one server thread, so a worker process serves at most
+EVENT_MAX_STREAMS streams at once (default 1) and leaves its other threads to
+ordinary requests; further dashboards are refused with 503 and fall back to
+polling `poll()` through `/manager/events.json` every few seconds, which reads
+the same buffer without holding a thread. A stream also ends after
+EVENT_STREAM_SECONDS (default 300) and the browser reconnects from
+Last-Event-ID, so a dashboard that was refused gets its turn later.
+
+Functions:
+- booking_changed(year, week, user_id, booking_id, old_slots, new_slots): Publishes a booking change.
+- admitted(user_id, year, week, slot, when): Publishes a gate admission.
+- access_checked(user_id, granted, when): Publishes a manual access check.
+- open_stream(): Takes one of this process's EVENT_MAX_STREAMS stream slots.
+- close_stream(): Gives a stream slot back.
+- stream(last_id=None): Server-sent events for one dashboard.
+- poll(after=None): The events after an ID, for dashboards that cannot stream.
+
+Classes:
+- EventBus: In-process pub/sub over a ring buffer of events.
+- LiveCounters: Booked and served counters of the current week.
+"""
+
+import json
+from collections import deque
+from datetime import date
+from itertools import islice
+from threading import Condition, Lock
+from time import monotonic
+from flask import current_app
+from sqlalchemy import func
+from . import db
+from . import slots
+from . import headcount
+from . import tenants
+
+
+class EventBus:
+    """In-process pub/sub delivering every event to every subscriber from one ring buffer."""
+
+    def __init__(self, history=1000):
+        # Reentrant, so LiveCounters can share it and update its counters atomically with publishing
+        self.lock = Condition()
+        self._events = deque(maxlen=history)
+        self._last_id = 0
+        self.subscribers = 0
+        self.published = 0
+
+    @property
+    def last_id(self):
+        """ID of the latest event published."""
+        with self.lock:
+            return self._last_id
+
+    def resize(self, history):
+        """
+        Changes how many events are kept for late or reconnecting subscribers.
+
+        Args:
+            history (int): Events kept.
+        """
+        with self.lock:
+            if history != self._events.maxlen:
+                self._events = deque(self._events, maxlen=history)
+
+    def publish(self, event_type, data):
+        """
+        Publishes an event to every subscriber.
+
+        Args:
+            event_type (str): Event name, e.g. 'booking'.
+            data (dict): JSON-serialisable payload.
+
+        Returns:
+            int: ID of the event.
+        """
+        with self.lock:
+            self._last_id += 1
+            self._events.append((self._last_id, event_type, data))
+            self.published += 1
+            self.lock.notify_all()
+            return self._last_id
+
+    def since(self, after):
+        """
+        Returns the events published after an event ID without waiting.
+
+        Args:
+            after (int): Last event ID already seen.
+
+        Returns:
+            list: (event_id, event_type, data) tuples in order, or None if some
+            of them have already left the buffer.
+        """
+        with self.lock:
+            if self._events and after + 1 < self._events[0][0]:
+                return None
+            if not self._events:
+                return []
+            return list(islice(self._events, max(after + 1 - self._events[0][0], 0), None))
+
+    def listen(self, after, timeout=15):
+        """
+        Yields the events published after an event ID, blocking while there are none.
+
+        Args:
+            after (int): Last event ID already seen.
+            timeout (float, optional): Seconds to wait before yielding an empty list, e.g. to send a keep-alive.
+
+        Yields:
+            list: (event_id, event_type, data) tuples in order, empty after an idle timeout. Yields
+            None and stops if events after the cursor have already left the buffer.
+        """
+        with self.lock:
+            self.subscribers += 1
+        cursor = after
+        try:
+            while True:
+                with self.lock:
+                    if self._last_id == cursor:
+                        self.lock.wait(timeout)
+                    # None if events were dropped from the buffer before this subscriber read them
+                    pending = self.since(cursor)
+                if pending is None:
+                    yield None
+                    return
+                if pending:
+                    cursor = pending[-1][0]
+                yield pending
+        finally:
+            with self.lock:
+                self.subscribers -= 1
+
+
+class LiveCounters:
+    """Booked and served counters per slot of the current week, kept from events."""
+
+    def __init__(self, bus):
+        self._bus = bus
+        self._reloading = Lock()
+        self._week = None
+        self._booked = [0] * slots.SLOT_COUNT
+        self._served = [0] * slots.SLOT_COUNT
+        self._loaded = None
+
+    def due(self):
+        """True if the counters are for another week or due a reload. Needs an application context."""
+        resync = current_app.config.get('EVENT_RESYNC_SECONDS', 300)
+        with self._bus.lock:
+            return (self._week != tuple(date.today().isocalendar()[:2])
+                    or self._loaded is None or monotonic() - self._loaded >= resync)
+
+    def reload(self):
+        """
+        Reloads the current week's counters from Meal_Count and Admission and
+        publishes them as a snapshot event. Only one reload runs at a time; the
+        others return straight away. Must be called inside an application context.
+        """
+        from .gate import admissions
+        from .models import Admission
+
+        if not self._reloading.acquire(blocking=False):
+            return
+        try:
+            # Admissions still queued in this process must be counted by the query
+            admissions.flush()
+            year, week = date.today().isocalendar()[:2]
+            booked = headcount.weekly_totals(year, week)
+            served = [0] * slots.SLOT_COUNT
+            for slot, count in db.session.query(Admission.slot, func.count(Admission.admission_id)).filter(
+                    Admission.year == year, Admission.week == week).group_by(Admission.slot):
+                if slot is not None and 0 <= slot < slots.SLOT_COUNT:
+                    served[slot] = count
+            db.session.close()
+            with self._bus.lock:
+                self._week, self._booked, self._served, self._loaded = (year, week), booked, served, monotonic()
+                self._bus.publish('snapshot', self.snapshot())
+        finally:
+            self._reloading.release()
+
+    def snapshot(self):
+        """
+        Returns the counters as they stand after the latest event published.
+
+        Returns:
+            dict: 'year', 'week', 'slots', 'booked' and 'served'.
+        """
+        with self._bus.lock:
+            year, week = self._week or (None, None)
+            return {'year': year, 'week': week, 'slots': [f'{meal}:{day}' for meal, day in slots.SLOTS],
+                    'booked': list(self._booked), 'served': list(self._served)}
+
+    def apply_booking(self, year, week, added, removed):
+        """Applies a booking change to the booked counters if it is for the current week."""
+        with self._bus.lock:
+            if (year, week) != self._week:
+                return
+            for index in range(slots.SLOT_COUNT):
+                self._booked[index] += (added >> index & 1) - (removed >> index & 1)
+
+    def apply_admission(self, year, week, slot):
+        """Counts an admission if it is for the current week."""
+        with self._bus.lock:
+            if (year, week) == self._week and 0 <= slot < slots.SLOT_COUNT:
+                self._served[slot] += 1
+
+
+# Process-wide event buses and counters behind /manager/events, one per tenant
+bus = tenants.PerTenant(EventBus)
+counters = tenants.PerTenant(lambda: LiveCounters(bus.of()))
+
+# Streams open in this process, across tenants, since each holds a server thread
+_streams_lock = Lock()
+_open_streams = 0
+
+
+def booking_changed(year, week, user_id, booking_id, old_slots, new_slots):
+    """
+    Publishes a committed booking change.
+
+    Args:
+        year (int): ISO year of the booking.
+        week (int): ISO week of the booking.
+        user_id (int): Student.
+        booking_id (int): Booking changed.
+        old_slots (int): Slots before the change.
+        new_slots (int): Slots after the change.
+    """
+    added, removed = new_slots & ~old_slots, old_slots & ~new_slots
+    if not added and not removed:
+        return
+    with bus.lock:
+        counters.apply_booking(year, week, added, removed)
+        bus.publish('booking', {'year': year, 'week': week, 'user_id': user_id, 'booking_id': booking_id,
+                                'added': added, 'removed': removed})
+
+
+def admitted(user_id, year, week, slot, when):
+    """
+    Publishes a gate admission.
+
+    Args:
+        user_id (int): Student admitted.
+        year (int): ISO year of the meal.
+        week (int): ISO week of the meal.
+        slot (int): Index of the meal slot in slots.SLOTS.
+        when (datetime): Time of the swipe.
+    """
+    with bus.lock:
+        counters.apply_admission(year, week, slot)
+        bus.publish('admission', {'year': year, 'week': week, 'user_id': user_id, 'slot': slot,
+                                  'time': when.isoformat(timespec='seconds')})
+
+
+def access_checked(user_id, granted, when):
+    """
+    Publishes a manual access check made on the access page.
+
+    Args:
+        user_id (str): Student ID entered on the access page.
+        granted (bool): Whether access was granted.
+        when (datetime): Time of the check.
+    """
+    bus.publish('access', {'user_id': user_id, 'granted': granted, 'time': when.isoformat(timespec='seconds')})
+
+
+def _message(event_type, data, event_id=None):
+    """Formats one server-sent event."""
+    head = f'id: {event_id}\n' if event_id is not None else ''
+    return f'{head}event: {event_type}\ndata: {json.dumps(data, separators=(",", ":"))}\n\n'
+
+
+def open_stream():
+    """
+    Takes a stream slot of this process if fewer than EVENT_MAX_STREAMS are
+    open. Must be called inside an application context, and paired with
+    close_stream() once the response is closed.
+
+    Returns:
+        bool: False if every slot is taken.
+    """
+    global _open_streams
+    with _streams_lock:
+        if _open_streams >= current_app.config.get('EVENT_MAX_STREAMS', 1):
+            return False
+        _open_streams += 1
+        return True
+
+
+def close_stream():
+    """Gives back a stream slot taken by open_stream()."""
+    global _open_streams
+    with _streams_lock:
+        _open_streams -= 1
+
+
+def _current_snapshot():
+    """Returns (event ID, snapshot) of the counters, reloading them first if due."""
+    if counters.due():
+        counters.reload()
+    # The snapshot counts exactly the events up to its ID
+    with bus.lock:
+        return bus.last_id, counters.snapshot()
+
+
+def stream(last_id=None):
+    """
+    Yields server-sent events for one dashboard: a snapshot unless it resumes
+    from Last-Event-ID, then every new event, until EVENT_STREAM_SECONDS have
+    passed. Must run inside an application context, e.g. with
+    stream_with_context().
+
+    Args:
+        last_id (int, optional): Last event ID the client received.
+
+    Yields:
+        str: Server-sent event messages and keep-alive comments.
+    """
+    config = current_app.config
+    bus.resize(config.get('EVENT_HISTORY', 1000))
+    keepalive = config.get('EVENT_KEEPALIVE_SECONDS', 15)
+    ends = monotonic() + config.get('EVENT_STREAM_SECONDS', 300)
+    yield 'retry: 3000\n\n'
+
+    while monotonic() < ends:
+        if last_id is None or last_id > bus.last_id:
+            last_id, snapshot = _current_snapshot()
+            yield _message('snapshot', snapshot, last_id)
+
+        for events in bus.listen(last_id, keepalive):
+            if monotonic() >= ends:
+                # The browser reconnects from the last event ID, freeing this thread meanwhile
+                return
+            if events is None:
+                # Fell behind the buffer; start again from a snapshot
+                last_id = None
+                break
+            if events:
+                last_id = events[-1][0]
+                yield ''.join(_message(event_type, data, event_id) for event_id, event_type, data in events)
+            elif counters.due():
+                # The reloaded counters reach every dashboard of this process as one snapshot event
+                counters.reload()
+            else:
+                yield ': keep-alive\n\n'
+
+
+def poll(after=None):
+    """
+    Returns the events published after an event ID, for a dashboard polling
+    /manager/events.json instead of streaming. Must be called inside an
+    application context.
+
+    Args:
+        after (int, optional): Last event ID the client received.
+
+    Returns:
+        dict: 'last_id' and 'events' ({"id", "type", "data"} each, a reload of
+        the counters arriving as a 'snapshot' event), or 'last_id' and a
+        'snapshot' of the counters if the client is new or fell behind the buffer.
+    """
+    bus.resize(current_app.config.get('EVENT_HISTORY', 1000))
+    if counters.due():
+        counters.reload()
+    pending = bus.since(after) if after is not None and after <= bus.last_id else None
+    if pending is None:
+        last_id, snapshot = _current_snapshot()
+        return {'last_id': last_id, 'snapshot': snapshot, 'events': []}
+    return {'last_id': pending[-1][0] if pending else after,
+            'events': [{'id': event_id, 'type': event_type, 'data': data} for event_id, event_type, data in pending]}
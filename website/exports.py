@@ -0,0 +1,264 @@
+"""
+Streaming exports of a week's bookings for the kitchen.
+
+Two sheets are produced for a week:
+
+- Kitchen: the head-count of every meal slot, read from Meal_Count.
+- Students: one row per booked student with their name, email, a 1 under
+  every booked slot and their number of meals.
+
+Closed weeks that have been moved out of the hot tables are read from their
+archive file instead (see week_archive.py).
+
+Bookings are read with `yield_per` chunked queries ordered by student, and the
+output is produced by generators, so a response streams while it is read and
+memory stays flat whatever the number of bookings. The spreadsheet is an
+Office Open XML workbook (.xlsx) written straight into a zip stream with the
+standard library, so no spreadsheet package is needed and the archive is never
+held in memory either.
+
+Names and emails are typed in by users, so a CSV text cell that a spreadsheet
+would read as a formula (starting with =, +, -, @, a tab or a carriage return)
+is written with a leading apostrophe. Workbook cells are inline strings, which
+spreadsheets never evaluate.
+
+Functions:
+- student_rows(year, week, chunk_size=1000): Yields one combined row per booked student.
+- kitchen_rows(year, week): Yields the head-count of every meal slot.
+- csv_stream(year, week, sheet='students', chunk_size=1000): Yields a sheet as CSV text.
+- xlsx_stream(year, week, chunk_size=1000): Yields both sheets as an .xlsx workbook.
+"""
+
+import csv
+import io
+import zipfile
+from itertools import islice
+from xml.sax.saxutils import escape
+from sqlalchemy import select
+from . import db
+from . import slots
+from . import headcount
+from . import week_archive
+from .models import Booking, User
+
+STUDENT_HEADER = (['Student ID', 'Initials', 'Surname', 'Email']
+                  + [f'{meal.capitalize()} {day.capitalize()}' for meal, day in slots.SLOTS] + ['Meals'])
+KITCHEN_HEADER = ['Meal', 'Day', 'Students']
+
+# First characters that make a spreadsheet read a CSV cell as a formula
+FORMULA_PREFIXES = ('=', '+', '-', '@', '\t', '\r')
+
+# Workbook parts that do not depend on the data
+CONTENT_TYPES = (
+    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+    '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+    '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+    '<Default Extension="xml" ContentType="application/xml"/>'
+    '<Override PartName="/xl/workbook.xml" '
+    'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet.main+xml"/>'
+    '<Override PartName="/xl/worksheets/sheet1.xml" '
+    'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.worksheet+xml"/>'
+    '<Override PartName="/xl/worksheets/sheet2.xml" '
+    'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.worksheet+xml"/>'
+    '</Types>'
+)
+ROOT_RELS = (
+    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+    '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+    '<Relationship Id="rId1" '
+    'Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument" '
+    'Target="xl/workbook.xml"/>'
+    '</Relationships>'
+)
+WORKBOOK = (
+    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+    '<workbook xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main" '
+    'xmlns:r="http://schemas.openxmlformats.org/officeDocument/2006/relationships">'
+    '<sheets><sheet name="Kitchen" sheetId="1" r:id="rId1"/><sheet name="Students" sheetId="2" r:id="rId2"/></sheets>'
+    '</workbook>'
+)
+WORKBOOK_RELS = (
+    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+    '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+    '<Relationship Id="rId1" '
+    'Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/worksheet" '
+    'Target="worksheets/sheet1.xml"/>'
+    '<Relationship Id="rId2" '
+    'Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/worksheet" '
+    'Target="worksheets/sheet2.xml"/>'
+    '</Relationships>'
+)
+SHEET_START = ('<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+               '<worksheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main"><sheetData>')
+SHEET_END = '</sheetData></worksheet>'
+
+
+def _archived_rows(year, week, chunk_size):
+    """Yields (user_id, initials, surname, email, meal_slots) for an archived week, a chunk of names per query."""
+    rows = week_archive.booking_rows(year, week)
+    while True:
+        chunk = list(islice(rows, chunk_size))
+        if not chunk:
+            return
+        names = {user_id: (initials, surname, email) for user_id, initials, surname, email in db.session.execute(
+            select(User.user_id, User.initials, User.surname, User.email)
+            .where(User.user_id.in_({user_id for _, user_id, _ in chunk})))}
+        for _, user_id, meal_slots in chunk:
+            if user_id in names:
+                yield (user_id, *names[user_id], meal_slots)
+
+
+def student_rows(year, week, chunk_size=1000):
+    """
+    Streams the students booked for a week, ordered by student ID. A student
+    with several Booking rows in the week gets one row with their slots combined.
+
+    Args:
+        year (int): ISO year.
+        week (int): ISO week number.
+        chunk_size (int, optional): Rows fetched from the database at a time.
+
+    Yields:
+        list: Student ID, initials, surname, email, one 1/'' per slot, meal count.
+    """
+    query = (select(User.user_id, User.initials, User.surname, User.email, Booking.meal_slots)
+             .join(User, User.user_id == Booking.user_booking_id_fk)
+             .where(Booking.year == year, Booking.week == week)
+             .order_by(Booking.user_booking_id_fk)
+             .execution_options(yield_per=chunk_size))
+    if week_archive.is_archived(year, week):
+        rows = _archived_rows(year, week, chunk_size)
+    else:
+        rows = db.session.execute(query)
+
+    def row(student, bitmap):
+        return list(student) + [1 if bitmap >> index & 1 else '' for index in range(slots.SLOT_COUNT)] \
+            + [slots.count(bitmap)]
+
+    current, combined = None, 0
+    for user_id, initials, surname, email, meal_slots in rows:
+        if current is not None and current[0] != user_id:
+            yield row(current, combined)
+            combined = 0
+        current = (user_id, initials, surname, email)
+        combined |= meal_slots or 0
+    if current is not None:
+        yield row(current, combined)
+
+
+def kitchen_rows(year, week):
+    """
+    Lists the head-count of every meal slot of a week.
+
+    Args:
+        year (int): ISO year.
+        week (int): ISO week number.
+
+    Yields:
+        list: Meal, day and number of students.
+    """
+    if week_archive.is_archived(year, week):
+        totals = week_archive.weekly_totals(year, week)
+    else:
+        totals = headcount.weekly_totals(year, week)
+    for (meal, day), count in zip(slots.SLOTS, totals):
+        yield [meal.capitalize(), day.capitalize(), count]
+
+
+def _csv_cell(value):
+    """Neutralises a text cell a spreadsheet would run as a formula by prefixing an apostrophe."""
+    if isinstance(value, str) and value.startswith(FORMULA_PREFIXES):
+        return "'" + value
+    return value
+
+
+def csv_stream(year, week, sheet='students', chunk_size=1000):
+    """
+    Streams one sheet as CSV text, a batch of rows per chunk.
+
+    Args:
+        year (int): ISO year.
+        week (int): ISO week number.
+        sheet (str, optional): 'students' or 'kitchen'.
+        chunk_size (int, optional): Rows per database fetch and per yielded chunk.
+
+    Yields:
+        str: CSV text.
+    """
+    if sheet == 'kitchen':
+        header, rows = KITCHEN_HEADER, kitchen_rows(year, week)
+    else:
+        header, rows = STUDENT_HEADER, student_rows(year, week, chunk_size)
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(header)
+    for count, row in enumerate(rows, 1):
+        writer.writerow([_csv_cell(value) for value in row])
+        if count % chunk_size == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue()
+
+
+class _Sink:
+    """Write-only file object collecting the zip output between yields."""
+
+    def __init__(self):
+        self._chunks = []
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = b''.join(self._chunks)
+        self._chunks = []
+        return data
+
+
+def _xml_row(values):
+    """Formats a row as worksheet XML, numbers as values and the rest as inline strings."""
+    cells = []
+    for value in values:
+        if isinstance(value, int):
+            cells.append(f'<c><v>{value}</v></c>')
+        elif value == '' or value is None:
+            cells.append('<c/>')
+        else:
+            cells.append(f'<c t="inlineStr"><is><t>{escape(str(value))}</t></is></c>')
+    return '<row>' + ''.join(cells) + '</row>'
+
+
+def xlsx_stream(year, week, chunk_size=1000):
+    """
+    Streams an .xlsx workbook with the Kitchen and Students sheets.
+
+    Args:
+        year (int): ISO year.
+        week (int): ISO week number.
+        chunk_size (int, optional): Rows per database fetch and per yielded chunk.
+
+    Yields:
+        bytes: Parts of the zip archive.
+    """
+    sink = _Sink()
+    with zipfile.ZipFile(sink, 'w', zipfile.ZIP_DEFLATED) as workbook:
+        workbook.writestr('[Content_Types].xml', CONTENT_TYPES)
+        workbook.writestr('_rels/.rels', ROOT_RELS)
+        workbook.writestr('xl/workbook.xml', WORKBOOK)
+        workbook.writestr('xl/_rels/workbook.xml.rels', WORKBOOK_RELS)
+        for name, header, rows in (('sheet1', KITCHEN_HEADER, kitchen_rows(year, week)),
+                                   ('sheet2', STUDENT_HEADER, student_rows(year, week, chunk_size))):
+            with workbook.open(f'xl/worksheets/{name}.xml', 'w', force_zip64=True) as sheet:
+                sheet.write((SHEET_START + _xml_row(header)).encode('utf-8'))
+                for count, row in enumerate(rows, 1):
+                    sheet.write(_xml_row(row).encode('utf-8'))
+                    if count % chunk_size == 0:
+                        yield sink.drain()
+                sheet.write(SHEET_END.encode('utf-8'))
+            yield sink.drain()
+    yield sink.drain()
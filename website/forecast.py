@@ -0,0 +1,285 @@
+"""
+Kitchen demand forecast from booking history and gate admissions.
+
+For a coming week the forecast gives, per (meal, day) slot, the head-count the
+kitchen should expect to be booked, the share of booked students who do not
+turn up (no-show rate, from the Admission rows recorded at the gate) and the
+expected attendance to cook for.
+
+History is assembled into week x slot matrices (booked head-counts from
+Meal_Count and the per-term archive files, distinct students admitted from
+Admission) and fitted with vectorised NumPy operations, so refitting on years of
+history is a handful of matrix products:
+
+- baseline: exponentially weighted mean of each slot's bookings, weeks losing
+  half their weight every FORECAST_HALF_LIFE weeks (default 8);
+- dish effect: how far above or below the baseline a slot was booked when a
+  dish was served, relative to the size of that week, averaged per dish and
+  shrunk towards no effect for rarely served dishes;
+- no-show rate: 1 - admitted / booked over the past weeks the gate was in
+  use; the current week is left out until all of its meals have been served.
+
+Predictions are cached per (year, week) in this process for FORECAST_CACHE_TTL
+seconds (default 3600), in an LRU map of at most FORECAST_CACHE_SIZE weeks
+(default 16) since the week comes from the query string; saving a menu drops
+its week.
+
+NumPy is optional: without it `available()` is False and the dashboard shows
+the booked head-counts only. It is imported on the first forecast rather than
+with this module, so it stays out of every worker's start-up.
+
+Functions:
+- available(): Whether NumPy is installed.
+- load_history(year, week): Week x slot matrices of the history before a week.
+- fit(history, half_life=8): Fits the per-slot baseline, dish effects and no-show rates.
+- predict(year, week): Forecast of every slot of a week.
+
+Classes:
+- ForecastCache: Per-week LRU cache of forecasts.
+"""
+
+from collections import OrderedDict
+from datetime import date
+from importlib.util import find_spec
+from threading import Lock
+from time import monotonic, perf_counter
+from flask import current_app
+from sqlalchemy import func
+from . import db
+from . import slots
+from . import headcount
+from . import week_archive
+from . import tenants
+from .menu_cache import parse_menu
+from .models import Admission, Meal_Count, Weekly_menu
+
+# Weight of the "no effect" prior pulling the factor of rarely served dishes towards 1
+DISH_PRIOR = 2.0
+
+
+def available():
+    """Returns True if NumPy is installed and forecasts can be computed."""
+    return find_spec('numpy') is not None
+
+
+def _monday(year, week):
+    """Monday of an ISO week."""
+    return date.fromisocalendar(year, week, 1)
+
+
+def _dish(menu, meal, day):
+    """Normalised dish served at a slot, or None."""
+    dish = (menu.get(meal) or {}).get(day)
+    return dish.strip().lower() if isinstance(dish, str) and dish.strip() else None
+
+
+def load_history(year, week):
+    """
+    Reads the history before a week into week x slot matrices. Must be called
+    inside an application context.
+
+    Args:
+        year (int): ISO year of the week to forecast.
+        week (int): ISO week to forecast.
+
+    Returns:
+        dict: 'ages' (W weeks before the target), 'booked' (W x S head-counts),
+        'admitted' (W x S students admitted, NaN rows for weeks without gate
+        data and for the current week, which is not over yet), 'dishes' (W x S dish ids, -1 for none) and 'target_dishes' (S dish ids).
+    """
+    import numpy as np
+
+    target = (year, week)
+    totals = {key: counts for key, counts in week_archive.all_weekly_totals().items() if key < target}
+    for count_year, count_week, meal, day, head_count in db.session.query(
+            Meal_Count.year, Meal_Count.week, Meal_Count.meal, Meal_Count.day, Meal_Count.head_count):
+        if (count_year, count_week) < target and (meal, day) in slots.SLOT_INDEX:
+            totals.setdefault((count_year, count_week), [0] * slots.SLOT_COUNT)[slots.SLOT_INDEX[(meal, day)]] = \
+                head_count
+
+    weeks = sorted(totals)
+    row_of = {key: row for row, key in enumerate(weeks)}
+    target_monday = _monday(year, week)
+    ages = np.array([(target_monday - _monday(*key)).days // 7 for key in weeks], dtype=float)
+    booked = np.array([totals[key] for key in weeks], dtype=float).reshape(len(weeks), slots.SLOT_COUNT)
+
+    # The current week is still being served, so only weeks that have ended count towards no-show rates
+    current = tuple(date.today().isocalendar()[:2])
+    admitted = np.full(booked.shape, np.nan)
+    for admission_year, admission_week, slot, students in db.session.query(
+            Admission.year, Admission.week, Admission.slot, func.count(func.distinct(Admission.admission_user_fk))
+    ).group_by(Admission.year, Admission.week, Admission.slot):
+        row = row_of.get((admission_year, admission_week))
+        if row is not None and (admission_year, admission_week) < current and slot is not None \
+                and 0 <= slot < slots.SLOT_COUNT:
+            admitted[row, slot] = students
+    gate_weeks = ~np.isnan(admitted).all(axis=1)
+    admitted[gate_weeks] = np.nan_to_num(admitted[gate_weeks])
+
+    menus = {(menu_year, menu_week): parse_menu(content) for menu_year, menu_week, content in
+             db.session.query(Weekly_menu.year, Weekly_menu.week, Weekly_menu.menu_content)}
+    dish_ids = {}
+
+    def dish_row(menu):
+        return [dish_ids.setdefault(dish, len(dish_ids)) if dish else -1
+                for dish in (_dish(menu, meal, day) for meal, day in slots.SLOTS)]
+
+    dishes = np.full(booked.shape, -1, dtype=int)
+    for row, key in enumerate(weeks):
+        if key in menus:
+            dishes[row] = dish_row(menus[key])
+    target_dishes = np.array(dish_row(menus.get(target, {})), dtype=int)
+
+    return {'ages': ages, 'booked': booked, 'admitted': admitted, 'dishes': dishes, 'target_dishes': target_dishes}
+
+
+def fit(history, half_life=8):
+    """
+    Fits the forecast on week x slot history matrices.
+
+    Args:
+        history (dict): Matrices returned by load_history().
+        half_life (float, optional): Weeks after which a week's weight halves.
+
+    Returns:
+        dict: 'baseline' (S expected bookings), 'dish_factor' (multiplier per
+        dish id) and 'no_show' (S rates between 0 and 1).
+    """
+    import numpy as np
+
+    booked, admitted, dishes = history['booked'], history['admitted'], history['dishes']
+    if not len(booked):
+        return {'baseline': np.zeros(slots.SLOT_COUNT), 'dish_factor': np.ones(0),
+                'no_show': np.zeros(slots.SLOT_COUNT)}
+    weights = 0.5 ** (history['ages'] / half_life)
+    baseline = weights @ booked / weights.sum()
+
+    # Bookings relative to the baseline, after removing each week's overall level
+    level = booked.sum(axis=1, keepdims=True) / max(baseline.sum(), 1.0)
+    expected = baseline * level
+    ratio = np.divide(booked, expected, out=np.ones_like(booked), where=expected > 0)
+    served = dishes >= 0
+    cell_weights = np.broadcast_to(weights[:, None], booked.shape)[served]
+    dish_count = int(dishes.max()) + 1 if served.any() else 0
+    sums = np.bincount(dishes[served], weights=cell_weights * ratio[served], minlength=dish_count)
+    counts = np.bincount(dishes[served], weights=cell_weights, minlength=dish_count)
+    dish_factor = (sums + DISH_PRIOR) / (counts + DISH_PRIOR)
+
+    gate_weeks = ~np.isnan(admitted).all(axis=1)
+    booked_at_gate = weights[gate_weeks] @ booked[gate_weeks]
+    admitted_at_gate = weights[gate_weeks] @ admitted[gate_weeks]
+    attendance = np.divide(admitted_at_gate, booked_at_gate, out=np.ones_like(booked_at_gate),
+                           where=booked_at_gate > 0)
+    no_show = np.clip(1.0 - attendance, 0.0, 1.0)
+
+    return {'baseline': baseline, 'dish_factor': dish_factor, 'no_show': no_show}
+
+
+def predict(year, week):
+    """
+    Forecasts every slot of a week. Must be called inside an application context.
+
+    Args:
+        year (int): ISO year.
+        week (int): ISO week number.
+
+    Returns:
+        dict: 'slots' (per slot: meal, day, booked so far, predicted bookings,
+        no_show_rate and expected attendance), 'weeks' of history used and
+        'seconds' spent loading and fitting.
+    """
+    import numpy as np
+
+    started = perf_counter()
+    history = load_history(year, week)
+    model = fit(history, current_app.config.get('FORECAST_HALF_LIFE', 8))
+
+    target_dishes = history['target_dishes']
+    known = (target_dishes >= 0) & (target_dishes < len(model['dish_factor']))
+    factor = np.ones(slots.SLOT_COUNT)
+    factor[known] = model['dish_factor'][target_dishes[known]]
+    predicted = model['baseline'] * factor
+    booked = np.array(headcount.weekly_totals(year, week), dtype=float)
+    expected = np.maximum(predicted, booked) * (1.0 - model['no_show'])
+
+    return {
+        'slots': [{'meal': meal, 'day': day, 'booked': int(booked[index]),
+                   'predicted': int(round(predicted[index])), 'no_show_rate': round(float(model['no_show'][index]), 3),
+                   'expected': int(round(expected[index]))}
+                  for index, (meal, day) in enumerate(slots.SLOTS)],
+        'weeks': len(history['ages']),
+        'seconds': perf_counter() - started,
+    }
+
+
+class ForecastCache:
+    """LRU cache of forecasts keyed by week."""
+
+    def __init__(self):
+        self._lock = Lock()
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, year, week):
+        """
+        Returns the forecast of a week, computing it on a miss.
+
+        Args:
+            year (int): ISO year.
+            week (int): ISO week number.
+
+        Returns:
+            dict: Forecast as returned by predict(), or None without NumPy.
+        """
+        if not available():
+            return None
+        ttl = current_app.config.get('FORECAST_CACHE_TTL', 3600)
+        now = monotonic()
+        with self._lock:
+            entry = self._entries.get((year, week))
+            if entry is not None and now - entry[1] < ttl:
+                self._entries.move_to_end((year, week))
+                self.hits += 1
+                return entry[0]
+            self.misses += 1
+
+        forecast = predict(year, week)
+        size = current_app.config.get('FORECAST_CACHE_SIZE', 16)
+        with self._lock:
+            self._entries[(year, week)] = (forecast, now)
+            self._entries.move_to_end((year, week))
+            while len(self._entries) > size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+        return forecast
+
+    def invalidate(self, year=None, week=None):
+        """
+        Drops the forecast of one week, or every forecast.
+
+        Args:
+            year (int, optional): ISO year of the week to drop.
+            week (int, optional): ISO week to drop; all weeks if omitted.
+        """
+        with self._lock:
+            if week is None:
+                self._entries.clear()
+            else:
+                self._entries.pop((year, week), None)
+
+    def stats(self):
+        """
+        Returns the cache counters.
+
+        Returns:
+            dict: 'hits', 'misses', 'evictions' and 'size'.
+        """
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                    'size': len(self._entries)}
+
+
+# Process-wide caches used by the manager dashboard, one per tenant
+forecasts = tenants.PerTenant(ForecastCache)
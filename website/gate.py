@@ -0,0 +1,354 @@
+"""
+Dining-hall gate checks keyed by RFID card.
+
+The gate terminal posts the `rfid_code` of each card swiped to `/access/scan`.
+Verdicts come from an in-process map of card to this week's entitlement
+(user id and meal-slot bitmap), loaded with a single indexed join of
+Access_Card and Booking. A swipe is then a dictionary lookup plus a bit test for
+the meal being served at that time of day, with no database round trip unless
+the card is booked for it: `check()` then refuses a card already admitted to
+that meal ('already_admitted'), from the admissions still queued in this process
+or one indexed query, so the scan endpoint, the API's batch checks and the
+offline terminal (see gate_snapshot.py) all stop passback the same way.
+
+The map reloads when the ISO week changes or after `GATE_CACHE_TTL` seconds
+(default 300), so bookings written by other worker processes are picked up.
+Booking and account changes made in this process update it immediately.
+
+Granted swipes are recorded as `Admission` rows (source 'online') by
+`AdmissionRecorder`, which queues them and writes them with one bulk insert per
+ADMISSION_BATCH_SIZE swipes (default 100), or from a timer thread once the
+oldest queued swipe is ADMISSION_FLUSH_SECONDS old (default 5) even if no other
+card is swiped, so the swipe itself still does no database write. Swipes already
+recorded are skipped, and while the database is unavailable at most
+ADMISSION_QUEUE_LIMIT (default 10000) admissions wait for the next flush. The
+admissions feed the no-show rates of the kitchen forecast (see forecast.py) and are
+published to the live dashboards as they are queued (see events.py).
+
+Classes:
+- EntitlementCache: Warm map of card to this week's entitlement.
+- AdmissionRecorder: Buffered, batched writer of online admissions.
+
+Functions:
+- check(rfid_code, when=None): Decides whether a card may enter right now.
+"""
+
+import atexit
+from datetime import datetime
+from threading import Lock, Timer
+from time import monotonic
+from flask import current_app
+from sqlalchemy import and_, or_
+from sqlalchemy.exc import IntegrityError, OperationalError
+from . import db
+from . import slots
+from . import events
+from . import tenants
+from .models import Access_Card, Admission, Booking, insert_ignoring_duplicates
+
+
+class EntitlementCache:
+    """Map of rfid_code to (user_id, meal_slots) for one ISO week."""
+
+    def __init__(self):
+        self._lock = Lock()
+        self._entries = {}
+        self._week = None  # (ISO year, ISO week) of the loaded map
+        self._loaded_at = 0.0
+
+    def _query(self, year, week, rfid_code=None):
+        """Yields (rfid_code, user_id, meal_slots) rows, one per card and booking."""
+        query = (db.session.query(Access_Card.rfid_code, Access_Card.user_card_id_fk, Booking.meal_slots)
+                 .outerjoin(Booking, and_(Booking.user_booking_id_fk == Access_Card.user_card_id_fk,
+                                          Booking.year == year, Booking.week == week)))
+        if rfid_code is not None:
+            query = query.filter(Access_Card.rfid_code == rfid_code)
+        return query
+
+    def load(self, year, week):
+        """
+        Replaces the map with every card's entitlement for the given week.
+
+        Args:
+            year (int): ISO year.
+            week (int): ISO week number.
+        """
+        entries = {}
+        for rfid_code, user_id, meal_slots in self._query(year, week):
+            previous = entries.get(rfid_code, (user_id, 0))[1]
+            entries[rfid_code] = (user_id, previous | (meal_slots or 0))
+        with self._lock:
+            self._entries = entries
+            self._week = (year, week)
+            self._loaded_at = monotonic()
+
+    def items(self):
+        """Returns the loaded (rfid_code, (user_id, meal_slots)) pairs."""
+        with self._lock:
+            return list(self._entries.items())
+
+    def lookup(self, rfid_code, year, week):
+        """
+        Returns the entitlement of a card, loading the week on first use and
+        falling back to an indexed point query for cards issued since the load.
+
+        Args:
+            rfid_code (str): Card RFID code.
+            year (int): ISO year.
+            week (int): ISO week number.
+
+        Returns:
+            tuple: (user_id, meal_slots), or None if the card is unknown.
+        """
+        ttl = current_app.config.get('GATE_CACHE_TTL', 300)
+        if self._week != (year, week) or monotonic() - self._loaded_at > ttl:
+            self.load(year, week)
+
+        entry = self._entries.get(rfid_code)
+        if entry is None:
+            rows = self._query(year, week, rfid_code).all()
+            if rows:
+                entry = (rows[0][1], 0)
+                for _, _, meal_slots in rows:
+                    entry = (entry[0], entry[1] | (meal_slots or 0))
+                with self._lock:
+                    self._entries[rfid_code] = entry
+        return entry
+
+    def update_user(self, user_id, year, week, meal_slots):
+        """
+        Records a changed booking for every card of a user, if the map holds
+        that week.
+
+        Args:
+            user_id (int): User whose booking changed.
+            year (int): ISO year of the booking.
+            week (int): ISO week of the booking.
+            meal_slots (int): New slot bitmap of the booking.
+        """
+        with self._lock:
+            if (year, week) != self._week:
+                return
+            for rfid_code, (card_user_id, _) in list(self._entries.items()):
+                if card_user_id == user_id:
+                    self._entries[rfid_code] = (card_user_id, meal_slots)
+
+    def forget_user(self, user_id):
+        """
+        Drops every card of a deleted user from the map.
+
+        Args:
+            user_id (int): Deleted user.
+        """
+        self.forget_users({user_id})
+
+    def forget_users(self, user_ids):
+        """
+        Drops every card of many deleted users from the map in one pass.
+
+        Args:
+            user_ids (set): Deleted users.
+        """
+        with self._lock:
+            self._entries = {rfid_code: entry for rfid_code, entry in self._entries.items()
+                             if entry[0] not in user_ids}
+
+
+# Process-wide entitlement maps used by the gate endpoint, one per tenant
+entitlements = tenants.PerTenant(EntitlementCache)
+
+
+class AdmissionRecorder:
+    """Queues granted swipes and writes them to the Admission table in batches."""
+
+    def __init__(self):
+        self._lock = Lock()
+        self._pending = []
+        self._writing = []
+        self._timer = None
+        self._app = None
+        self._tenant = None
+        atexit.register(self.flush)
+
+    def record(self, rfid_code, verdict, when):
+        """
+        Queues the admission of a granted swipe. Must be called inside an
+        application context.
+
+        Args:
+            rfid_code (str): Card RFID code.
+            verdict (dict): Granted verdict returned by check().
+            when (datetime): Time of the swipe.
+        """
+        app = current_app._get_current_object()
+        year, week = when.isocalendar()[:2]
+        slot = slots.SLOT_INDEX[(verdict['meal'], verdict['day'])]
+        with self._lock:
+            self._app, self._tenant = app, tenants.current()
+            self._pending.append({
+                'admission_user_fk': verdict['user_id'],
+                'rfid_code': rfid_code,
+                'year': year,
+                'week': week,
+                'slot': slot,
+                'admitted_date': when,
+                'source': 'online',
+            })
+            due = len(self._pending) >= app.config.get('ADMISSION_BATCH_SIZE', 100)
+            self._schedule(app)
+        # Live dashboards see the admission straight away, before it is written
+        events.admitted(verdict['user_id'], year, week, slot, when)
+        if due:
+            self.flush()
+
+    def admitted(self, swipes):
+        """
+        Returns the admissions of some cards in some weeks, whether still queued
+        in this process or already written. Must be called inside an application
+        context.
+
+        Args:
+            swipes (set): (rfid_code, year, week) of the cards and weeks to look up.
+
+        Returns:
+            set: (rfid_code, year, week, slot) of each admission found.
+        """
+        if not swipes:
+            return set()
+        with self._lock:
+            found = {(row['rfid_code'], row['year'], row['week'], row['slot']) for row in self._pending + self._writing
+                     if (row['rfid_code'], row['year'], row['week']) in swipes}
+        weeks = {(year, week) for _, year, week in swipes}
+        query = db.session.query(Admission.rfid_code, Admission.year, Admission.week, Admission.slot).filter(
+            Admission.rfid_code.in_({rfid_code for rfid_code, _, _ in swipes}),
+            or_(*(and_(Admission.year == year, Admission.week == week) for year, week in weeks)))
+        found.update((rfid_code, year, week, slot) for rfid_code, year, week, slot in query
+                     if (rfid_code, year, week) in swipes)
+        return found
+
+    def flush(self):
+        """
+        Writes every queued admission in one bulk insert that skips swipes
+        already recorded (uq_admission_card_date), so a retried swipe never
+        blocks the queue. If the batch is refused for another integrity reason,
+        the rows are written one at a time and the refused ones are logged and
+        dropped. Only rows that failed because the database was unavailable are
+        queued again for the next flush.
+
+        Returns:
+            int: Number of admissions written.
+        """
+        with self._lock:
+            rows, app, tenant = self._pending, self._app, self._tenant
+            self._pending = []
+            # Still visible to admitted() until committed
+            self._writing = self._writing + rows
+        if not rows:
+            return 0
+        try:
+            with app.app_context():
+                engine = tenants.engine(tenant)
+                try:
+                    with engine.begin() as connection:
+                        statement = insert_ignoring_duplicates(connection, Admission.__table__)
+                        return connection.execute(statement, rows).rowcount
+                except OperationalError:
+                    app.logger.exception('Writing %d admissions failed, will retry', len(rows))
+                    self._requeue(app, rows)
+                    return 0
+                except IntegrityError:
+                    return self._insert_each(app, engine, rows)
+        finally:
+            written = {id(row) for row in rows}
+            with self._lock:
+                self._writing = [row for row in self._writing if id(row) not in written]
+
+    def _insert_each(self, app, engine, rows):
+        """Writes admissions one at a time, dropping those the database refuses."""
+        written = 0
+        for index, row in enumerate(rows):
+            try:
+                with engine.begin() as connection:
+                    written += connection.execute(insert_ignoring_duplicates(connection, Admission.__table__),
+                                                  row).rowcount
+            except OperationalError:
+                app.logger.exception('Writing %d admissions failed, will retry', len(rows) - index)
+                self._requeue(app, rows[index:])
+                break
+            except IntegrityError:
+                app.logger.exception('Dropped admission of card %s at %s', row['rfid_code'], row['admitted_date'])
+        return written
+
+    def _requeue(self, app, rows):
+        """Queues unwritten rows again, dropping the oldest beyond ADMISSION_QUEUE_LIMIT."""
+        limit = app.config.get('ADMISSION_QUEUE_LIMIT', 10000)
+        with self._lock:
+            self._pending[:0] = rows
+            dropped = len(self._pending) - limit
+            if dropped > 0:
+                del self._pending[:dropped]
+                app.logger.error('Admission queue is full, dropped the %d oldest admissions', dropped)
+            self._schedule(app)
+
+    def _schedule(self, app):
+        """Starts the timer flushing the queue in ADMISSION_FLUSH_SECONDS, unless one is running. Hold the lock."""
+        if self._timer is None:
+            self._timer = Timer(app.config.get('ADMISSION_FLUSH_SECONDS', 5), self._flush_on_timer)
+            self._timer.daemon = True
+            self._timer.start()
+
+    def _flush_on_timer(self):
+        """Writes the admissions queued since the timer started."""
+        with self._lock:
+            self._timer = None
+        self.flush()
+
+
+# Process-wide recorders of the gate endpoint's admissions, one per tenant
+admissions = tenants.PerTenant(AdmissionRecorder)
+
+
+def check(rfid_code, when=None, admitted=None):
+    """
+    Decides whether a card may enter the dining hall at a given time. A card
+    already admitted to the meal is refused. Must be called inside an
+    application context.
+
+    Args:
+        rfid_code (str): Card RFID code.
+        when (datetime, optional): Time of the swipe, defaults to now.
+        admitted (set, optional): (rfid_code, year, week, slot) of the admissions
+            already made, as returned by AdmissionRecorder.admitted(), for
+            checking many swipes at once; looked up for this card if omitted.
+
+    Returns:
+        dict: Verdict with 'granted' (bool), 'reason' ('booked', 'not_booked',
+        'already_admitted', 'no_meal' or 'unknown_card'), 'user_id', 'meal' and 'day'.
+    """
+    when = when or datetime.now()
+    year, week = when.isocalendar()[:2]
+    verdict = {'granted': False, 'reason': 'unknown_card', 'user_id': None, 'meal': None, 'day': None}
+
+    entry = entitlements.lookup(rfid_code, year, week)
+    if entry is None:
+        return verdict
+    user_id, meal_slots = entry
+    verdict['user_id'] = user_id
+
+    index = slots.slot_at(when)
+    if index is None:
+        verdict['reason'] = 'no_meal'
+        return verdict
+    verdict['meal'], verdict['day'] = slots.SLOTS[index]
+
+    if not meal_slots >> index & 1:
+        verdict['reason'] = 'not_booked'
+        return verdict
+    if admitted is None:
+        admitted = admissions.admitted({(rfid_code, year, week)})
+    if (rfid_code, year, week, index) in admitted:
+        verdict['reason'] = 'already_admitted'
+    else:
+        verdict['granted'] = True
+        verdict['reason'] = 'booked'
+    return verdict
@@ -0,0 +1,130 @@
+"""
+Offline dining-hall gate backed by a preloaded entitlement snapshot.
+
+A snapshot is a small binary file holding every card's meal-slot bitmap for one
+ISO week, exported from Booking and Access_Card with `flask export-gate-snapshot`.
+A gate process memory-maps it and answers swipes locally, so a slow database or
+a network outage does not stop the queue. Opening a snapshot does no parsing,
+whatever the number of students, and a lookup is a binary search over
+fixed-width records.
+
+Admissions are appended to a local journal, one line per swipe, and bulk
+uploaded into the Admission table with `flask upload-gate-journal` once the
+database is reachable again.
+
+The snapshot format, the journal format and the gate terminal itself live in
+gate_snapshot.py, which runs without importing this package:
+
+    python website/gate_snapshot.py SNAPSHOT JOURNAL
+
+Classes:
+- OfflineGate: Validates swipes against a snapshot and journals admissions (from gate_snapshot.py).
+
+Functions:
+- export_snapshot(path, year, week): Writes a snapshot from the database.
+- upload_journal(path): Bulk inserts journaled admissions into the database.
+"""
+
+import os
+import zlib
+from datetime import datetime
+from .gate_snapshot import (HEADER, RECORD, SNAPSHOT_MAGIC, SNAPSHOT_VERSION, OfflineGate, main,
+                            read_journal_line, snapshot_key)
+
+# Admissions inserted per transaction when uploading a journal
+UPLOAD_CHUNK_SIZE = 1000
+
+
+def export_snapshot(path, year, week):
+    """
+    Writes the entitlement snapshot of one week. The file is written next to
+    its destination and renamed into place, so running gates never see a
+    partial snapshot. Must be called inside an application context.
+
+    Args:
+        path (str): Destination file.
+        year (int): ISO year of the week.
+        week (int): ISO week number.
+
+    Returns:
+        int: Number of cards in the snapshot.
+    """
+    from .gate import EntitlementCache
+
+    cache = EntitlementCache()
+    cache.load(year, week)
+    records = b''.join(RECORD.pack(snapshot_key(rfid_code), user_id or 0, meal_slots)
+                       for rfid_code, (user_id, meal_slots) in sorted(cache.items(),
+                                                                      key=lambda item: snapshot_key(item[0]))
+                       if rfid_code)
+    count = len(records) // RECORD.size
+    header = HEADER.pack(SNAPSHOT_MAGIC, SNAPSHOT_VERSION, year, week, count,
+                         int(datetime.now().timestamp()), zlib.crc32(records))
+
+    temporary = f'{path}.tmp'
+    with open(temporary, 'wb') as snapshot:
+        snapshot.write(header)
+        snapshot.write(records)
+        snapshot.flush()
+        os.fsync(snapshot.fileno())
+    os.replace(temporary, path)
+    return count
+
+
+def upload_journal(path):
+    """
+    Bulk inserts journaled admissions into the Admission table in chunked
+    transactions. Lines already uploaded are skipped, so a journal can be
+    uploaded again after an interruption or by two processes at once. Each
+    admission keeps the ISO year and week journaled with it. Must be called
+    inside an application context.
+
+    Args:
+        path (str): Journal written by OfflineGate.
+
+    Returns:
+        tuple: (inserted, skipped) admission counts.
+    """
+    from . import db
+    from .models import Admission, insert_ignoring_duplicates
+
+    inserted = skipped = 0
+
+    def flush(rows):
+        existing = {(rfid_code, admitted_date) for rfid_code, admitted_date in
+                    db.session.query(Admission.rfid_code, Admission.admitted_date)
+                    .filter(Admission.rfid_code.in_({row['rfid_code'] for row in rows}),
+                            Admission.admitted_date.in_({row['admitted_date'] for row in rows}))}
+        new_rows = [row for row in rows if (row['rfid_code'], row['admitted_date']) not in existing]
+        if new_rows:
+            # Rows another upload wrote since the query above are skipped by the unique (card, time) key
+            db.session.execute(insert_ignoring_duplicates(db.session, Admission.__table__), new_rows)
+        db.session.commit()
+        return len(new_rows), len(rows) - len(new_rows)
+
+    rows = []
+    with open(path) as journal:
+        for entry in filter(None, map(read_journal_line, journal)):
+            admitted_date, rfid_code, user_id, year, week, slot = entry
+            rows.append({
+                'admission_user_fk': user_id,
+                'rfid_code': rfid_code,
+                'year': year,
+                'week': week,
+                'slot': slot,
+                'admitted_date': admitted_date,
+                'source': 'offline',
+            })
+            if len(rows) == UPLOAD_CHUNK_SIZE:
+                counts = flush(rows)
+                inserted, skipped = inserted + counts[0], skipped + counts[1]
+                rows = []
+    if rows:
+        counts = flush(rows)
+        inserted, skipped = inserted + counts[0], skipped + counts[1]
+    return inserted, skipped
+
+
+if __name__ == '__main__':
+    # Kept for existing scripts; `python website/gate_snapshot.py` does not load Flask
+    raise SystemExit(main())
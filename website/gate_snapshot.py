@@ -0,0 +1,237 @@
+"""
+Gate snapshot format and the offline gate terminal.
+
+This module and slots.py only need the standard library, so a gate terminal
+runs them as a script without Flask, SQLAlchemy or the rest of the `website`
+package (which `python -m website...` would import first):
+
+    python website/gate_snapshot.py SNAPSHOT JOURNAL
+
+The terminal memory-maps a snapshot written by `flask export-gate-snapshot`
+(see gate_offline.py), answers swipes read from standard input and appends
+admissions to a local journal, later uploaded with `flask upload-gate-journal`.
+
+Snapshot layout (little-endian):
+- header: magic b'SAMG', format version, ISO year, ISO week, record count,
+  generation time (Unix seconds) and CRC32 of the records.
+- records: rfid_code (20 bytes, NUL padded), user_id, meal_slots; sorted by
+  rfid_code.
+
+Journal lines: `<unix ms>,<rfid_code>,<user_id>,<ISO year>,<ISO week>,<slot>`.
+Lines written before the year was recorded have no year field; their year is
+taken from the swipe time.
+
+Classes:
+- OfflineGate: Validates swipes against a snapshot and journals admissions.
+
+Functions:
+- snapshot_key(rfid_code): Fixed-width snapshot key of an RFID code.
+- journal_line(when, rfid_code, user_id, year, week, slot): Formats a journal line.
+- read_journal_line(line): Parses a journal line.
+"""
+
+import mmap
+import os
+import struct
+import sys
+import zlib
+from datetime import datetime
+
+if __package__:
+    from . import slots
+else:
+    # Run as a script: website/ is on sys.path, the website package is not imported
+    import slots
+
+SNAPSHOT_MAGIC = b'SAMG'
+SNAPSHOT_VERSION = 1
+HEADER = struct.Struct('<4sHHHIqI')
+RECORD = struct.Struct('<20sII')
+RFID_LENGTH = 20
+
+
+def snapshot_key(rfid_code):
+    """Encodes an RFID code as a fixed-width snapshot key."""
+    return rfid_code.encode('utf-8')[:RFID_LENGTH].ljust(RFID_LENGTH, b'\0')
+
+
+def journal_line(when, rfid_code, user_id, year, week, slot):
+    """
+    Formats the journal line of an admission.
+
+    Args:
+        when (datetime): Time of the swipe.
+        rfid_code (str): Card RFID code.
+        user_id (int): Student admitted.
+        year (int): ISO year of the meal.
+        week (int): ISO week of the meal.
+        slot (int): Index of the meal slot in slots.SLOTS.
+
+    Returns:
+        str: Line including its newline.
+    """
+    return f'{int(when.timestamp() * 1000)},{rfid_code},{user_id},{year},{week},{slot}\n'
+
+
+def read_journal_line(line):
+    """
+    Parses a journal line, with or without the ISO year field.
+
+    Args:
+        line (str): Line of a journal.
+
+    Returns:
+        tuple: (admitted datetime, rfid_code, user_id, year, week, slot), or None if the line is malformed.
+    """
+    fields = line.rstrip('\n').split(',')
+    try:
+        if len(fields) == 6:
+            timestamp, rfid_code, user_id, year, week, slot = fields
+            when = datetime.fromtimestamp(int(timestamp) / 1000)
+        elif len(fields) == 5:
+            timestamp, rfid_code, user_id, week, slot = fields
+            when = datetime.fromtimestamp(int(timestamp) / 1000)
+            year = when.isocalendar()[0]
+        else:
+            return None
+        return when, rfid_code, int(user_id), int(year), int(week), int(slot)
+    except ValueError:
+        return None
+
+
+class OfflineGate:
+    """
+    Validates swipes against a memory-mapped snapshot and journals admissions.
+
+    Args:
+        snapshot_path (str): Snapshot written by gate_offline.export_snapshot().
+        journal_path (str): Append-only admission journal, created if missing.
+        durable (bool): fsync the journal after every admission.
+    """
+
+    def __init__(self, snapshot_path, journal_path, durable=False):
+        self._file = open(snapshot_path, 'rb')
+        self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, self.year, self.week, self.count, self.generated, checksum = \
+            HEADER.unpack_from(self._map, 0)
+        if magic != SNAPSHOT_MAGIC or version != SNAPSHOT_VERSION:
+            self.close()
+            raise ValueError(f'{snapshot_path} is not a version {SNAPSHOT_VERSION} gate snapshot')
+        if len(self._map) != HEADER.size + self.count * RECORD.size:
+            self.close()
+            raise ValueError(f'{snapshot_path} is truncated')
+        self._checksum = checksum
+
+        # Students already admitted to a slot of this week, so a card cannot be passed back
+        self._admitted = set()
+        if os.path.exists(journal_path):
+            with open(journal_path) as journal:
+                for entry in filter(None, map(read_journal_line, journal)):
+                    _, _, user_id, year, week, slot = entry
+                    if (year, week) == (self.year, self.week):
+                        self._admitted.add((user_id, slot))
+        self._journal = open(journal_path, 'a', buffering=1)
+        self._durable = durable
+
+    def verify(self):
+        """Returns True if the snapshot records match the header checksum."""
+        return zlib.crc32(self._map[HEADER.size:]) == self._checksum
+
+    def lookup(self, rfid_code):
+        """
+        Finds a card in the snapshot by binary search.
+
+        Args:
+            rfid_code (str): Card RFID code.
+
+        Returns:
+            tuple: (user_id, meal_slots), or None if the card is unknown.
+        """
+        key = snapshot_key(rfid_code)
+        low, high = 0, self.count
+        while low < high:
+            middle = (low + high) // 2
+            offset = HEADER.size + middle * RECORD.size
+            current = self._map[offset:offset + RFID_LENGTH]
+            if current < key:
+                low = middle + 1
+            elif current > key:
+                high = middle
+            else:
+                _, user_id, meal_slots = RECORD.unpack_from(self._map, offset)
+                return user_id, meal_slots
+        return None
+
+    def check(self, rfid_code, when=None):
+        """
+        Decides whether a card may enter now and journals the admission.
+
+        Args:
+            rfid_code (str): Card RFID code.
+            when (datetime, optional): Time of the swipe, defaults to now.
+
+        Returns:
+            dict: Verdict in the same shape as gate.check(), with the extra
+            reasons 'stale_snapshot' and 'already_admitted'.
+        """
+        when = when or datetime.now()
+        verdict = {'granted': False, 'reason': 'unknown_card', 'user_id': None, 'meal': None, 'day': None}
+        if tuple(when.isocalendar()[:2]) != (self.year, self.week):
+            verdict['reason'] = 'stale_snapshot'
+            return verdict
+
+        entry = self.lookup(rfid_code)
+        if entry is None:
+            return verdict
+        user_id, meal_slots = entry
+        verdict['user_id'] = user_id
+
+        index = slots.slot_at(when)
+        if index is None:
+            verdict['reason'] = 'no_meal'
+            return verdict
+        verdict['meal'], verdict['day'] = slots.SLOTS[index]
+
+        if not meal_slots >> index & 1:
+            verdict['reason'] = 'not_booked'
+        elif (user_id, index) in self._admitted:
+            verdict['reason'] = 'already_admitted'
+        else:
+            self._admitted.add((user_id, index))
+            self._journal.write(journal_line(when, rfid_code, user_id, self.year, self.week, index))
+            if self._durable:
+                os.fsync(self._journal.fileno())
+            verdict['granted'] = True
+            verdict['reason'] = 'booked'
+        return verdict
+
+    def close(self):
+        """Releases the snapshot mapping and closes the journal."""
+        if getattr(self, '_journal', None):
+            self._journal.close()
+        self._map.close()
+        self._file.close()
+
+
+def main(argv=None):
+    """Runs a gate that reads one RFID code per line from standard input."""
+    argv = sys.argv[1:] if argv is None else argv
+    if len(argv) != 2:
+        print('usage: python website/gate_snapshot.py SNAPSHOT JOURNAL', file=sys.stderr)
+        return 2
+
+    gate = OfflineGate(argv[0], argv[1])
+    print(f'Loaded {gate.count} cards for week {gate.week} of {gate.year}', file=sys.stderr)
+    try:
+        for line in sys.stdin:
+            rfid_code = line.strip()
+            if rfid_code:
+                verdict = gate.check(rfid_code)
+                print('GRANTED' if verdict['granted'] else 'DENIED', verdict['reason'], flush=True)
+    finally:
+        gate.close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
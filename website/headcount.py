@@ -0,0 +1,244 @@
+"""
+Pre-aggregated meal head-counts for the kitchen.
+
+`Meal_Count` keeps one row per (ISO year, week, meal, day) holding the number of students
+booked for that slot. Every code path that changes a booking calls
+`apply_change()` before committing, so the counts are updated in the same
+transaction as the booking itself and the manager pages read at most 19 rows per
+week, however many students there are.
+
+`rebuild()` recomputes the counts from the Booking table and reports any drift;
+it backs the `flask rebuild-meal-counts` command.
+
+`touch()` increments the week's `Week_Revision` counter in the same
+transaction as every booking change (capacity.change(), promotions, the
+rollover and account removal), so a reader can tell whether a week's bookings
+changed with one point query; the API's booking page ETags are built from it.
+
+Functions:
+- live_totals(year, week): Per-slot head-counts summed from Booking in one query.
+- weekly_totals(year, week): Per-slot head-counts read from Meal_Count.
+- apply_totals(year, week, deltas): Adds per-slot deltas to the counts of a week.
+- apply_change(year, week, old_slots, new_slots): Adjusts the counts for a booking change.
+- rebuild(year=None, week=None, check_only=False): Recomputes the counts from Booking.
+- touch(year, week): Counts a change to the bookings of a week.
+- revision(year, week): Number of changes counted for a week.
+- tenant_totals(year, week): Bookings and head-counts of a week in every tenant, read in parallel.
+"""
+
+from datetime import date
+from time import perf_counter
+from flask import current_app
+from sqlalchemy import func, update
+from sqlalchemy.exc import IntegrityError
+from . import db
+from . import slots
+from . import tenants
+from .models import Booking, Meal_Count, Week_Revision
+
+
+def live_totals(year, week):
+    """
+    Sums the head-count of every meal slot for a week directly from Booking,
+    using integer bit operations on the meal_slots bitmap.
+
+    Args:
+        year (int): ISO year.
+        week (int): ISO week number.
+
+    Returns:
+        list: SLOT_COUNT head-counts in slots.SLOTS order.
+    """
+    columns = [func.coalesce(func.sum(Booking.meal_slots.op('>>')(index).op('&')(1)), 0)
+               for index in range(slots.SLOT_COUNT)]
+    return list(db.session.query(*columns).filter(Booking.year == year, Booking.week == week).one())
+
+
+def weekly_totals(year, week):
+    """
+    Reads the pre-aggregated head-count of every meal slot for a week.
+
+    Args:
+        year (int): ISO year.
+        week (int): ISO week number.
+
+    Returns:
+        list: SLOT_COUNT head-counts in slots.SLOTS order.
+    """
+    totals = [0] * slots.SLOT_COUNT
+    rows = (db.session.query(Meal_Count.meal, Meal_Count.day, Meal_Count.head_count)
+            .filter(Meal_Count.year == year, Meal_Count.week == week))
+    for meal, day, head_count in rows:
+        index = slots.SLOT_INDEX.get((meal, day))
+        if index is not None:
+            totals[index] = head_count
+    return totals
+
+
+def ensure_week(year, week):
+    """
+    Creates any missing Meal_Count rows for a week so later updates only ever
+    increment existing rows, with the MEAL_CAPACITY default capacity. Safe
+    against concurrent callers.
+
+    Args:
+        year (int): ISO year.
+        week (int): ISO week number.
+    """
+    existing = {(meal, day) for meal, day in
+                db.session.query(Meal_Count.meal, Meal_Count.day)
+                .filter(Meal_Count.year == year, Meal_Count.week == week)}
+    for meal, day in slots.SLOTS:
+        if (meal, day) in existing:
+            continue
+        try:
+            with db.session.begin_nested():
+                db.session.add(Meal_Count(year=year, week=week, meal=meal, day=day, head_count=0,
+                                          capacity=current_app.config.get('MEAL_CAPACITY')))
+        except IntegrityError:
+            # Another request created the row first
+            pass
+
+
+def apply_totals(year, week, deltas):
+    """
+    Adds per-slot deltas to the head-counts of a week, issuing one UPDATE per
+    changed slot however many bookings the deltas cover. Does not commit.
+
+    Args:
+        year (int): ISO year.
+        week (int): ISO week number.
+        deltas (list): SLOT_COUNT signed head-count changes in slots.SLOTS order.
+    """
+    if not any(deltas):
+        return
+    ensure_week(year, week)
+    for (meal, day), delta in zip(slots.SLOTS, deltas):
+        if not delta:
+            continue
+        db.session.execute(
+            update(Meal_Count)
+            .where(Meal_Count.year == year, Meal_Count.week == week, Meal_Count.meal == meal, Meal_Count.day == day)
+            .values(head_count=Meal_Count.head_count + delta)
+        )
+
+
+def touch(year, week):
+    """
+    Counts a change to the bookings of a week, creating its counter on first
+    use. Safe against concurrent callers. Does not commit.
+
+    Args:
+        year (int): ISO year.
+        week (int): ISO week number.
+    """
+    bump = (update(Week_Revision).where(Week_Revision.year == year, Week_Revision.week == week)
+            .values(revision=Week_Revision.revision + 1))
+    if db.session.execute(bump).rowcount:
+        return
+    try:
+        with db.session.begin_nested():
+            db.session.add(Week_Revision(year=year, week=week, revision=1))
+    except IntegrityError:
+        # Another transaction created the counter first
+        db.session.execute(bump)
+
+
+def revision(year, week):
+    """
+    Returns the number of changes counted for a week.
+
+    Args:
+        year (int): ISO year.
+        week (int): ISO week number.
+
+    Returns:
+        int: Revision, 0 if the week's bookings never changed since counting began.
+    """
+    return db.session.query(Week_Revision.revision).filter(
+        Week_Revision.year == year, Week_Revision.week == week).scalar() or 0
+
+
+def apply_change(year, week, old_slots, new_slots):
+    """
+    Adjusts the head-counts of a week for a booking whose slots changed from
+    old_slots to new_slots. Does not commit; call it in the same transaction as
+    the booking change.
+
+    Args:
+        year (int): ISO year of the booking.
+        week (int): ISO week number of the booking.
+        old_slots (int): Slot bitmap before the change, 0 for a new booking.
+        new_slots (int): Slot bitmap after the change, 0 for a deleted booking.
+    """
+    old_slots = old_slots or 0
+    new_slots = new_slots or 0
+    apply_totals(year, week, [(new_slots >> index & 1) - (old_slots >> index & 1) for index in range(slots.SLOT_COUNT)])
+
+
+def rebuild(year=None, week=None, check_only=False):
+    """
+    Recomputes Meal_Count from Booking and reports slots whose stored count
+    differs from the live count.
+
+    Args:
+        year (int, optional): ISO year of the week to rebuild.
+        week (int, optional): Only rebuild this week of the given year (the
+            current ISO year if omitted); every booked week otherwise.
+        check_only (bool): Report differences without writing them.
+
+    Returns:
+        list: (year, week, meal, day, stored, live) tuples for every mismatch found.
+    """
+    if week is None:
+        weeks = set(db.session.query(Booking.year, Booking.week).distinct().tuples())
+        weeks |= set(db.session.query(Meal_Count.year, Meal_Count.week).distinct().tuples())
+    else:
+        weeks = {(year or date.today().isocalendar()[0], week)}
+
+    mismatches = []
+    for current_year, current_week in sorted(key for key in weeks if None not in key):
+        stored = weekly_totals(current_year, current_week)
+        live = live_totals(current_year, current_week)
+        for (meal, day), stored_count, live_count in zip(slots.SLOTS, stored, live):
+            if stored_count != live_count:
+                mismatches.append((current_year, current_week, meal, day, stored_count, live_count))
+
+        if not check_only:
+            ensure_week(current_year, current_week)
+            for (meal, day), live_count in zip(slots.SLOTS, live):
+                db.session.execute(
+                    update(Meal_Count)
+                    .where(Meal_Count.year == current_year, Meal_Count.week == current_week,
+                           Meal_Count.meal == meal, Meal_Count.day == day)
+                    .values(head_count=live_count)
+                )
+            db.session.commit()
+    return mismatches
+
+
+def tenant_totals(year, week):
+    """
+    Reads a week's booking count and head-counts from every tenant's database,
+    one thread per tenant (see tenants.gather()), for weeks not yet archived.
+    Must be called inside an application context.
+
+    Args:
+        year (int): ISO year.
+        week (int): ISO week number.
+
+    Returns:
+        dict: 'tenants' (tenant name to {'bookings', 'meals'}, meals in
+        slots.SLOTS order), 'total' (the same summed over tenants) and
+        'seconds' (time taken).
+    """
+    def read():
+        bookings = db.session.query(func.count(Booking.booking_id)).filter(
+            Booking.year == year, Booking.week == week).scalar()
+        return {'bookings': bookings, 'meals': weekly_totals(year, week)}
+
+    started = perf_counter()
+    per_tenant = tenants.gather(read)
+    total = {'bookings': sum(totals['bookings'] for totals in per_tenant.values()),
+             'meals': [sum(counts) for counts in zip(*(totals['meals'] for totals in per_tenant.values()))]}
+    return {'tenants': per_tenant, 'total': total, 'seconds': perf_counter() - started}
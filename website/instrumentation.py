@@ -0,0 +1,279 @@
+"""
+Opt-in per-request instrumentation, slow-request log and Prometheus metrics.
+
+When INSTRUMENTATION is enabled, `init_app()` hooks the app so that every
+request records its wall time, the number of SQL statements and the time
+spent in the database, the template render time and its endpoint. The
+request is flagged as a likely N+1 when the same relationship is lazy-loaded
+(e.g. `Booking.user_booking_relationship` inside a loop) or the same
+statement runs N_PLUS_ONE_THRESHOLD times or more. Requests slower than
+SLOW_REQUEST_MS, and flagged ones, are written as JSON lines to a rotating
+log. Aggregate histograms per endpoint are served in the Prometheus text
+format at /metrics to a logged-in manager, or to a scraper sending
+`Authorization: Bearer <METRICS_TOKEN>`.
+
+Configuration (app.config):
+- INSTRUMENTATION: Enables the hooks (default off).
+- SLOW_REQUEST_MS: Slow-request threshold in milliseconds (default 500).
+- SLOW_REQUEST_LOG: Log file (default slow_requests.log in the instance folder).
+- SLOW_REQUEST_LOG_BYTES, SLOW_REQUEST_LOG_BACKUPS: Rotation size and count.
+- N_PLUS_ONE_THRESHOLD: Repeats of one query that flag an N+1 (default 5).
+- METRICS_TOKEN: Bearer token accepted at /metrics (optional).
+
+Classes:
+- Histogram: Cumulative-bucket histogram with Prometheus label support.
+- RequestMetrics: Per-process aggregates of the recorded requests.
+
+Functions:
+- init_app(app): Installs the hooks and the /metrics route when enabled.
+"""
+
+import json
+import logging
+import os
+from collections import Counter
+from logging.handlers import RotatingFileHandler
+from threading import Lock
+from time import perf_counter, time
+from flask import abort, current_app, g, has_request_context, request, template_rendered, before_render_template
+from flask_login import current_user
+from sqlalchemy import event
+from . import db
+
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+STATEMENT_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500)
+
+slow_log = logging.getLogger('samam.slow_requests')
+
+
+class Histogram:
+    """
+    Cumulative-bucket histogram, one series per label value.
+
+    Args:
+        name (str): Metric name.
+        help_text (str): HELP line.
+        buckets (tuple): Upper bounds, ascending.
+        label (str): Label name distinguishing series.
+    """
+
+    def __init__(self, name, help_text, buckets, label='endpoint'):
+        self.name = name
+        self.help_text = help_text
+        self.buckets = buckets
+        self.label = label
+        self._series = {}
+
+    def observe(self, label_value, value):
+        """Adds one observation; the caller holds the metrics lock."""
+        counts, total = self._series.get(label_value, ([0] * (len(self.buckets) + 1), 0.0))
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                counts[i] += 1
+        counts[-1] += 1
+        self._series[label_value] = (counts, total + value)
+
+    def render(self):
+        """Formats the histogram in the Prometheus text exposition format."""
+        lines = [f'# HELP {self.name} {self.help_text}', f'# TYPE {self.name} histogram']
+        for label_value, (counts, total) in sorted(self._series.items()):
+            label = f'{self.label}="{label_value}"'
+            for bound, count in zip(self.buckets, counts):
+                lines.append(f'{self.name}_bucket{{{label},le="{bound}"}} {count}')
+            lines.append(f'{self.name}_bucket{{{label},le="+Inf"}} {counts[-1]}')
+            lines.append(f'{self.name}_sum{{{label}}} {total:.6f}')
+            lines.append(f'{self.name}_count{{{label}}} {counts[-1]}')
+        return lines
+
+
+class RequestMetrics:
+    """Per-process aggregates of the requests recorded by the hooks."""
+
+    def __init__(self):
+        self._lock = Lock()
+        self.histograms = (
+            Histogram('samam_request_duration_seconds', 'Wall time per request.', DURATION_BUCKETS),
+            Histogram('samam_request_db_seconds', 'Time spent executing SQL per request.', DURATION_BUCKETS),
+            Histogram('samam_request_template_seconds', 'Template render time per request.', DURATION_BUCKETS),
+            Histogram('samam_request_sql_statements', 'SQL statements per request.', STATEMENT_BUCKETS),
+        )
+        self.slow = Counter()
+        self.n_plus_one = Counter()
+
+    def record(self, endpoint, stats, slow, flagged):
+        """
+        Adds a finished request to the aggregates.
+
+        Args:
+            endpoint (str): Endpoint name.
+            stats (dict): Output of the request stats ('seconds', 'db_seconds', ...).
+            slow (bool): Whether the request exceeded SLOW_REQUEST_MS.
+            flagged (bool): Whether an N+1 pattern was detected.
+        """
+        values = (stats['seconds'], stats['db_seconds'], stats['template_seconds'], stats['sql_statements'])
+        with self._lock:
+            for histogram, value in zip(self.histograms, values):
+                histogram.observe(endpoint, value)
+            self.slow[endpoint] += slow
+            self.n_plus_one[endpoint] += flagged
+
+    def render(self):
+        """
+        Formats every metric in the Prometheus text exposition format.
+
+        Returns:
+            str: Metrics page body.
+        """
+        with self._lock:
+            lines = []
+            for histogram in self.histograms:
+                lines.extend(histogram.render())
+            for name, help_text, counter in (
+                    ('samam_slow_requests_total', 'Requests slower than SLOW_REQUEST_MS.', self.slow),
+                    ('samam_n_plus_one_requests_total', 'Requests flagged with an N+1 query pattern.', self.n_plus_one)):
+                lines += [f'# HELP {name} {help_text}', f'# TYPE {name} counter']
+                lines += [f'{name}{{endpoint="{endpoint}"}} {count}' for endpoint, count in sorted(counter.items())]
+        return '\n'.join(lines) + '\n'
+
+
+metrics = RequestMetrics()
+
+
+def _stats():
+    """Stats of the current request, or None outside an instrumented request."""
+    return g.get('request_stats') if has_request_context() else None
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    stats = _stats()
+    if stats is not None:
+        stats['sql_statements'] += 1
+        stats['statements'][statement] += 1
+        context.query_started = perf_counter()
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    stats = _stats()
+    if stats is not None and hasattr(context, 'query_started'):
+        stats['db_seconds'] += perf_counter() - context.query_started
+
+
+def _orm_execute(orm_execute_state):
+    stats = _stats()
+    if stats is not None and orm_execute_state.is_relationship_load and orm_execute_state.lazy_loaded_from:
+        path = orm_execute_state.loader_strategy_path
+        prop = path[-1] if path and len(path) % 2 == 0 else None
+        key = str(prop) if prop is not None else orm_execute_state.lazy_loaded_from.class_.__name__
+        stats['lazy_loads'][key] += 1
+
+
+def _template_started(sender, template, context, **extra):
+    stats = _stats()
+    if stats is not None:
+        stats['template_started'].append(perf_counter())
+
+
+def _template_rendered(sender, template, context, **extra):
+    stats = _stats()
+    if stats is not None and stats['template_started']:
+        started = stats['template_started'].pop()
+        # Only the outermost template counts, includes are part of its time
+        if not stats['template_started']:
+            stats['template_seconds'] += perf_counter() - started
+
+
+def _start_request():
+    g.request_stats = {
+        'started': perf_counter(),
+        'sql_statements': 0,
+        'db_seconds': 0.0,
+        'template_seconds': 0.0,
+        'template_started': [],
+        'statements': Counter(),
+        'lazy_loads': Counter(),
+    }
+
+
+def _finish_request(response):
+    stats = g.pop('request_stats', None)
+    if stats is None:
+        return response
+    config = current_app.config
+    threshold = config['N_PLUS_ONE_THRESHOLD']
+    seconds = perf_counter() - stats['started']
+    endpoint = request.endpoint or 'unmatched'
+
+    # Any repeated lazy load is an N+1; repeated identical statements past the threshold likely are
+    suspects = [{'lazy_load': key, 'count': count} for key, count in stats['lazy_loads'].items() if count > 1]
+    suspects += [{'statement': statement, 'count': count}
+                 for statement, count in stats['statements'].items() if count >= threshold]
+    slow = seconds * 1000 >= config['SLOW_REQUEST_MS']
+
+    summary = {
+        'seconds': seconds,
+        'db_seconds': stats['db_seconds'],
+        'template_seconds': stats['template_seconds'],
+        'sql_statements': stats['sql_statements'],
+    }
+    metrics.record(endpoint, summary, slow, bool(suspects))
+
+    if slow or suspects:
+        slow_log.warning(json.dumps({
+            'time': time(),
+            'endpoint': endpoint,
+            'method': request.method,
+            'path': request.path,
+            'status': response.status_code,
+            **summary,
+            'slow': slow,
+            'n_plus_one': suspects,
+        }))
+    return response
+
+
+def _metrics_view():
+    token = current_app.config.get('METRICS_TOKEN')
+    if token and request.headers.get('Authorization') == f'Bearer {token}':
+        pass
+    elif not (current_user.is_authenticated and current_user.role == 'manager'):
+        abort(403)
+    return metrics.render(), 200, {'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'}
+
+
+def init_app(app):
+    """
+    Installs the request, SQL and template hooks, the rotating slow-request
+    log and the /metrics route, if INSTRUMENTATION is enabled.
+
+    Args:
+        app (Flask): Application built by create_app().
+    """
+    if not app.config.get('INSTRUMENTATION'):
+        return
+    app.config.setdefault('SLOW_REQUEST_MS', 500)
+    app.config.setdefault('N_PLUS_ONE_THRESHOLD', 5)
+    app.config.setdefault('SLOW_REQUEST_LOG_BYTES', 10 * 1024 * 1024)
+    app.config.setdefault('SLOW_REQUEST_LOG_BACKUPS', 5)
+
+    if not slow_log.handlers:
+        log_path = app.config.get('SLOW_REQUEST_LOG') or os.path.join(app.instance_path, 'slow_requests.log')
+        os.makedirs(os.path.dirname(log_path) or '.', exist_ok=True)
+        handler = RotatingFileHandler(log_path, maxBytes=app.config['SLOW_REQUEST_LOG_BYTES'],
+                                      backupCount=app.config['SLOW_REQUEST_LOG_BACKUPS'])
+        handler.setFormatter(logging.Formatter('%(message)s'))
+        slow_log.addHandler(handler)
+        slow_log.setLevel(logging.INFO)
+        slow_log.propagate = False
+
+    with app.app_context():
+        for engine in db.engines.values():
+            event.listen(engine, 'before_cursor_execute', _before_cursor_execute)
+            event.listen(engine, 'after_cursor_execute', _after_cursor_execute)
+    if not event.contains(db.session, 'do_orm_execute', _orm_execute):
+        event.listen(db.session, 'do_orm_execute', _orm_execute)
+    before_render_template.connect(_template_started, app)
+    template_rendered.connect(_template_rendered, app)
+
+    app.before_request(_start_request)
+    app.after_request(_finish_request)
+    app.add_url_rule('/metrics', 'metrics', _metrics_view)
@@ -0,0 +1,157 @@
+"""
+Weekly menu storage helpers and the rendered-menu cache.
+
+`Weekly_menu.menu_content` holds the menu as JSON, one object per meal mapping
+lower-case day names to dishes, and (`Weekly_menu.year`, `Weekly_menu.week`) is
+unique so a week's menu is a single indexed lookup.
+
+The student menu page is the most viewed page of the app and only changes when
+a manager saves a menu, so `MenuCache` keeps, per (ISO year, ISO week), the rendered HTML table
+and the JSON body served by the menu endpoints, with the menu's row version
+for API ETags. Hits do no database or template work for the menu itself.
+Saving a menu invalidates its week in this process; other worker processes
+pick it up within MENU_CACHE_TTL seconds (default 300). The weeks come from the
+query string, so the cache is an LRU map of at most MENU_CACHE_SIZE weeks
+(default 64) and the routes answer 400 for pairs that name no ISO week.
+
+Configuration (app.config):
+- MENU_CACHE_SIZE: Maximum number of cached weeks (default 64).
+- MENU_CACHE_TTL: Seconds a cached menu stays valid (default 300).
+
+Classes:
+- MenuCache: Per-week cache of rendered menu fragments.
+
+Functions:
+- parse_menu(menu_content): Decodes stored menu content.
+- meal_schedule(menu): Expands a menu to every day of the week for display.
+"""
+
+import ast
+import json
+from collections import OrderedDict
+from threading import Lock
+from time import monotonic
+from flask import current_app, render_template
+from . import db
+from . import tenants
+from . import slots
+
+
+def parse_menu(menu_content):
+    """
+    Decodes stored menu content, accepting the JSON format and the Python dict
+    repr written before menus were stored as JSON.
+
+    Args:
+        menu_content (str): Value of Weekly_menu.menu_content.
+
+    Returns:
+        dict: Meal name to {day: dish}; empty if the content is unreadable.
+    """
+    if not menu_content:
+        return {}
+    try:
+        menu = json.loads(menu_content)
+    except ValueError:
+        try:
+            menu = ast.literal_eval(menu_content)
+        except (ValueError, SyntaxError):
+            return {}
+    return menu if isinstance(menu, dict) else {}
+
+
+def meal_schedule(menu):
+    """
+    Expands a menu so every meal lists all seven days, in week order.
+
+    Args:
+        menu (dict): Meal name to {day: dish}.
+
+    Returns:
+        dict: Meal name to {day: dish or ''} for the days Monday to Sunday.
+    """
+    return {meal: {day: (dishes or {}).get(day) or '' for day in slots.DAYS}
+            for meal, dishes in menu.items()}
+
+
+class MenuCache:
+    """LRU cache of the rendered menu table and its JSON body, keyed by week."""
+
+    def __init__(self):
+        self._lock = Lock()
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, year, week):
+        """
+        Returns the cached menu of a week, rendering it on a miss.
+
+        Args:
+            year (int): ISO year.
+            week (int): ISO week number.
+
+        Returns:
+            dict: 'html' (rendered table, empty if no menu is published),
+            'json' (encoded body of the menu endpoint) and 'version' (row
+            version of the menu, 0 if none is published).
+        """
+        ttl = current_app.config.get('MENU_CACHE_TTL', 300)
+        now = monotonic()
+        with self._lock:
+            entry = self._entries.get((year, week))
+            if entry is not None and now - entry[1] < ttl:
+                self._entries.move_to_end((year, week))
+                self.hits += 1
+                return entry[0]
+            self.misses += 1
+
+        from .models import Weekly_menu
+
+        row = db.session.query(Weekly_menu.menu_content, Weekly_menu.version).filter(
+            Weekly_menu.year == year, Weekly_menu.week == week).first()
+        content, version = row if row else (None, 0)
+        menu = parse_menu(content)
+        rendered = {
+            'html': render_template('menu_table.html', meal_schedule=meal_schedule(menu)) if menu else '',
+            'json': json.dumps({'year': year, 'week': week, 'menu': menu}),
+            'version': version,
+        }
+        size = current_app.config.get('MENU_CACHE_SIZE', 64)
+        with self._lock:
+            self._entries[(year, week)] = (rendered, now)
+            self._entries.move_to_end((year, week))
+            while len(self._entries) > size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+        return rendered
+
+    def invalidate(self, year=None, week=None):
+        """
+        Drops one week, or every week, from the cache.
+
+        Args:
+            year (int, optional): ISO year of the week to drop.
+            week (int, optional): ISO week to drop; all weeks if omitted.
+        """
+        with self._lock:
+            if week is None:
+                self._entries.clear()
+            else:
+                self._entries.pop((year, week), None)
+
+    def stats(self):
+        """
+        Returns the cache counters.
+
+        Returns:
+            dict: 'hits', 'misses', 'evictions' and 'size'.
+        """
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                    'size': len(self._entries)}
+
+
+# Process-wide caches used by the menu pages, one per tenant
+menus = tenants.PerTenant(MenuCache)
@@ -0,0 +1,352 @@
+"""
+Explicit schema migrations for existing databases.
+
+`db.create_all()` creates missing tables but never alters a table that already
+exists, so columns and indexes added to the models after a database was created
+are applied here instead. Each migration runs once and is recorded in the
+`schema_migration` table; every step also checks the live schema first so it is
+safe on databases that `create_all()` already built with the new layout.
+`create_app()` issues no DDL, so this is also how a new database is created.
+
+Run pending migrations with:
+
+    flask --app main migrate
+
+which migrates every tenant's database in turn (see tenants.py), or one with
+`--tenant NAME`.
+
+Functions:
+- migration(name): Decorator registering a migration step.
+- upgrade(): Creates missing tables and applies pending migrations.
+"""
+
+import json
+from datetime import date, datetime, timedelta
+from sqlalchemy import MetaData, inspect, text
+from . import db
+from . import slots
+from . import tenants
+
+# Registered (name, function) pairs, applied in definition order
+MIGRATIONS = []
+
+
+def migration(name):
+    """
+    Registers a migration step.
+
+    Args:
+        name (str): Unique, ordered name such as '0001_booking_meal_slots'.
+
+    Returns:
+        function: Decorator that records the step and returns it unchanged.
+    """
+    def register(function):
+        MIGRATIONS.append((name, function))
+        return function
+    return register
+
+
+def has_column(connection, table, column):
+    """Returns True if the given table already has the given column."""
+    return any(info['name'] == column for info in inspect(connection).get_columns(table))
+
+
+def has_index(connection, table, index):
+    """Returns True if the given table already has the given index."""
+    return any(info['name'] == index for info in inspect(connection).get_indexes(table))
+
+
+@migration('0001_booking_meal_slots')
+def booking_meal_slots(connection):
+    """Adds Booking.meal_slots and converts legacy meal_type strings into it."""
+    if not has_column(connection, 'booking', 'meal_slots'):
+        connection.execute(text('ALTER TABLE booking ADD COLUMN meal_slots INTEGER NOT NULL DEFAULT 0'))
+
+    rows = connection.execute(text(
+        'SELECT booking_id, meal_type FROM booking WHERE meal_type IS NOT NULL AND meal_slots = 0'
+    )).fetchall()
+    updates = [{'booking_id': booking_id, 'meal_slots': slots.parse_legacy(meal_type)}
+               for booking_id, meal_type in rows]
+    if updates:
+        connection.execute(text('UPDATE booking SET meal_slots = :meal_slots WHERE booking_id = :booking_id'), updates)
+
+
+@migration('0002_meal_count_backfill')
+def meal_count_backfill(connection):
+    """Fills the new Meal_Count table from the bookings already on record."""
+    from .models import Meal_Count
+
+    table = Meal_Count.__tablename__
+    if has_column(connection, table, 'year'):
+        # Built with the (year, week) layout; 0008_iso_year fills it
+        return
+    if connection.execute(text(f'SELECT COUNT(*) FROM {table}')).scalar():
+        return
+    for index, (meal, day) in enumerate(slots.SLOTS):
+        connection.execute(text(
+            f'INSERT INTO {table} (week, meal, day, head_count) '
+            'SELECT week, :meal, :day, SUM((meal_slots >> :index) & 1) FROM booking '
+            'WHERE week IS NOT NULL GROUP BY week'
+        ), {'meal': meal, 'day': day, 'index': index})
+
+
+@migration('0003_gate_indexes')
+def gate_indexes(connection):
+    """Indexes Access_Card.rfid_code and Booking (user, week) for the access gate."""
+    from .models import Access_Card
+
+    table = Access_Card.__tablename__
+    if not has_index(connection, table, f'ix_{table}_rfid_code'):
+        connection.execute(text(f'CREATE INDEX ix_{table}_rfid_code ON {table} (rfid_code)'))
+    if not has_index(connection, 'booking', 'ix_booking_user_week') and not has_column(connection, 'booking', 'year'):
+        connection.execute(text('CREATE INDEX ix_booking_user_week ON booking (user_booking_id_fk, week)'))
+
+
+@migration('0004_weekly_menu_json')
+def weekly_menu_json(connection):
+    """Keeps the latest menu of each week, stores menus as JSON and makes week unique."""
+    from .menu_cache import parse_menu
+
+    connection.execute(text(
+        'DELETE FROM weekly_menu WHERE menu_id NOT IN (SELECT MAX(menu_id) FROM weekly_menu GROUP BY week)'
+    ))
+    rows = connection.execute(text('SELECT menu_id, menu_content FROM weekly_menu')).fetchall()
+    updates = [{'menu_id': menu_id, 'menu_content': json.dumps(parse_menu(menu_content))}
+               for menu_id, menu_content in rows]
+    if updates:
+        connection.execute(text('UPDATE weekly_menu SET menu_content = :menu_content WHERE menu_id = :menu_id'),
+                           updates)
+    if not any(index['unique'] and index['column_names'] == ['week']
+               for index in inspect(connection).get_indexes('weekly_menu')):
+        connection.execute(text('CREATE UNIQUE INDEX uq_weekly_menu_week ON weekly_menu (week)'))
+
+
+@migration('0005_modification_log_diffs')
+def modification_log_diffs(connection):
+    """Adds the slot diff columns and the (booking, date) index to Booking_Modification_Log."""
+    from .models import Booking_Modification_Log
+
+    table = Booking_Modification_Log.__tablename__
+    for column in ('slots_added', 'slots_removed'):
+        if not has_column(connection, table, column):
+            connection.execute(text(f'ALTER TABLE {table} ADD COLUMN {column} INTEGER NOT NULL DEFAULT 0'))
+    if not has_index(connection, table, 'ix_modification_log_booking_date'):
+        connection.execute(text(
+            f'CREATE INDEX ix_modification_log_booking_date ON {table} (log_booking_fk, modification_date)'
+        ))
+
+
+@migration('0006_booking_page_indexes')
+def booking_page_indexes(connection):
+    """Indexes Booking (week, user) and User.surname for the paginated bookings view."""
+    if not has_index(connection, 'booking', 'ix_booking_week_user') and not has_column(connection, 'booking', 'year'):
+        connection.execute(text('CREATE INDEX ix_booking_week_user ON booking (week, user_booking_id_fk)'))
+    if not has_index(connection, 'user', 'ix_user_surname'):
+        connection.execute(text('CREATE INDEX ix_user_surname ON user (surname)'))
+
+
+@migration('0007_reminder_delivery')
+def reminder_delivery(connection):
+    """Adds Reminder.sent_date and indexes Reminder.date for the reminder scheduler."""
+    if not has_column(connection, 'reminder', 'sent_date'):
+        connection.execute(text('ALTER TABLE reminder ADD COLUMN sent_date DATETIME'))
+    if not has_index(connection, 'reminder', 'ix_reminder_date'):
+        connection.execute(text('CREATE INDEX ix_reminder_date ON reminder (date)'))
+
+
+@migration('0008_iso_year')
+def iso_year(connection):
+    """
+    Keys bookings and head-counts by (ISO year, ISO week). Existing bookings are
+    given this year if their week is not after next week, and last year otherwise.
+    """
+    from .models import ARCHIVE_TABLES, Booking, Meal_Count
+
+    next_year, next_week = (date.today() + timedelta(days=7)).isocalendar()[:2]
+    if not has_column(connection, 'booking', 'year'):
+        connection.execute(text('ALTER TABLE booking ADD COLUMN year INTEGER NOT NULL DEFAULT 0'))
+        connection.execute(text(
+            'UPDATE booking SET year = CASE WHEN week <= :week THEN :year ELSE :year - 1 END'
+        ), {'year': next_year, 'week': next_week})
+    for old_index in ('ix_booking_user_week', 'ix_booking_week_user'):
+        if has_index(connection, 'booking', old_index):
+            connection.execute(text(f'DROP INDEX {old_index}'))
+    for index in Booking.__table__.indexes:
+        # The unique (user, year, week) index waits for 0010_booking_capacity to merge duplicates
+        if not index.unique and not has_index(connection, 'booking', index.name):
+            index.create(connection)
+
+    archived = ARCHIVE_TABLES[Booking].name
+    if inspect(connection).has_table(archived) and not has_column(connection, archived, 'year'):
+        connection.execute(text(f'ALTER TABLE {archived} ADD COLUMN year INTEGER'))
+
+    # Head-counts are derived data: rebuild the table with its new unique key and refill it
+    table = Meal_Count.__tablename__
+    if not has_column(connection, table, 'year'):
+        Meal_Count.__table__.drop(connection)
+        Meal_Count.__table__.create(connection)
+    connection.execute(text(f'DELETE FROM {table}'))
+    for index, (meal, day) in enumerate(slots.SLOTS):
+        connection.execute(text(
+            f'INSERT INTO {table} (year, week, meal, day, head_count) '
+            'SELECT year, week, :meal, :day, SUM((meal_slots >> :index) & 1) FROM booking '
+            'WHERE week IS NOT NULL GROUP BY year, week'
+        ), {'meal': meal, 'day': day, 'index': index})
+
+
+@migration('0009_admission_year')
+def admission_year(connection):
+    """Adds Admission.year, filled from the admission date, and indexes (year, week, slot) for forecasting."""
+    from .models import ARCHIVE_TABLES, Admission
+
+    for table in (Admission.__tablename__, ARCHIVE_TABLES[Admission].name):
+        if not inspect(connection).has_table(table) or has_column(connection, table, 'year'):
+            continue
+        connection.execute(text(f'ALTER TABLE {table} ADD COLUMN year INTEGER'))
+        rows = connection.execute(text(f'SELECT admission_id, admitted_date FROM {table}')).fetchall()
+        updates = [{'admission_id': admission_id, 'year': datetime.fromisoformat(str(admitted_date)).isocalendar()[0]}
+                   for admission_id, admitted_date in rows if admitted_date]
+        if updates:
+            connection.execute(text(f'UPDATE {table} SET year = :year WHERE admission_id = :admission_id'), updates)
+
+    table = Admission.__tablename__
+    if has_index(connection, table, 'ix_admission_week_slot'):
+        connection.execute(text('DROP INDEX ix_admission_week_slot'))
+    for index in Admission.__table__.indexes:
+        if not has_index(connection, table, index.name):
+            index.create(connection)
+
+
+@migration('0010_booking_capacity')
+def booking_capacity(connection):
+    """
+    Adds Meal_Count.capacity and makes Booking (user, year, week) unique. A
+    student's duplicate bookings of a week are merged into the latest one and
+    the week's head-counts recomputed.
+    """
+    from .models import Booking, Booking_Modification_Log, Meal_Count
+
+    table = Meal_Count.__tablename__
+    if not has_column(connection, table, 'capacity'):
+        connection.execute(text(f'ALTER TABLE {table} ADD COLUMN capacity INTEGER'))
+
+    duplicates = connection.execute(text(
+        'SELECT user_booking_id_fk, year, week, MAX(booking_id) FROM booking '
+        'WHERE user_booking_id_fk IS NOT NULL GROUP BY user_booking_id_fk, year, week HAVING COUNT(*) > 1'
+    )).fetchall()
+    log_table = Booking_Modification_Log.__tablename__
+    for user_id, year, week, kept in duplicates:
+        key = {'user_id': user_id, 'year': year, 'week': week, 'kept': kept}
+        merged = 0
+        for (meal_slots,) in connection.execute(text(
+                'SELECT meal_slots FROM booking WHERE user_booking_id_fk = :user_id AND year = :year '
+                'AND week = :week'), key):
+            merged |= meal_slots or 0
+        connection.execute(text(
+            f'UPDATE {log_table} SET log_booking_fk = :kept WHERE log_booking_fk IN (SELECT booking_id FROM booking '
+            'WHERE user_booking_id_fk = :user_id AND year = :year AND week = :week AND booking_id != :kept)'
+        ), key)
+        connection.execute(text(
+            'DELETE FROM booking WHERE user_booking_id_fk = :user_id AND year = :year AND week = :week '
+            'AND booking_id != :kept'
+        ), key)
+        connection.execute(text('UPDATE booking SET meal_slots = :meal_slots WHERE booking_id = :kept'),
+                           {'meal_slots': merged, 'kept': kept})
+
+    for year, week in {(year, week) for _, year, week, _ in duplicates}:
+        for index, (meal, day) in enumerate(slots.SLOTS):
+            connection.execute(text(
+                f'UPDATE {table} SET head_count = (SELECT COALESCE(SUM((meal_slots >> :index) & 1), 0) FROM booking '
+                'WHERE year = :year AND week = :week) '
+                'WHERE year = :year AND week = :week AND meal = :meal AND day = :day'
+            ), {'index': index, 'year': year, 'week': week, 'meal': meal, 'day': day})
+
+    if has_index(connection, 'booking', 'ix_booking_user_year_week'):
+        connection.execute(text('DROP INDEX ix_booking_user_year_week'))
+    for index in Booking.__table__.indexes:
+        if not has_index(connection, 'booking', index.name):
+            index.create(connection)
+
+
+@migration('0011_row_versions')
+def row_versions(connection):
+    """Adds the version column of Booking and Weekly_menu, and of the archived bookings, for API ETags."""
+    from .models import ARCHIVE_TABLES, Booking, Weekly_menu
+
+    for table in (Booking.__tablename__, Weekly_menu.__tablename__, ARCHIVE_TABLES[Booking].name):
+        if inspect(connection).has_table(table) and not has_column(connection, table, 'version'):
+            connection.execute(text(f'ALTER TABLE {table} ADD COLUMN version INTEGER NOT NULL DEFAULT 1'))
+
+
+@migration('0012_weekly_menu_year')
+def weekly_menu_year(connection):
+    """
+    Keys menus by (ISO year, ISO week), like bookings. Existing menus are given
+    this year if their week is not after next week, and last year otherwise.
+    The unique key on week alone goes, with the foreign key from Booking.week
+    that relied on it; SQLite cannot drop a unique column constraint, so there
+    the table is copied into a new one with the new key.
+    """
+    from .models import Weekly_menu
+
+    table = Weekly_menu.__tablename__
+    next_year, next_week = (date.today() + timedelta(days=7)).isocalendar()[:2]
+    if not has_column(connection, table, 'year'):
+        connection.execute(text(f'ALTER TABLE {table} ADD COLUMN year INTEGER'))
+        connection.execute(text(
+            f'UPDATE {table} SET year = CASE WHEN week <= :week THEN :year ELSE :year - 1 END'
+        ), {'year': next_year, 'week': next_week})
+
+    sqlite = connection.dialect.name == 'sqlite'
+    if not sqlite:
+        # SQLite does not enforce foreign keys here, so its booking table keeps the inert declaration
+        for foreign_key in inspect(connection).get_foreign_keys('booking'):
+            if foreign_key['referred_table'] == table and foreign_key['name']:
+                connection.execute(text(f'ALTER TABLE booking DROP CONSTRAINT {foreign_key["name"]}'))
+    if has_index(connection, table, 'uq_weekly_menu_week'):
+        connection.execute(text('DROP INDEX uq_weekly_menu_week'))
+
+    week_only = [constraint['name'] for constraint in inspect(connection).get_unique_constraints(table)
+                 if constraint['column_names'] == ['week']]
+    if week_only and sqlite:
+        columns = ', '.join(column.name for column in Weekly_menu.__table__.columns)
+        Weekly_menu.__table__.to_metadata(MetaData(), name=f'{table}_new').create(connection)
+        connection.execute(text(f'INSERT INTO {table}_new ({columns}) SELECT {columns} FROM {table}'))
+        connection.execute(text(f'DROP TABLE {table}'))
+        connection.execute(text(f'ALTER TABLE {table}_new RENAME TO {table}'))
+    elif week_only:
+        for name in week_only:
+            connection.execute(text(f'ALTER TABLE {table} DROP CONSTRAINT {name}'))
+    for index in Weekly_menu.__table__.indexes:
+        if not has_index(connection, table, index.name):
+            index.create(connection)
+
+
+def upgrade():
+    """
+    Creates missing tables and applies every pending migration, each in its own
+    transaction, in the current tenant's database (see tenants.using()). Must be
+    called inside an application context.
+
+    Returns:
+        list: Names of the migrations applied by this call.
+    """
+    # Import models so create_all() knows about every table
+    from .models import Schema_Migration
+
+    engine = tenants.engine()
+    db.metadata.create_all(engine)
+    applied = {name for (name,) in db.session.query(Schema_Migration.migration_name)}
+    db.session.remove()
+
+    newly_applied = []
+    for name, function in MIGRATIONS:
+        if name in applied:
+            continue
+        with engine.begin() as connection:
+            function(connection)
+            connection.execute(Schema_Migration.__table__.insert().values(
+                migration_name=name, applied_date=datetime.now()))
+        newly_applied.append(name)
+    return newly_applied
@@ -8,6 +8,19 @@ Classes:
 - Access_Card: Represents an access card associated with a user.
 - Reminder: Represents a reminder associated with a user.
 - Booking_Modification_Log: Represents a log entry for modifications made to bookings by users.
+- Schema_Migration: Records which schema migrations have been applied.
+- Meal_Count: Represents the number of students booked for one meal on one day of a week.
+- Admission: Represents a student admitted to a meal at the dining-hall gate.
+- Standing_Order: Represents a student's opt-in to repeat their last booking every week.
+- Waitlist: Represents a student waiting for a seat at a full meal.
+- Week_Revision: Counts the changes made to the bookings of a week.
+
+Functions:
+- archive_table(model): Builds the archive copy of a model's table.
+- insert_ignoring_duplicates(connection, table): INSERT that skips rows violating a unique constraint.
+
+Tables:
+- ARCHIVE_TABLES: archived_<table> copies receiving the rows of removed accounts.
 
 Attributes:
 - user_id: Unique identifier for a user.
@@ -19,11 +32,14 @@ Attributes:
 - role: Role of the user in the system.
 - booking_id: Unique identifier for a booking.
 - user_booking_id_fk: Foreign key referencing the user who made the booking.
-- week: Week number for the booking.
-- meal_type: Type of meal booked.
+- year: ISO year of the week of a booking or menu.
+- week: Week number for the booking or menu.
+- meal_type: Legacy stringified list of meals booked, superseded by meal_slots.
+- meal_slots: Bitmap of the meal slots booked, see website/slots.py.
 - status: Status of the booking.
 - menu_id: Unique identifier for a weekly menu.
-- menu_content: Content of the weekly menu.
+- menu_content: Content of the weekly menu as JSON, see website/menu_cache.py.
+- version: Row version of a booking or menu, incremented on every update and used for API ETags, see website/api.py.
 - card_id: Unique identifier for an access card.
 - user_card_id_fk: Foreign key referencing the user associated with the access card.
 - rfid_code: RFID code associated with the access card.
@@ -31,11 +47,31 @@ Attributes:
 - user__reminder_fk: Foreign key referencing the user associated with the reminder.
 - reminder_type: Type of reminder.
 - date: Date and time of the reminder.
+- sent_date: Date and time the reminder was delivered, empty until then.
 - log_entry_id: Unique identifier for a log entry in the booking modification log.
 - log_booking_fk: Foreign key referencing the booking associated with the log entry.
 - log_user_id_fk: Foreign key referencing the user associated with the log entry.
 - modification_date: Date and time of the modification.
 - modification_text: Text describing the modification.
+- slots_added: Bitmap of the meal slots added by a modification.
+- slots_removed: Bitmap of the meal slots removed by a modification.
+- count_id: Unique identifier for a meal count.
+- head_count: Number of students booked for the meal.
+- capacity: Seats available for the meal, unlimited when empty.
+- admission_id: Unique identifier for a gate admission.
+- admission_user_fk: Foreign key referencing the user admitted.
+- slot: Index of the meal slot admitted to, see website/slots.py.
+- admitted_date: Date and time of the admission.
+- source: Where the admission was recorded ('online' or 'offline').
+- order_id: Unique identifier for a standing order.
+- user_standing_fk: Foreign key referencing the user who opted in.
+- active: Whether the standing order is in effect.
+- created_date: Date and time the standing order or waitlist entry was created.
+- waitlist_id: Unique identifier for a waitlist entry.
+- user_waitlist_fk: Foreign key referencing the user waiting.
+- revision: Number of changes made to the bookings of a week.
+- migration_name: Name of an applied schema migration.
+- applied_date: Date and time the migration was applied.
 """
 
 from . import db
@@ -47,7 +83,7 @@ class User(db.Model, UserMixin):
     
     user_id = db.Column(db.Integer, primary_key=True)
     initials = db.Column(db.String(5))
-    surname = db.Column(db.String(50))
+    surname = db.Column(db.String(50), index=True)
     username = db.Column(db.String(100))
     password = db.Column(db.String(255))
     email = db.Column(db.String(255))
@@ -66,29 +102,38 @@ class Booking(db.Model, UserMixin):
     
     booking_id = db.Column(db.Integer, primary_key=True)
     user_booking_id_fk = db.Column(db.Integer, db.ForeignKey('user.user_id'))
-    week = db.Column(db.Integer, db.ForeignKey('weekly_menu.week'))
+    year = db.Column(db.Integer, nullable=False)
+    week = db.Column(db.Integer)
     meal_type = db.Column(db.String(20))
+    meal_slots = db.Column(db.Integer, nullable=False, default=0)
     status = db.Column(db.String(20))
+    version = db.Column(db.Integer, nullable=False, default=1)
     user_booking_relationship = db.relationship('User')
+    __table_args__ = (db.Index('uq_booking_user_year_week', 'user_booking_id_fk', 'year', 'week', unique=True),
+                      db.Index('ix_booking_year_week_user', 'year', 'week', 'user_booking_id_fk'))
+    __mapper_args__ = {'version_id_col': version}
     
     def __repr__(self):
         """Representation of the Booking object."""
-        return f'[{self.user_booking_id_fk}, {self.meal_type}]'
+        return f'[{self.user_booking_id_fk}, {self.meal_slots:#07x}]'
 
 class Weekly_menu(db.Model, UserMixin):
     """Model representing weekly menus."""
     
     menu_id = db.Column(db.Integer, primary_key=True)
-    week = db.Column(db.Integer)
-    menu_content = db.Column(db.String(1000))
-    Weekly_menu_booking_relationship = db.relationship('Booking')
+    year = db.Column(db.Integer, nullable=False)
+    week = db.Column(db.Integer, nullable=False)
+    menu_content = db.Column(db.Text)
+    version = db.Column(db.Integer, nullable=False, default=1)
+    __table_args__ = (db.Index('uq_weekly_menu_year_week', 'year', 'week', unique=True),)
+    __mapper_args__ = {'version_id_col': version}
 
 class Access_Card(db.Model, UserMixin):
     """Model representing access cards."""
     
     card_id = db.Column(db.Integer, primary_key=True)
     user_card_id_fk = db.Column(db.Integer, db.ForeignKey('user.user_id'))
-    rfid_code = db.Column(db.String(20))
+    rfid_code = db.Column(db.String(20), index=True)
     card_user_relationship = db.relationship('User')
 
 class Reminder(db.Model, UserMixin):
@@ -97,7 +142,8 @@ class Reminder(db.Model, UserMixin):
     reminder_id = db.Column(db.Integer, primary_key=True)
     user__reminder_fk = db.Column(db.Integer, db.ForeignKey('user.user_id'))
     reminder_type = db.Column(db.String(20))
-    date = db.Column(db.DateTime(timezone=True), default=func.now())
+    date = db.Column(db.DateTime(timezone=True), default=func.now(), index=True)
+    sent_date = db.Column(db.DateTime(timezone=True))
     reminder_user_relationship = db.relationship("User")
 
 class Booking_Modification_Log(db.Model, UserMixin):
@@ -108,5 +154,123 @@ class Booking_Modification_Log(db.Model, UserMixin):
     log_user_id_fk = db.Column(db.Integer, db.ForeignKey('user.user_id'))
     modification_date = db.Column(db.DateTime(timezone=True), default=func.now())
     modification_text = db.Column(db.String(10000))
+    slots_added = db.Column(db.Integer, nullable=False, default=0)
+    slots_removed = db.Column(db.Integer, nullable=False, default=0)
     modification_user_relationship = db.relationship("User")
     modification_booking_relationship = db.relationship("Booking")
+    
+    # A booking's history is read in date order
+    __table_args__ = (db.Index('ix_modification_log_booking_date', 'log_booking_fk', 'modification_date'),)
+
+class Schema_Migration(db.Model):
+    """Model recording schema migrations applied by `flask migrate`."""
+    
+    migration_name = db.Column(db.String(100), primary_key=True)
+    applied_date = db.Column(db.DateTime(timezone=True), default=func.now())
+
+class Meal_Count(db.Model):
+    """Model holding the pre-aggregated head-count of each (year, week, day, meal), see website/headcount.py."""
+    
+    count_id = db.Column(db.Integer, primary_key=True)
+    year = db.Column(db.Integer, nullable=False)
+    week = db.Column(db.Integer, nullable=False)
+    meal = db.Column(db.String(20), nullable=False)
+    day = db.Column(db.String(20), nullable=False)
+    head_count = db.Column(db.Integer, nullable=False, default=0)
+    capacity = db.Column(db.Integer)
+    __table_args__ = (db.UniqueConstraint('year', 'week', 'meal', 'day', name='uq_meal_count_year_week_meal_day'),)
+
+class Admission(db.Model):
+    """Model representing a student admitted to a meal at the dining-hall gate."""
+    
+    admission_id = db.Column(db.Integer, primary_key=True)
+    admission_user_fk = db.Column(db.Integer, db.ForeignKey('user.user_id'))
+    rfid_code = db.Column(db.String(20))
+    year = db.Column(db.Integer)
+    week = db.Column(db.Integer)
+    slot = db.Column(db.Integer)
+    admitted_date = db.Column(db.DateTime(timezone=True), default=func.now())
+    source = db.Column(db.String(20))
+    admission_user_relationship = db.relationship("User")
+    __table_args__ = (
+        db.UniqueConstraint('rfid_code', 'admitted_date', name='uq_admission_card_date'),
+        db.Index('ix_admission_year_week_slot', 'year', 'week', 'slot'),
+    )
+
+class Standing_Order(db.Model):
+    """Model representing a student's opt-in to repeat their last booking every week."""
+    
+    order_id = db.Column(db.Integer, primary_key=True)
+    user_standing_fk = db.Column(db.Integer, db.ForeignKey('user.user_id'), unique=True)
+    active = db.Column(db.Boolean, nullable=False, default=True)
+    created_date = db.Column(db.DateTime(timezone=True), default=func.now())
+    standing_user_relationship = db.relationship("User")
+
+class Waitlist(db.Model):
+    """Model representing a student waiting for a seat at a full meal slot, see website/capacity.py."""
+    
+    waitlist_id = db.Column(db.Integer, primary_key=True)
+    user_waitlist_fk = db.Column(db.Integer, db.ForeignKey('user.user_id'))
+    year = db.Column(db.Integer, nullable=False)
+    week = db.Column(db.Integer, nullable=False)
+    slot = db.Column(db.Integer, nullable=False)
+    created_date = db.Column(db.DateTime(timezone=True), default=func.now())
+    waitlist_user_relationship = db.relationship("User")
+    __table_args__ = (
+        db.UniqueConstraint('user_waitlist_fk', 'year', 'week', 'slot', name='uq_waitlist_user_slot'),
+        db.Index('ix_waitlist_year_week_slot', 'year', 'week', 'slot', 'waitlist_id'),
+    )
+
+class Week_Revision(db.Model):
+    """Model counting the changes made to the bookings of a week, for API ETags, see website/headcount.py."""
+    
+    revision_id = db.Column(db.Integer, primary_key=True)
+    year = db.Column(db.Integer, nullable=False)
+    week = db.Column(db.Integer, nullable=False)
+    revision = db.Column(db.Integer, nullable=False, default=0)
+    __table_args__ = (db.UniqueConstraint('year', 'week', name='uq_week_revision_year_week'),)
+
+
+def archive_table(model):
+    """
+    Builds the archive copy of a model's table: the same columns without keys or
+    constraints, a surrogate archive_id and the date the row was archived.
+
+    Args:
+        model (db.Model): Model to archive.
+
+    Returns:
+        Table: archived_<table name> table.
+    """
+    table = model.__table__
+    return db.Table(f'archived_{table.name}',
+                    db.Column('archive_id', db.Integer, primary_key=True),
+                    *[db.Column(column.name, column.type) for column in table.columns],
+                    db.Column('archived_date', db.DateTime(timezone=True)))
+
+
+def insert_ignoring_duplicates(connection, table):
+    """
+    Builds an INSERT for a table that silently skips rows violating one of its
+    unique constraints, e.g. a swipe or booking that was already written.
+
+    Args:
+        connection (Connection): Connection or session the statement runs on, for its dialect.
+        table (Table): Table to insert into.
+
+    Returns:
+        Insert: INSERT ... ON CONFLICT DO NOTHING, or INSERT IGNORE on MySQL.
+    """
+    dialect = connection.get_bind().dialect.name if hasattr(connection, 'get_bind') else connection.dialect.name
+    if dialect == 'sqlite':
+        from sqlalchemy.dialects.sqlite import insert
+        return insert(table).on_conflict_do_nothing()
+    if dialect == 'postgresql':
+        from sqlalchemy.dialects.postgresql import insert
+        return insert(table).on_conflict_do_nothing()
+    return table.insert().prefix_with('IGNORE')
+
+# Archive tables receiving the rows of removed accounts, see website/deletion.py
+ARCHIVE_TABLES = {model: archive_table(model) for model in
+                  (User, Booking, Access_Card, Reminder, Booking_Modification_Log, Admission, Standing_Order,
+                   Waitlist)}
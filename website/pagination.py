@@ -0,0 +1,151 @@
+"""
+Keyset pagination of a week's bookings for the manager.
+
+Pages are ordered by (year, week, student ID, booking ID) and continue from the last
+row of the previous page (`after` cursor) instead of skipping rows with an
+OFFSET, so with the (year, week, user_booking_id_fk) index every page costs the same
+however deep into the cohort it is. Filters are applied in SQL:
+
+- meal and day: a bitmask test on Booking.meal_slots (see slots.py);
+- surname: a case-sensitive prefix match, written as a range so it can use the
+  index on User.surname.
+
+Weeks moved to the archive (see week_archive.py) are paged the same way from
+their archive file, with names joined from User one page at a time.
+
+Functions:
+- encode_cursor(user_id, booking_id): Cursor continuing after a row.
+- decode_cursor(cursor): Parses a cursor back into its key.
+- booking_page(year, week, meal=None, day=None, surname=None, after=None, limit=50): One page of bookings.
+"""
+
+from sqlalchemy import and_, or_, select
+from . import db
+from . import slots
+from . import week_archive
+from .models import Booking, User
+
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 500
+
+
+def encode_cursor(user_id, booking_id):
+    """
+    Builds the cursor continuing after a row.
+
+    Args:
+        user_id (int): Student ID of the row.
+        booking_id (int): Booking ID of the row.
+
+    Returns:
+        str: Opaque cursor such as '42:1093'.
+    """
+    return f'{user_id}:{booking_id}'
+
+
+def decode_cursor(cursor):
+    """
+    Parses a cursor produced by encode_cursor().
+
+    Args:
+        cursor (str): Cursor from a previous page.
+
+    Returns:
+        tuple: (user_id, booking_id).
+
+    Raises:
+        ValueError: If the cursor is malformed.
+    """
+    user_id, booking_id = cursor.split(':')
+    return int(user_id), int(booking_id)
+
+
+def _archived_page(year, week, mask, surname, after, limit):
+    """Fetches limit + 1 archived rows as (booking_id, user_id, initials, surname, meal_slots)."""
+    mask = mask if mask != slots.FULL_MASK else None
+    if surname:
+        # Walk the matching students in ID order, a chunk of IDs per archive query
+        user_ids = list(db.session.execute(
+            select(User.user_id).where(User.surname >= surname, User.surname < surname + '\U0010ffff',
+                                       User.user_id >= (after[0] if after else 0))
+            .order_by(User.user_id)).scalars())
+        rows = []
+        for start in range(0, len(user_ids), 500):
+            rows += week_archive.booking_rows(year, week, mask, user_ids[start:start + 500], after,
+                                              limit + 1 - len(rows))
+            if len(rows) > limit:
+                break
+    else:
+        rows = list(week_archive.booking_rows(year, week, mask, after=after, limit=limit + 1))
+
+    names = {user_id: (initials, student_surname) for user_id, initials, student_surname in db.session.execute(
+        select(User.user_id, User.initials, User.surname).where(User.user_id.in_({row[1] for row in rows})))}
+    return [(booking_id, user_id, *names.get(user_id, (None, None)), meal_slots)
+            for booking_id, user_id, meal_slots in rows]
+
+
+def booking_page(year, week, meal=None, day=None, surname=None, after=None, limit=DEFAULT_PAGE_SIZE):
+    """
+    Fetches one page of a week's bookings.
+
+    Args:
+        year (int): ISO year.
+        week (int): ISO week number.
+        meal (str, optional): Only bookings including this meal.
+        day (str, optional): Only bookings including a meal on this day.
+        surname (str, optional): Only students whose surname starts with this.
+        after (str, optional): Cursor of the previous page.
+        limit (int, optional): Page size, capped at MAX_PAGE_SIZE.
+
+    Returns:
+        dict: 'bookings' (list of dicts with booking_id, user_id, initials,
+            surname, meal_slots) and 'next' (cursor of the following page, or None).
+
+    Raises:
+        ValueError: If a filter or the cursor is invalid.
+    """
+    if meal and meal not in slots.MEALS:
+        raise ValueError(f'Unknown meal {meal!r}')
+    if day and day not in slots.DAYS:
+        raise ValueError(f'Unknown day {day!r}')
+    limit = max(1, min(int(limit), MAX_PAGE_SIZE))
+
+    query = (select(Booking.booking_id, Booking.user_booking_id_fk, User.initials, User.surname, Booking.meal_slots)
+             .join(User, User.user_id == Booking.user_booking_id_fk)
+             .where(Booking.year == year, Booking.week == week))
+
+    # Keep bookings sharing at least one slot with the requested meal and/or day
+    mask = slots.FULL_MASK
+    if meal:
+        mask &= slots.meal_mask(meal)
+    if day:
+        mask &= slots.day_mask(day)
+    if not mask:
+        return {'bookings': [], 'next': None}
+    after = decode_cursor(after) if after else None
+
+    # One extra row tells whether a next page exists
+    if week_archive.is_archived(year, week):
+        rows = _archived_page(year, week, mask, surname, after, limit)
+    else:
+        if mask != slots.FULL_MASK:
+            query = query.where(Booking.meal_slots.op('&')(mask) != 0)
+
+        if surname:
+            query = query.where(User.surname >= surname, User.surname < surname + '\U0010ffff')
+
+        if after:
+            user_id, booking_id = after
+            query = query.where(or_(Booking.user_booking_id_fk > user_id,
+                                    and_(Booking.user_booking_id_fk == user_id, Booking.booking_id > booking_id)))
+
+        rows = db.session.execute(
+            query.order_by(Booking.user_booking_id_fk, Booking.booking_id).limit(limit + 1)
+        ).all()
+    page = rows[:limit]
+    return {
+        'bookings': [{'booking_id': booking_id, 'user_id': user_id, 'initials': initials,
+                      'surname': surname, 'meal_slots': meal_slots}
+                     for booking_id, user_id, initials, surname, meal_slots in page],
+        'next': encode_cursor(page[-1][1], page[-1][0]) if len(rows) > limit else None,
+    }
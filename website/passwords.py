@@ -0,0 +1,216 @@
+"""
+Salted, adaptive password hashing.
+
+Passwords are stored as self-describing strings so the cost can be raised per
+deployment without invalidating existing accounts:
+
+- scrypt:         'scrypt$<n>$<r>$<p>$<salt>$<hash>'
+- PBKDF2-SHA256:  'pbkdf2_sha256$<iterations>$<salt>$<hash>'
+
+Salt and hash are URL-safe base64. Rows written before hashing was introduced
+hold the plain password; they still verify and are rehashed on the next login,
+as are hashes made with an older method or cost. Only values without a hash
+prefix are compared as plain text, so a malformed hash never matches.
+
+Configuration (app.config):
+- PASSWORD_HASH_METHOD: 'scrypt' (default) or 'pbkdf2_sha256'.
+- PASSWORD_SCRYPT_COST: log2 of the scrypt work factor N (default 14, at least 10).
+- PASSWORD_PBKDF2_ITERATIONS: PBKDF2 iteration count (default 600000, at least 100000).
+- PASSWORD_WORKERS: Threads verifying passwords concurrently (default: one per
+  CPU). Both KDFs release the GIL, so the pool spreads logins across cores while
+  capping how many run at once.
+
+Functions:
+- hash_password(password, method=None, cost=None): Hashes a password.
+- hash_cost(method): The configured cost of a method.
+- verify_password(stored, password): Checks a password against a stored value.
+- needs_rehash(stored): Whether a stored value uses outdated parameters.
+- check_password(stored, password): verify_password() run on the worker pool.
+- hash_passwords(passwords): Hashes many passwords on the worker pool.
+"""
+
+import base64
+import hashlib
+import hmac
+import os
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+from flask import current_app, has_app_context
+
+DEFAULT_METHOD = 'scrypt'
+# Each method's cost setting, default and minimum: log2(N) for scrypt, iterations for PBKDF2
+COST_SETTINGS = {'scrypt': 'PASSWORD_SCRYPT_COST', 'pbkdf2_sha256': 'PASSWORD_PBKDF2_ITERATIONS'}
+DEFAULT_COSTS = {'scrypt': 14, 'pbkdf2_sha256': 600000}
+MIN_COSTS = {'scrypt': 10, 'pbkdf2_sha256': 100000}
+# First '$' field of stored values that are hashes, including other libraries' (e.g. 'pbkdf2:sha256:600000')
+HASH_PREFIXES = ('scrypt', 'pbkdf2')
+SCRYPT_R = 8
+SCRYPT_P = 1
+SALT_BYTES = 16
+HASH_BYTES = 64
+
+_pool = None
+_pool_lock = Lock()
+
+
+def _setting(name, default):
+    """Reads a setting from the app config when an app context is active."""
+    if has_app_context() and current_app.config.get(name) is not None:
+        return current_app.config[name]
+    return default
+
+
+def _encode(raw):
+    return base64.urlsafe_b64encode(raw).decode('ascii').rstrip('=')
+
+
+def _decode(text):
+    return base64.urlsafe_b64decode(text + '=' * (-len(text) % 4))
+
+
+def _scrypt(password, salt, n, r, p):
+    return hashlib.scrypt(password.encode('utf-8'), salt=salt, n=n, r=r, p=p,
+                          maxmem=256 * r * n, dklen=HASH_BYTES)
+
+
+def _pbkdf2(password, salt, iterations):
+    return hashlib.pbkdf2_hmac('sha256', password.encode('utf-8'), salt, iterations, dklen=HASH_BYTES)
+
+
+def hash_cost(method):
+    """
+    Returns the configured cost of a hash method.
+
+    Args:
+        method (str): 'scrypt' or 'pbkdf2_sha256'.
+
+    Returns:
+        int: log2(N) for scrypt, the iteration count for PBKDF2.
+
+    Raises:
+        ValueError: If the method is unknown.
+    """
+    if method not in COST_SETTINGS:
+        raise ValueError(f'Unknown password hash method {method!r}')
+    return _setting(COST_SETTINGS[method], DEFAULT_COSTS[method])
+
+
+def hash_password(password, method=None, cost=None):
+    """
+    Hashes a password with a fresh random salt.
+
+    Args:
+        password (str): Plain password.
+        method (str, optional): 'scrypt' or 'pbkdf2_sha256', defaults to
+            PASSWORD_HASH_METHOD.
+        cost (int, optional): log2(N) for scrypt or iterations for PBKDF2,
+            defaults to the method's setting.
+
+    Returns:
+        str: Self-describing hash string.
+
+    Raises:
+        ValueError: If the method is unknown or the cost below its minimum.
+    """
+    method = method or _setting('PASSWORD_HASH_METHOD', DEFAULT_METHOD)
+    cost = cost or hash_cost(method)
+    if cost < MIN_COSTS[method]:
+        raise ValueError(f'{method} cost {cost} is below the minimum of {MIN_COSTS[method]}')
+    salt = os.urandom(SALT_BYTES)
+    if method == 'scrypt':
+        n = 1 << cost
+        return f'scrypt${n}${SCRYPT_R}${SCRYPT_P}${_encode(salt)}${_encode(_scrypt(password, salt, n, SCRYPT_R, SCRYPT_P))}'
+    elif method == 'pbkdf2_sha256':
+        return f'pbkdf2_sha256${cost}${_encode(salt)}${_encode(_pbkdf2(password, salt, cost))}'
+    raise ValueError(f'Unknown password hash method {method!r}')
+
+
+def verify_password(stored, password):
+    """
+    Checks a password against a stored hash or legacy plain value, in constant
+    time with respect to the stored value.
+
+    Args:
+        stored (str): Value of User.password.
+        password (str): Password entered at login.
+
+    Returns:
+        bool: True if the password matches.
+    """
+    if not stored or password is None:
+        return False
+    fields = stored.split('$')
+    try:
+        if fields[0] == 'scrypt' and len(fields) == 6:
+            n, r, p = int(fields[1]), int(fields[2]), int(fields[3])
+            return hmac.compare_digest(_scrypt(password, _decode(fields[4]), n, r, p), _decode(fields[5]))
+        elif fields[0] == 'pbkdf2_sha256' and len(fields) == 4:
+            return hmac.compare_digest(_pbkdf2(password, _decode(fields[2]), int(fields[1])), _decode(fields[3]))
+    except ValueError:
+        return False
+    if '$' in stored and fields[0].split(':')[0] in HASH_PREFIXES:
+        # A hash this module cannot read, never a plain password
+        return False
+    # Legacy plain-text row
+    return hmac.compare_digest(stored.encode('utf-8'), password.encode('utf-8'))
+
+
+def needs_rehash(stored):
+    """
+    Tells whether a stored value should be replaced by a hash made with the
+    configured method and cost.
+
+    Args:
+        stored (str): Value of User.password.
+
+    Returns:
+        bool: True for legacy plain values and outdated parameters.
+    """
+    method = _setting('PASSWORD_HASH_METHOD', DEFAULT_METHOD)
+    cost = hash_cost(method)
+    fields = (stored or '').split('$')
+    if method == 'scrypt':
+        return not (fields[0] == 'scrypt' and len(fields) == 6
+                    and fields[1:4] == [str(1 << cost), str(SCRYPT_R), str(SCRYPT_P)])
+    return not (fields[0] == method and len(fields) == 4 and fields[1] == str(cost))
+
+
+def _get_pool():
+    """Creates the verification pool on first use."""
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            workers = _setting('PASSWORD_WORKERS', None) or os.cpu_count() or 1
+            _pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='password')
+        return _pool
+
+
+def check_password(stored, password):
+    """
+    Runs verify_password() on the worker pool, so no more than
+    PASSWORD_WORKERS hashes are computed at once.
+
+    Args:
+        stored (str): Value of User.password.
+        password (str): Password entered at login.
+
+    Returns:
+        bool: True if the password matches.
+    """
+    return _get_pool().submit(verify_password, stored, password).result()
+
+
+def hash_passwords(passwords):
+    """
+    Hashes many passwords in parallel on the worker pool, e.g. for bulk imports.
+    Must be called inside an application context to use the configured cost.
+
+    Args:
+        passwords (iterable): Plain passwords.
+
+    Returns:
+        list: Hash strings in input order.
+    """
+    method = _setting('PASSWORD_HASH_METHOD', DEFAULT_METHOD)
+    cost = hash_cost(method)
+    return list(_get_pool().map(lambda password: hash_password(password, method, cost), passwords))
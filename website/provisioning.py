@@ -0,0 +1,163 @@
+"""
+Bulk user provisioning for the accommodation office.
+
+A new intake is imported from a CSV file (with a header row) or a JSONL file
+(one JSON object per line), each row holding `initials`, `surname`, `email`,
+`password` and `role`. Rows are streamed, never loaded all at once, and
+processed in chunks: each chunk is validated with the same rules as the
+sign-up form, checked for existing emails with a single `IN` query, inserted
+with one bulk statement and committed. Passwords are hashed in parallel on the
+password worker pool (see passwords.py), which dominates the import time at
+production hash costs. Invalid rows are skipped and reported with their line
+number.
+
+Used by `/accommodation/import` and `flask import-users`.
+
+Functions:
+- validate_profile(...): First sign-up rule a profile breaks, if any.
+- read_rows(stream, filename): Yields (line, row) pairs from a CSV or JSONL stream.
+- import_users(rows, chunk_size=1000): Validates and inserts rows in chunks.
+"""
+
+import csv
+import io
+import json
+from time import perf_counter
+from . import db
+from .models import User
+from .passwords import hash_passwords
+
+# Rows validated, checked and inserted per transaction
+IMPORT_CHUNK_SIZE = 1000
+
+IMPORT_FIELDS = ('initials', 'surname', 'email', 'password', 'role')
+
+
+def validate_profile(initials, surname, email1, email2, password1, password2, role):
+    """
+    Checks a new profile against the sign-up rules, apart from the duplicate
+    email check which needs the database.
+
+    Args:
+        initials (str): User initials.
+        surname (str): User surname.
+        email1 (str): Email address.
+        email2 (str): Email address confirmation.
+        password1 (str): Password.
+        password2 (str): Password confirmation.
+        role (str): User role.
+
+    Returns:
+        str: Message for the first rule broken, or None if the profile is valid.
+    """
+    if len(initials or '') == 0:
+        return 'Enter valid initials'
+    elif len(surname or '') < 2:
+        return 'Enter valid surname'
+    elif email1 != email2:
+        return 'Emails do not match'
+    elif len(email1 or '') < 4:
+        return 'Enter valid email'
+    elif password1 != password2:
+        return 'Passwords do not match'
+    elif len(password1 or '') < 8:
+        return 'Password characters must be more than 7'
+    elif len(role or '') < 1:
+        return 'Enter valid role'
+    return None
+
+
+def read_rows(stream, filename=''):
+    """
+    Streams user rows from a CSV or JSONL file. The format is taken from the
+    file extension, defaulting to CSV.
+
+    Args:
+        stream (file): Binary or text file object.
+        filename (str, optional): Original file name, used to detect JSONL.
+
+    Yields:
+        tuple: (line number, row dict); the row is None for an unparseable line.
+    """
+    if isinstance(stream.read(0), bytes):
+        stream = io.TextIOWrapper(stream, encoding='utf-8-sig', newline='')
+
+    if filename.lower().endswith(('.jsonl', '.ndjson', '.json')):
+        for line_number, line in enumerate(stream, start=1):
+            if not line.strip():
+                continue
+            try:
+                row = json.loads(line)
+            except ValueError:
+                row = None
+            yield line_number, row if isinstance(row, dict) else None
+    else:
+        reader = csv.DictReader(stream)
+        for row in reader:
+            yield reader.line_num, row
+
+
+def _import_chunk(chunk, report):
+    """Validates, de-duplicates and inserts one chunk of (line, row) pairs."""
+    candidates = []
+    seen = set()
+    for line_number, row in chunk:
+        if row is None:
+            report['errors'].append((line_number, None, 'Unreadable row'))
+            continue
+        profile = {field: (str(row.get(field) or '')).strip() for field in IMPORT_FIELDS}
+        email = profile['email']
+        error = validate_profile(profile['initials'], profile['surname'], email, email,
+                                 profile['password'], profile['password'], profile['role'])
+        if error is None and email in seen:
+            error = 'Email appears more than once in the file'
+        if error:
+            report['errors'].append((line_number, email, error))
+            continue
+        seen.add(email)
+        candidates.append((line_number, profile))
+
+    # One set-based lookup for every email in the chunk
+    existing = {email for (email,) in
+                db.session.query(User.email).filter(User.email.in_([p['email'] for _, p in candidates]))}
+    new_users = []
+    for line_number, profile in candidates:
+        if profile['email'] in existing:
+            report['errors'].append((line_number, profile['email'], 'Email already exists.'))
+        else:
+            new_users.append(profile)
+
+    if new_users:
+        for profile, hashed in zip(new_users, hash_passwords(p['password'] for p in new_users)):
+            profile['password'] = hashed
+        db.session.execute(User.__table__.insert(), new_users)
+    db.session.commit()
+    report['created'] += len(new_users)
+
+
+def import_users(rows, chunk_size=IMPORT_CHUNK_SIZE):
+    """
+    Imports users from (line, row) pairs in batched transactions. Must be
+    called inside an application context.
+
+    Args:
+        rows (iterable): (line number, row dict) pairs, e.g. from read_rows().
+        chunk_size (int, optional): Rows per transaction.
+
+    Returns:
+        dict: 'created' count, 'errors' as (line, email, message) tuples,
+        'rows' processed and 'seconds' taken.
+    """
+    started = perf_counter()
+    report = {'created': 0, 'errors': [], 'rows': 0, 'seconds': 0.0}
+    chunk = []
+    for line_number, row in rows:
+        chunk.append((line_number, row))
+        report['rows'] += 1
+        if len(chunk) == chunk_size:
+            _import_chunk(chunk, report)
+            chunk = []
+    if chunk:
+        _import_chunk(chunk, report)
+    report['seconds'] = perf_counter() - started
+    return report
@@ -0,0 +1,423 @@
+"""
+Reminder scheduling and delivery.
+
+Two kinds of `Reminder` rows are created for a week by `schedule_week()`:
+
+- 'book_next_week': sent to every student during the previous week at
+  REMINDER_BOOKING_DAY / REMINDER_BOOKING_HOUR; students who have booked by then
+  are skipped at delivery.
+- 'meal_soon': sent REMINDER_MEAL_LEAD minutes before each meal a student booked.
+
+`ReminderScheduler` delivers them from a single background thread. It loads the
+unsent reminders due within REMINDER_HORIZON seconds with one query on the
+indexed `Reminder.date` column, keeps them in a heap ordered by due time and
+sleeps until the earliest one is due or the next reload, so the table is read
+once per half horizon instead of every second. Due reminders are handed to a
+thread pool in batches and marked sent (`Reminder.sent_date`) once delivered.
+Senders report each message as it goes out, so when a batch fails part way the
+messages already delivered are still marked sent; the rest stay unsent and are
+retried on the next reload.
+
+A 'meal_soon' reminder is only useful before its meal starts: after downtime,
+or on the first start, the ones whose meal has already started are marked sent
+without being sent, on loading and again at delivery.
+
+Messages go through a pluggable sender: `FileSender` appends them as JSON lines
+(for development and tests) and `SMTPSender` mails them, one SMTP connection per
+batch. Run the scheduler as its own process so several web workers don't send
+the same reminders:
+
+    flask --app main schedule-reminders
+    flask --app main run-reminders
+
+Configuration (app.config):
+- REMINDER_SENDER: 'file' (default) or 'smtp'.
+- REMINDER_FILE: Output of the file sender (default reminders.jsonl in the instance folder).
+- SMTP_HOST, SMTP_PORT, SMTP_USERNAME, SMTP_PASSWORD, SMTP_STARTTLS, MAIL_FROM: SMTP sender settings.
+- REMINDER_WORKERS: Delivery threads (default 16).
+- REMINDER_BATCH_SIZE: Reminders per delivery batch (default 100).
+- REMINDER_HORIZON: Seconds of due reminders held in memory (default 600).
+- REMINDER_MEAL_LEAD: Minutes before a meal its reminder is sent (default 30).
+- REMINDER_BOOKING_DAY, REMINDER_BOOKING_HOUR: When the booking reminder is
+  sent in the week before (default Thursday, 12).
+
+Classes:
+- FileSender: Writes messages to a JSON lines file.
+- SMTPSender: Sends messages by email.
+- ReminderScheduler: Heap-based scheduler with a delivery worker pool.
+
+Functions:
+- make_sender(app): Builds the configured sender.
+- compose(reminder_type, due, lead_minutes=30): Subject and body of a reminder.
+- schedule_week(week, year=None): Creates the reminders for a week's meals.
+"""
+
+import heapq
+import json
+import os
+import smtplib
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime, timedelta
+from email.message import EmailMessage
+from threading import Condition, Lock, Thread
+from flask import current_app
+from sqlalchemy import select, update
+from . import db
+from . import slots
+from . import tenants
+from .models import Booking, Reminder, User
+
+BOOK_NEXT_WEEK = 'book_next_week'
+MEAL_SOON = 'meal_soon'
+
+
+class FileSender:
+    """
+    Appends messages to a JSON lines file instead of sending them.
+
+    Args:
+        path (str): Output file.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = Lock()
+
+    def send_many(self, messages, on_sent=None):
+        """
+        Writes a batch of messages.
+
+        Args:
+            messages (list): Dicts with 'to', 'subject' and 'body'.
+            on_sent (callable, optional): Called with the index of each message written.
+        """
+        lines = ''.join(json.dumps(message) + '\n' for message in messages)
+        with self._lock, open(self.path, 'a', encoding='utf-8') as output:
+            output.write(lines)
+        if on_sent:
+            for index in range(len(messages)):
+                on_sent(index)
+
+
+class SMTPSender:
+    """
+    Sends messages by email, one connection per batch.
+
+    Args:
+        host (str): SMTP server.
+        port (int): SMTP port.
+        sender (str): From address.
+        username (str, optional): Login name.
+        password (str, optional): Login password.
+        starttls (bool, optional): Upgrade the connection with STARTTLS.
+    """
+
+    def __init__(self, host, port, sender, username=None, password=None, starttls=True):
+        self.host = host
+        self.port = port
+        self.sender = sender
+        self.username = username
+        self.password = password
+        self.starttls = starttls
+
+    def send_many(self, messages, on_sent=None):
+        """
+        Sends a batch of messages over one SMTP connection.
+
+        Args:
+            messages (list): Dicts with 'to', 'subject' and 'body'.
+            on_sent (callable, optional): Called with the index of each message
+                accepted by the server, so a caller knows which ones went out
+                if the batch fails part way.
+        """
+        with smtplib.SMTP(self.host, self.port, timeout=30) as smtp:
+            if self.starttls:
+                smtp.starttls()
+            if self.username:
+                smtp.login(self.username, self.password)
+            for index, message in enumerate(messages):
+                email = EmailMessage()
+                email['From'] = self.sender
+                email['To'] = message['to']
+                email['Subject'] = message['subject']
+                email.set_content(message['body'])
+                smtp.send_message(email)
+                if on_sent:
+                    on_sent(index)
+
+
+def make_sender(app):
+    """
+    Builds the sender selected by REMINDER_SENDER.
+
+    Args:
+        app (Flask): Flask application.
+
+    Returns:
+        FileSender or SMTPSender: Configured sender.
+    """
+    config = app.config
+    if config.get('REMINDER_SENDER', 'file') == 'smtp':
+        return SMTPSender(config['SMTP_HOST'], config.get('SMTP_PORT', 587), config['MAIL_FROM'],
+                          config.get('SMTP_USERNAME'), config.get('SMTP_PASSWORD'),
+                          config.get('SMTP_STARTTLS', True))
+    return FileSender(config.get('REMINDER_FILE') or os.path.join(app.instance_path, 'reminders.jsonl'))
+
+
+def compose(reminder_type, due, lead_minutes=30):
+    """
+    Writes the subject and body of a reminder.
+
+    Args:
+        reminder_type (str): BOOK_NEXT_WEEK or MEAL_SOON.
+        due (datetime): When the reminder is due.
+        lead_minutes (int, optional): Minutes between a meal reminder and the meal.
+
+    Returns:
+        tuple: (subject, body).
+    """
+    if reminder_type == MEAL_SOON:
+        starts = due + timedelta(minutes=lead_minutes)
+        index = slots.slot_at(starts)
+        meal = slots.SLOTS[index][0] if index is not None else 'meal'
+        return (f'Your {meal} starts at {starts:%H:%M}',
+                f'Your {meal} is served from {starts:%H:%M} today. Bring your access card.')
+    week = _booked_week(due)[1]
+    return (f'Book your meals for week {week}',
+            f'You have not booked your meals for week {week} yet. Log in to SAMAM to book them.')
+
+
+def _booked_week(due):
+    """(ISO year, ISO week) a booking reminder due at a time asks students to book: the following week."""
+    return tuple((due + timedelta(days=7)).isocalendar()[:2])
+
+
+def schedule_week(week, year=None):
+    """
+    Creates the reminders for a week: one booking reminder per student in the
+    week before, and one reminder before every meal booked for the week.
+    Unsent reminders previously scheduled for the same week are replaced, so it
+    can be rerun after bookings change. Must be called inside an application context.
+
+    Args:
+        week (int): ISO week being booked.
+        year (int, optional): ISO year, defaults to the current one.
+
+    Returns:
+        dict: Number of reminders created per type.
+    """
+    config = current_app.config
+    year = year or date.today().isocalendar()[0]
+    monday = datetime.combine(date.fromisocalendar(year, week, 1), datetime.min.time())
+    lead = timedelta(minutes=config.get('REMINDER_MEAL_LEAD', 30))
+    booking_due = (monday - timedelta(days=7 - config.get('REMINDER_BOOKING_DAY', 3))
+                   + timedelta(hours=config.get('REMINDER_BOOKING_HOUR', 12)))
+    week_end = monday + timedelta(days=7)
+
+    # Replace what was scheduled for this week and not sent yet
+    db.session.execute(Reminder.__table__.delete().where(
+        Reminder.sent_date.is_(None),
+        ((Reminder.reminder_type == BOOK_NEXT_WEEK) & (Reminder.date == booking_due))
+        | ((Reminder.reminder_type == MEAL_SOON) & (Reminder.date >= monday - lead) & (Reminder.date < week_end))
+    ))
+
+    students = [user_id for (user_id,) in db.session.execute(select(User.user_id).where(User.role == 'student'))]
+    if students:
+        db.session.execute(Reminder.__table__.insert(), [
+            {'user__reminder_fk': user_id, 'reminder_type': BOOK_NEXT_WEEK, 'date': booking_due} for user_id in students
+        ])
+
+    # Start time of every slot in the week, less the lead time
+    slot_due = [monday + timedelta(days=slots.DAYS.index(day)) - lead
+                + timedelta(hours=slots.MEAL_TIMES[meal][0].hour, minutes=slots.MEAL_TIMES[meal][0].minute)
+                for meal, day in slots.SLOTS]
+    meal_count = 0
+    batch = []
+    for user_id, meal_slots in db.session.execute(
+            select(Booking.user_booking_id_fk, Booking.meal_slots).where(Booking.year == year, Booking.week == week)
+            .execution_options(yield_per=1000)):
+        batch.extend({'user__reminder_fk': user_id, 'reminder_type': MEAL_SOON, 'date': slot_due[index]}
+                     for index in range(slots.SLOT_COUNT) if meal_slots >> index & 1)
+        if len(batch) >= 5000:
+            db.session.execute(Reminder.__table__.insert(), batch)
+            meal_count += len(batch)
+            batch = []
+    if batch:
+        db.session.execute(Reminder.__table__.insert(), batch)
+        meal_count += len(batch)
+    db.session.commit()
+    return {BOOK_NEXT_WEEK: len(students), MEAL_SOON: meal_count}
+
+
+class ReminderScheduler:
+    """
+    Delivers due reminders from a heap, sleeping until the next one is due.
+
+    Args:
+        app (Flask): Flask application, used for database access.
+        sender (object, optional): Object with send_many(messages, on_sent),
+            defaults to make_sender(app).
+    """
+
+    def __init__(self, app, sender=None):
+        self.app = app
+        # Reminders of the tenant current when the scheduler is created
+        self.tenant = tenants.current()
+        self.sender = sender or make_sender(app)
+        self.horizon = timedelta(seconds=app.config.get('REMINDER_HORIZON', 600))
+        self.batch_size = app.config.get('REMINDER_BATCH_SIZE', 100)
+        self.lead_minutes = app.config.get('REMINDER_MEAL_LEAD', 30)
+        self._pool = ThreadPoolExecutor(max_workers=app.config.get('REMINDER_WORKERS', 16),
+                                        thread_name_prefix='reminder')
+        self._heap = []
+        self._queued = set()
+        self._lock = Lock()
+        self._wakeup = Condition()
+        self._stopping = False
+        self._reload_at = datetime.min
+        self._thread = None
+        self.sent = 0
+        self.failed = 0
+
+    def load(self, now=None):
+        """
+        Queues the unsent reminders due before now + horizon, first marking
+        sent the meal reminders whose meal has already started.
+
+        Args:
+            now (datetime, optional): Current time.
+
+        Returns:
+            int: Number of reminders newly queued.
+        """
+        now = now or datetime.now()
+        with self.app.app_context(), tenants.using(self.tenant):
+            expired = db.session.execute(
+                update(Reminder)
+                .where(Reminder.sent_date.is_(None), Reminder.reminder_type == MEAL_SOON,
+                       Reminder.date < now - timedelta(minutes=self.lead_minutes))
+                .values(sent_date=now)
+            ).rowcount
+            db.session.commit()
+            if expired:
+                self.app.logger.warning('Skipped %d reminders of meals that have already started', expired)
+            rows = db.session.execute(
+                select(Reminder.reminder_id, Reminder.date, Reminder.reminder_type, User.user_id, User.email)
+                .join(User, User.user_id == Reminder.user__reminder_fk)
+                .where(Reminder.sent_date.is_(None), Reminder.date < now + self.horizon)
+                .order_by(Reminder.date)
+            ).all()
+            db.session.remove()
+        added = 0
+        with self._lock:
+            for row in rows:
+                if row.reminder_id not in self._queued:
+                    self._queued.add(row.reminder_id)
+                    heapq.heappush(self._heap, (row.date, row.reminder_id, row.reminder_type, row.user_id, row.email))
+                    added += 1
+        self._reload_at = now + self.horizon / 2
+        return added
+
+    def wake(self):
+        """Makes the scheduler reload now, e.g. after reminders were scheduled."""
+        with self._wakeup:
+            self._reload_at = datetime.min
+            self._wakeup.notify()
+
+    def run_pending(self, now=None):
+        """
+        Hands every due reminder to the worker pool in batches.
+
+        Args:
+            now (datetime, optional): Current time.
+
+        Returns:
+            list: Futures of the submitted batches.
+        """
+        now = now or datetime.now()
+        due = []
+        with self._lock:
+            while self._heap and self._heap[0][0] <= now:
+                due.append(heapq.heappop(self._heap))
+        return [self._pool.submit(self._deliver, due[start:start + self.batch_size])
+                for start in range(0, len(due), self.batch_size)]
+
+    def _deliver(self, batch):
+        ids = [reminder_id for _, reminder_id, _, _, _ in batch]
+        # Reminders no longer needed and reminders delivered, marked sent even if the batch fails part way
+        skipped, delivered = [], []
+        try:
+            with self.app.app_context(), tenants.using(self.tenant):
+                # Students who booked since the booking reminder was scheduled don't need it
+                booked = set()
+                booking_reminders = {(user_id, *_booked_week(due))
+                                     for due, _, kind, user_id, _ in batch if kind == BOOK_NEXT_WEEK}
+                if booking_reminders:
+                    booked = set(db.session.execute(
+                        select(Booking.user_booking_id_fk, Booking.year, Booking.week).where(
+                            Booking.user_booking_id_fk.in_({user_id for user_id, _, _ in booking_reminders}),
+                            Booking.week.in_({week for _, _, week in booking_reminders}))).tuples())
+                messages, owners = [], []
+                now = datetime.now()
+                for due, reminder_id, kind, user_id, email in batch:
+                    if kind == BOOK_NEXT_WEEK and (user_id, *_booked_week(due)) in booked:
+                        skipped.append(reminder_id)
+                        continue
+                    # The meal has started since the reminder was queued
+                    if kind == MEAL_SOON and due + timedelta(minutes=self.lead_minutes) < now:
+                        skipped.append(reminder_id)
+                        continue
+                    subject, body = compose(kind, due, self.lead_minutes)
+                    messages.append({'to': email, 'subject': subject, 'body': body})
+                    owners.append(reminder_id)
+                try:
+                    if messages:
+                        self.sender.send_many(messages, lambda index: delivered.append(owners[index]))
+                finally:
+                    if skipped or delivered:
+                        db.session.execute(update(Reminder).where(Reminder.reminder_id.in_(skipped + delivered))
+                                           .values(sent_date=datetime.now()))
+                        db.session.commit()
+                    db.session.remove()
+            with self._lock:
+                self.sent += len(delivered)
+                self._queued.difference_update(ids)
+        except Exception:
+            unsent = len(batch) - len(skipped) - len(delivered)
+            self.app.logger.exception('Delivering %d reminders failed, will retry', unsent)
+            with self._lock:
+                self.sent += len(delivered)
+                self.failed += unsent
+                self._queued.difference_update(ids)
+
+    def run(self):
+        """Runs the scheduling loop until stop() is called."""
+        while True:
+            with self._wakeup:
+                if self._stopping:
+                    break
+            now = datetime.now()
+            if now >= self._reload_at:
+                self.load(now)
+            self.run_pending(now)
+            with self._lock:
+                next_due = self._heap[0][0] if self._heap else self._reload_at
+            with self._wakeup:
+                if not self._stopping:
+                    timeout = (min(next_due, self._reload_at) - datetime.now()).total_seconds()
+                    self._wakeup.wait(max(timeout, 0.01))
+
+    def start(self):
+        """Runs the scheduling loop in a daemon thread."""
+        self._thread = Thread(target=self.run, name='reminder-scheduler', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        """Stops the loop and waits for batches being delivered."""
+        with self._wakeup:
+            self._stopping = True
+            self._wakeup.notify()
+        if self._thread:
+            self._thread.join()
+        self._pool.shutdown(wait=True)
@@ -0,0 +1,145 @@
+"""
+Weekly rollover of standing orders.
+
+Students with an active Standing_Order have their booking for the previous
+week repeated for the target week. The job walks standing orders in user id
+order, one chunk at a time; each chunk reads the source bookings and the
+bookings already made for the target week with one query each, takes the seats
+with capacity.reserve_many(), inserts the new rows with a single bulk statement
+and commits. Slots that are full go on the waitlist instead, as when the
+student books them. Once the chunk has committed, every new booking is written
+to the booking change log, the gate map and the live event stream through
+capacity.after_commit(), like a booking made by the student.
+
+The insert skips students whose booking for the target week was created after
+the chunk read them (a student booking concurrently, or a second run): their
+own booking is kept, and the seats taken and waitlist places queued for them are
+given back, so such a race costs one row instead of the whole chunk.
+
+Students who already booked the target week are skipped, so the job is
+idempotent and an interrupted run can simply be started again.
+
+Schedule it once bookings close, for example from cron:
+
+    0 18 * * 5  cd /srv/samam && flask --app main rollover-bookings
+
+Functions:
+- rollover(target_year, target_week, chunk_size=1000, progress=None): Materialises the target week.
+"""
+
+from datetime import date, timedelta
+from time import perf_counter
+from sqlalchemy import func
+from . import db
+from . import capacity
+from .models import Booking, Standing_Order, insert_ignoring_duplicates
+
+# Standing orders processed per transaction
+ROLLOVER_CHUNK_SIZE = 1000
+
+
+def _insert_bookings(rows):
+    """
+    Inserts new bookings, skipping students who already have one for the week.
+
+    Args:
+        rows (list): Booking column values.
+
+    Returns:
+        dict: Booking id of each student whose row was inserted.
+    """
+    statement = insert_ignoring_duplicates(db.session, Booking.__table__)
+    if db.session.get_bind().dialect.insert_executemany_returning:
+        returning = statement.returning(Booking.user_booking_id_fk, Booking.booking_id)
+        return dict(db.session.execute(returning, rows).all())
+    inserted = {}
+    for row in rows:
+        result = db.session.execute(statement, row)
+        if result.rowcount:
+            inserted[row['user_booking_id_fk']] = result.inserted_primary_key[0]
+    return inserted
+
+
+def rollover(target_year, target_week, chunk_size=ROLLOVER_CHUNK_SIZE, progress=None):
+    """
+    Creates the target week's bookings for every active standing order. Must
+    be called inside an application context.
+
+    Args:
+        target_year (int): ISO year of the week to book.
+        target_week (int): ISO week to book.
+        chunk_size (int, optional): Standing orders per transaction.
+        progress (callable, optional): Called with the running report after
+            every chunk.
+
+    Returns:
+        dict: 'orders' examined, 'created' bookings, 'skipped' orders (already
+        booked or nothing to repeat), 'waitlisted' students (for at least one
+        full slot), 'seconds' taken and 'rows_per_second'.
+    """
+    source_year, source_week = (date.fromisocalendar(target_year, target_week, 1) - timedelta(days=7)).isocalendar()[:2]
+    started = perf_counter()
+    report = {'orders': 0, 'created': 0, 'skipped': 0, 'waitlisted': 0, 'seconds': 0.0, 'rows_per_second': 0.0}
+    last_user_id = 0
+
+    while True:
+        user_ids = [user_id for (user_id,) in
+                    db.session.query(Standing_Order.user_standing_fk)
+                    .filter(Standing_Order.active.is_(True), Standing_Order.user_standing_fk > last_user_id)
+                    .order_by(Standing_Order.user_standing_fk)
+                    .limit(chunk_size)]
+        if not user_ids:
+            break
+        last_user_id = user_ids[-1]
+
+        # Latest booking of each student in the source week
+        latest = (db.session.query(func.max(Booking.booking_id))
+                  .filter(Booking.year == source_year, Booking.week == source_week,
+                          Booking.user_booking_id_fk.in_(user_ids))
+                  .group_by(Booking.user_booking_id_fk))
+        source = dict(db.session.query(Booking.user_booking_id_fk, Booking.meal_slots)
+                      .filter(Booking.booking_id.in_(latest)))
+        already_booked = {user_id for (user_id,) in
+                          db.session.query(Booking.user_booking_id_fk)
+                          .filter(Booking.year == target_year, Booking.week == target_week,
+                                  Booking.user_booking_id_fk.in_(user_ids))}
+
+        wanted = {user_id: source[user_id] for user_id in user_ids
+                  if user_id in source and user_id not in already_booked and source[user_id]}
+        seated = capacity.reserve_many(target_year, target_week, wanted) if wanted else {}
+        new_bookings = [{'user_booking_id_fk': user_id, 'year': target_year, 'week': target_week,
+                         'meal_slots': booked, 'status': 'confirmed'}
+                        for user_id, (booked, _) in seated.items() if booked]
+        inserted = _insert_bookings(new_bookings) if new_bookings else {}
+
+        # A student who booked the week concurrently keeps their own booking: the seats taken and the
+        # waitlist places queued for them here go back, before anyone is promoted into the seats
+        raced = {user_id for user_id, (booked, _) in seated.items() if booked and user_id not in inserted}
+        only_waiting = [user_id for user_id, (booked, _) in seated.items() if not booked]
+        if only_waiting:
+            raced.update(user_id for (user_id,) in db.session.query(Booking.user_booking_id_fk).filter(
+                Booking.year == target_year, Booking.week == target_week,
+                Booking.user_booking_id_fk.in_(only_waiting)))
+        promoted = []
+        for user_id in raced:
+            booked, waiting = seated[user_id]
+            capacity.release(target_year, target_week, booked)
+            capacity.unqueue(user_id, target_year, target_week, waiting)
+            promoted += capacity.promote(target_year, target_week, booked)
+        db.session.commit()
+
+        created = [(user_id, booking_id, 0, seated[user_id][0]) for user_id, booking_id in inserted.items()]
+        capacity.after_commit(target_year, target_week, created + promoted)
+
+        report['orders'] += len(user_ids)
+        report['created'] += len(inserted)
+        report['skipped'] += len(user_ids) - len(wanted) + len(raced)
+        report['waitlisted'] += sum(1 for user_id, (_, waiting) in seated.items() if waiting and user_id not in raced)
+        report['seconds'] = perf_counter() - started
+        report['rows_per_second'] = report['created'] / report['seconds'] if report['seconds'] else 0.0
+        if progress:
+            progress(report)
+
+    report['seconds'] = perf_counter() - started
+    report['rows_per_second'] = report['created'] / report['seconds'] if report['seconds'] else 0.0
+    return report
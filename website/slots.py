@@ -0,0 +1,250 @@
+"""
+Meal-slot bitmap helpers.
+
+A weekly booking covers 19 meal slots, one bit per (meal, day), in the same
+order as the checkboxes on the booking forms:
+
+- bits 0-4:   breakfast, Monday to Friday
+- bits 5-9:   lunch, Monday to Friday
+- bits 10-11: brunch, Saturday and Sunday
+- bits 12-18: supper, Monday to Sunday
+
+`Booking.meal_slots` stores the bitmap as a plain integer, so head-counts can be
+summed with integer bit operations (in Python or directly in SQL) instead of
+re-parsing a stringified list on every page view.
+
+Functions:
+- encode(selected): Builds a bitmap from (meal, day) pairs.
+- from_form(form): Builds a bitmap from the booking form checkboxes.
+- decode(bitmap): Expands a bitmap into one boolean per slot.
+- count(bitmap): Number of booked slots in a bitmap.
+- aggregate(bitmaps): Per-slot head-counts over many bitmaps.
+- booking_info(bitmap): (day, status) rows for the booking templates.
+- parse_legacy(meal_type): Converts a legacy `Booking.meal_type` string.
+- slot_at(when): Slot index of the meal being served at a given time.
+"""
+
+from collections import Counter
+from datetime import time
+
+# Meals in form order with the days each one is served on
+MEAL_DAYS = (
+    ('breakfast', ('monday', 'tuesday', 'wednesday', 'thursday', 'friday')),
+    ('lunch', ('monday', 'tuesday', 'wednesday', 'thursday', 'friday')),
+    ('brunch', ('saturday', 'sunday')),
+    ('supper', ('monday', 'tuesday', 'wednesday', 'thursday', 'friday', 'saturday', 'sunday')),
+)
+
+MEALS = tuple(meal for meal, _ in MEAL_DAYS)
+DAYS = ('monday', 'tuesday', 'wednesday', 'thursday', 'friday', 'saturday', 'sunday')
+
+# Fixed slot order: SLOTS[i] is the (meal, day) stored in bit i
+SLOTS = tuple((meal, day) for meal, days in MEAL_DAYS for day in days)
+SLOT_COUNT = len(SLOTS)
+SLOT_INDEX = {slot: index for index, slot in enumerate(SLOTS)}
+FULL_MASK = (1 << SLOT_COUNT) - 1
+
+# Serving windows (start, end) during which the gate admits students to a meal
+MEAL_TIMES = {
+    'breakfast': (time(6, 0), time(9, 0)),
+    'lunch': (time(12, 0), time(14, 0)),
+    'brunch': (time(9, 30), time(12, 30)),
+    'supper': (time(17, 0), time(20, 0)),
+}
+
+
+def meal_mask(meal):
+    """
+    Returns the bitmap of every slot for the given meal.
+
+    Args:
+        meal (str): Meal name, e.g. 'supper'.
+
+    Returns:
+        int: Bitmap with one bit set per day the meal is served.
+    """
+    return encode((m, d) for m, d in SLOTS if m == meal)
+
+
+def day_mask(day):
+    """
+    Returns the bitmap of every slot served on the given day.
+
+    Args:
+        day (str): Lower-case day name, e.g. 'monday'.
+
+    Returns:
+        int: Bitmap with one bit set per meal served that day.
+    """
+    return encode((m, d) for m, d in SLOTS if d == day)
+
+
+def encode(selected):
+    """
+    Builds a bitmap from (meal, day) pairs.
+
+    Args:
+        selected (iterable): (meal, day) tuples; unknown pairs are ignored.
+
+    Returns:
+        int: Slot bitmap.
+    """
+    bitmap = 0
+    for slot in selected:
+        index = SLOT_INDEX.get(slot)
+        if index is not None:
+            bitmap |= 1 << index
+    return bitmap
+
+
+def from_form(form):
+    """
+    Builds a bitmap from the booking form, where each meal is a checkbox group
+    named after the meal with the day as the value.
+
+    Args:
+        form (MultiDict): Submitted form data.
+
+    Returns:
+        int: Slot bitmap.
+    """
+    return encode((meal, day) for meal in MEALS for day in form.getlist(meal))
+
+
+def decode(bitmap):
+    """
+    Expands a bitmap into one boolean per slot, in SLOTS order.
+
+    Args:
+        bitmap (int): Slot bitmap.
+
+    Returns:
+        tuple: SLOT_COUNT booleans.
+    """
+    return tuple(bool(bitmap >> index & 1) for index in range(SLOT_COUNT))
+
+
+def slots_of(bitmap):
+    """
+    Lists the (meal, day) pairs booked in a bitmap.
+
+    Args:
+        bitmap (int): Slot bitmap.
+
+    Returns:
+        list: (meal, day) tuples in SLOTS order.
+    """
+    return [slot for index, slot in enumerate(SLOTS) if bitmap >> index & 1]
+
+
+def count(bitmap):
+    """
+    Returns the number of booked slots in a bitmap.
+
+    Args:
+        bitmap (int): Slot bitmap.
+
+    Returns:
+        int: Number of set bits.
+    """
+    return bin(bitmap).count('1')
+
+
+def aggregate(bitmaps):
+    """
+    Sums head-counts per slot over many bitmaps.
+
+    Identical bitmaps are grouped first, so the per-bit work is proportional to
+    the number of distinct booking patterns rather than the number of students.
+
+    Args:
+        bitmaps (iterable): Slot bitmaps, None values are skipped.
+
+    Returns:
+        list: SLOT_COUNT head-counts in SLOTS order.
+    """
+    totals = [0] * SLOT_COUNT
+    for bitmap, students in Counter(bitmaps).items():
+        if not bitmap:
+            continue
+        for index in range(SLOT_COUNT):
+            if bitmap >> index & 1:
+                totals[index] += students
+    return totals
+
+
+def booking_info(bitmap):
+    """
+    Builds the (day, status) rows rendered by the booking templates.
+
+    Args:
+        bitmap (int): Slot bitmap.
+
+    Returns:
+        list: SLOT_COUNT (day, 'Booked' | 'Not Booked') tuples in SLOTS order.
+    """
+    return [(day.capitalize(), 'Booked' if booked else 'Not Booked')
+            for (_, day), booked in zip(SLOTS, decode(bitmap or 0))]
+
+
+def parse_legacy(meal_type):
+    """
+    Converts a legacy `Booking.meal_type` string into a bitmap.
+
+    Two formats were written before bitmaps were introduced:
+    - '1, 0, 1, ...': one flag per slot in SLOTS order.
+    - "['monday', 'friday', ...]": the concatenated day lists of the breakfast,
+      lunch, brunch and supper checkbox groups. Days are assigned to meals in
+      form order, moving to the next meal whenever a day can no longer belong
+      to the current one.
+
+    Args:
+        meal_type (str): Legacy value, may be None or empty.
+
+    Returns:
+        int: Slot bitmap.
+    """
+    if not meal_type:
+        return 0
+    values = [value.strip(" '\"[]") for value in meal_type.split(',')]
+    values = [value for value in values if value]
+
+    if all(value in ('0', '1') for value in values):
+        return sum(1 << index for index, value in enumerate(values[:SLOT_COUNT]) if value == '1')
+
+    bitmap = 0
+    meal = 0
+    last_day = -1
+    for day in (value.lower() for value in values):
+        while meal < len(MEAL_DAYS):
+            days = MEAL_DAYS[meal][1]
+            if day in days and days.index(day) > last_day:
+                break
+            meal += 1
+            last_day = -1
+        if meal == len(MEAL_DAYS):
+            break
+        last_day = MEAL_DAYS[meal][1].index(day)
+        bitmap |= 1 << SLOT_INDEX[(MEAL_DAYS[meal][0], day)]
+    return bitmap
+
+
+def slot_at(when, meal_times=MEAL_TIMES):
+    """
+    Finds the meal slot being served at a given time.
+
+    Args:
+        when (datetime): Local date and time of the swipe.
+        meal_times (dict, optional): Meal name to (start, end) serving window.
+
+    Returns:
+        int: Slot index in SLOTS order, or None if no meal is being served.
+    """
+    day = DAYS[when.weekday()]
+    now = when.time()
+    for meal, (start, end) in meal_times.items():
+        if start <= now < end:
+            index = SLOT_INDEX.get((meal, day))
+            if index is not None:
+                return index
+    return None
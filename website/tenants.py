@@ -0,0 +1,244 @@
+"""
+Multi-tenant routing: each academy, campus or dining hall in its own database.
+
+Every tenant has the whole schema in a database of its own, so its users,
+bookings, menus, cards and head-counts never share a file, a write lock or a
+connection pool with another tenant. The default tenant lives on
+SQLALCHEMY_DATABASE_URI (bind None), so a single-tenant deployment is unchanged;
+the others are Flask-SQLAlchemy binds named after the tenant, from
+TENANT_DATABASES.
+
+`TenantSession` is the class of `db.session`: its get_bind() sends every
+statement to the engine of the current tenant, so models and queries need no
+bind key. A request's tenant is the first label of its host name
+(east.meals.example.org is tenant 'east'); any other host is the default
+tenant. Logging in stamps the session with its tenant, and the user loader
+refuses a session stamped by another tenant. Outside requests (CLI commands,
+scheduler threads, reports) code selects a tenant with `using()`.
+
+Process-wide caches and write buffers (gate map, admission and change log
+writers, user, menu and forecast caches, live event bus) are wrapped in
+`PerTenant`, which keeps one instance per tenant behind the same module-level
+name, so `gate.entitlements.lookup(...)` always reads the current tenant's map.
+
+`gather()` runs a function once per tenant on a thread pool, each call in its
+own application context bound to one tenant, for reports across tenants (see
+the `tenant-report` command).
+
+Configuration (app.config):
+- TENANT_DATABASES: {name: database URI} of the tenants other than the default
+  one, read from the environment as JSON (default none).
+- DEFAULT_TENANT: Name of the tenant on SQLALCHEMY_DATABASE_URI (default 'default').
+- TENANT_WORKERS: Threads of a cross-tenant report (default 8).
+
+Classes:
+- TenantSession: db.session class binding statements to the current tenant.
+- PerTenant: One instance of a process-wide object per tenant.
+
+Functions:
+- init_app(app): Declares the tenant binds and routes requests to tenants.
+- names(): Every tenant, the default one first.
+- current(): Tenant of the current application context.
+- engine(name=None): Engine of a tenant.
+- using(name): Context manager selecting a tenant.
+- session_matches(): Whether the login session belongs to the current tenant.
+- gather(function, tenant_names=None): Calls a function once per tenant in parallel.
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from threading import Lock
+from flask import current_app, g, has_app_context, request, session
+from flask_login import user_logged_in
+from flask_sqlalchemy.session import Session
+
+
+class TenantSession(Session):
+    """Flask-SQLAlchemy session sending every statement to the current tenant's engine."""
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind is not None:
+            return bind
+        return engine()
+
+
+class PerTenant:
+    """
+    Proxy to one instance of a process-wide object per tenant, created on first
+    use. Attribute access goes to the current tenant's instance.
+
+    Args:
+        factory (callable): Builds the instance of one tenant; called with that tenant current.
+    """
+
+    def __init__(self, factory):
+        self._factory = factory
+        self._lock = Lock()
+        self._instances = {}
+
+    def of(self, name=None):
+        """
+        Returns the instance of a tenant.
+
+        Args:
+            name (str, optional): Tenant; the current one if omitted.
+
+        Returns:
+            object: The tenant's instance.
+        """
+        name = name or current()
+        instance = self._instances.get(name)
+        if instance is None:
+            with self._lock:
+                instance = self._instances.get(name)
+                if instance is None:
+                    instance = self._instances[name] = self._factory()
+        return instance
+
+    def all(self):
+        """Returns the instances created so far, by tenant."""
+        with self._lock:
+            return dict(self._instances)
+
+    def __getattr__(self, attribute):
+        return getattr(self.of(), attribute)
+
+
+def init_app(app):
+    """
+    Declares a bind per tenant in TENANT_DATABASES, with the same engine
+    options as the default database, and routes each request to the tenant of
+    its host. Must run before db.init_app(app).
+
+    Args:
+        app (Flask): Flask application.
+    """
+    from .config import engine_options
+
+    binds = app.config.setdefault('SQLALCHEMY_BINDS', {})
+    for name, uri in app.config.get('TENANT_DATABASES', {}).items():
+        if name == app.config['DEFAULT_TENANT']:
+            raise ValueError(f'Tenant {name!r} is the default tenant and cannot have its own database')
+        binds[name] = {'url': uri, **engine_options(app.config, uri)}
+
+    if binds:
+        app.before_request(_route_request)
+    user_logged_in.connect(_stamp_session, app)
+
+
+def _route_request():
+    """Selects the tenant named by the first label of the request's host name."""
+    label = request.host.split(':')[0].split('.')[0]
+    g.tenant = label if label in current_app.config.get('TENANT_DATABASES', {}) else default()
+
+
+def _stamp_session(app, user, **kwargs):
+    """Remembers which tenant a login session belongs to."""
+    session['tenant'] = current()
+
+
+def default():
+    """Name of the default tenant."""
+    return current_app.config.get('DEFAULT_TENANT', 'default') if has_app_context() else 'default'
+
+
+def names():
+    """
+    Returns every tenant.
+
+    Returns:
+        list: Tenant names, the default tenant first.
+    """
+    return [default(), *current_app.config.get('TENANT_DATABASES', {})]
+
+
+def current():
+    """
+    Returns the tenant of the current application context: the one selected
+    by the request's host or by using(), else the default tenant.
+
+    Returns:
+        str: Tenant name.
+    """
+    if has_app_context() and 'tenant' in g:
+        return g.tenant
+    return default()
+
+
+def engine(name=None):
+    """
+    Returns the engine of a tenant. Must be called inside an application context.
+
+    Args:
+        name (str, optional): Tenant; the current one if omitted.
+
+    Returns:
+        Engine: SQLAlchemy engine of the tenant's database.
+    """
+    name = name or current()
+    engines = current_app.extensions['sqlalchemy'].engines
+    return engines[None if name == default() else name]
+
+
+@contextmanager
+def using(name):
+    """
+    Makes a tenant current for the rest of the application context's block.
+    The session is closed when the tenant changes, so rows of two tenants
+    never share its identity map. Must be used inside an application context.
+
+    Args:
+        name (str): Tenant.
+
+    Raises:
+        ValueError: If the tenant is not configured.
+    """
+    if name not in names():
+        raise ValueError(f'Unknown tenant {name!r}, expected one of {", ".join(names())}')
+    db = current_app.extensions['sqlalchemy']
+    previous = current()
+    if name != previous:
+        db.session.remove()
+    g.tenant = name
+    try:
+        yield name
+    finally:
+        if name != previous:
+            db.session.remove()
+        g.tenant = previous
+
+
+def session_matches():
+    """
+    Tells whether the login session was created on the current tenant. Sessions
+    from before tenants were configured carry no tenant and are accepted.
+
+    Returns:
+        bool: False if the session belongs to another tenant.
+    """
+    return session.get('tenant', current()) == current()
+
+
+def gather(function, tenant_names=None):
+    """
+    Calls a function once per tenant on a thread pool, each call in a new
+    application context with its tenant current, e.g. for reports across
+    tenants. Must be called inside an application context.
+
+    Args:
+        function (callable): Called without arguments; its result must not hold ORM rows.
+        tenant_names (list, optional): Tenants to visit; every tenant if omitted.
+
+    Returns:
+        dict: Tenant name to the function's result, in the order of names.
+    """
+    app = current_app._get_current_object()
+    tenant_names = tenant_names or names()
+
+    def run(name):
+        with app.app_context(), using(name):
+            return function()
+
+    workers = max(1, min(len(tenant_names), app.config.get('TENANT_WORKERS', 8)))
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='tenant') as pool:
+        return dict(zip(tenant_names, pool.map(run, tenant_names)))
@@ -0,0 +1,138 @@
+"""
+Cross-request cache of logged-in users for the Flask-Login user_loader.
+
+Flask-Login already keeps `current_user` for the rest of a request once it is
+loaded, so the remaining cost is the `User` query at the start of every
+authenticated request. `UserCache` keeps lightweight, read-only user records
+keyed by id in an LRU map with a time-to-live, so repeat requests from the same
+student skip the database entirely.
+
+Records never hold the password. Entries are dropped when accounts change in
+this process (sign-up, bulk import, deletion) and expire after USER_CACHE_TTL
+seconds, which bounds staleness across worker processes.
+
+Configuration (app.config):
+- USER_CACHE_SIZE: Maximum number of cached users (default 10000).
+- USER_CACHE_TTL: Seconds a cached user stays valid (default 60).
+
+Classes:
+- CachedUser: Detached user record used as `current_user`.
+- UserCache: LRU/TTL cache with hit and miss counters.
+"""
+
+from collections import OrderedDict
+from threading import Lock
+from time import monotonic
+from flask import current_app
+from flask_login import UserMixin
+from . import db
+from . import tenants
+
+# Columns copied into cached records; the password is deliberately left out
+CACHED_FIELDS = ('user_id', 'initials', 'surname', 'username', 'email', 'role')
+
+
+class CachedUser(UserMixin):
+    """Read-only copy of a User row, safe to share between requests."""
+
+    def __init__(self, user_id, initials, surname, username, email, role):
+        self.user_id = user_id
+        self.initials = initials
+        self.surname = surname
+        self.username = username
+        self.email = email
+        self.role = role
+
+    def __repr__(self):
+        """Representation of the CachedUser object."""
+        return f'{self.user_id},{self.initials}, {self.surname}, {self.email},  {self.role}'
+
+    def get_id(self):
+        """Method required by Flask-Login for retrieving user ID."""
+        return str(self.user_id)
+
+
+class UserCache:
+    """LRU cache of CachedUser records keyed by user id, with a time-to-live."""
+
+    def __init__(self):
+        self._lock = Lock()
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def get(self, user_id):
+        """
+        Returns the user with the given id, loading it on a miss.
+
+        Args:
+            user_id (int): User ID.
+
+        Returns:
+            CachedUser: The user, or None if no such user exists.
+        """
+        ttl = current_app.config.get('USER_CACHE_TTL', 60)
+        now = monotonic()
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is not None and now - entry[1] < ttl:
+                self._entries.move_to_end(user_id)
+                self.hits += 1
+                return entry[0]
+            self.misses += 1
+
+        from .models import User
+
+        columns = [getattr(User, field) for field in CACHED_FIELDS]
+        row = db.session.query(*columns).filter(User.user_id == user_id).first()
+        if row is None:
+            return None
+        user = CachedUser(*row)
+
+        size = current_app.config.get('USER_CACHE_SIZE', 10000)
+        with self._lock:
+            self._entries[user_id] = (user, now)
+            self._entries.move_to_end(user_id)
+            while len(self._entries) > size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+        return user
+
+    def invalidate(self, user_id=None):
+        """
+        Drops one user, or every user, from the cache.
+
+        Args:
+            user_id (int, optional): User to drop; all users if omitted.
+        """
+        with self._lock:
+            if user_id is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(user_id, None)
+            self.invalidations += 1
+
+    def stats(self):
+        """
+        Returns the cache counters.
+
+        Returns:
+            dict: 'hits', 'misses', 'evictions', 'invalidations', 'size' and
+            'hit_ratio'.
+        """
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'invalidations': self.invalidations,
+                'size': len(self._entries),
+                'hit_ratio': self.hits / lookups if lookups else 0.0,
+            }
+
+
+# Process-wide caches used by the user_loader, one per tenant
+users = tenants.PerTenant(UserCache)
@@ -1,11 +1,11 @@
 '''
 This code is a Flask application with a series of routes and functionalities for managing bookings, menus, and user accounts. Here's a breakdown of the main components:
 
-1. Blueprints and Imports: The code starts with imports from Flask, Flask extensions (like Flask-Login), and the application's models. It also imports datetime for date handling.
+1. Blueprints and Imports: The code starts with imports from Flask, Flask extensions (like Flask-Login), and the application's models. It also imports datetime for date handling. Modules only a few routes need (exports.py, deletion.py) are imported inside those routes so worker start-up stays short.
 
-2. get_iso_week_number Function: This function calculates the ISO week number for a given date.
+2. get_iso_week_number Function: This function calculates the ISO week number for a given date. get_booking_week() returns the ISO (year, week) open for booking, which is next week; bookings and head-counts are keyed by both so week numbers never collide across years. get_report_week() reads the ?year=&week= of a report and answers 400 unless they name an ISO week (checked by is_iso_week()). get_booking_page() reads a bookings page request (see pagination.py).
 
-3. get_list Function: This function takes a list of booking statuses and organizes them into chunks representing days of the week. It's used to prepare booking information for display.
+3. Head-counts: student(), modify() and delete() keep the per-(year, week, meal, day) Meal_Count table up to date in the same transaction as the booking change (see headcount.py), so the manager pages read week totals without scanning bookings. Meals with a capacity only take a booking while seats are left: student() and modify() reserve each seat with an atomic conditional update, waitlist students for full meals and promote waiting students when a change frees seats (see capacity.py); get_locked_booking(), update_booking() and flash_waitlist() support them, and the JSON API reuses them (see api.py). Booking rows carry a version, so a change racing another change to the same booking is refused rather than lost.
 
 4. Blueprint Registration: The code registers a Flask Blueprint called views.
 
@@ -14,14 +14,23 @@ This code is a Flask application with a series of routes and functionalities for
     -/student/: Handles student operations, such as booking meals.
     -/student/view_bookings/: Renders the page to view student's bookings.
     -/student/modify_bookings/: Allows students to modify their bookings.
-    -/manager/: Renders the manager's dashboard.
+    -/student/menu/: Shows the coming week's menu (also as JSON at /student/menu.json).
+    -/student/standing_order/: Lets students opt in or out of repeating their last booking every week.
+    -/manager/: Renders the manager's dashboard, with next week's head-counts and kitchen forecast (see forecast.py).
+    -/manager/forecast.json: Returns a week's kitchen forecast as JSON.
+    -/manager/cache-stats/: Returns cache hit and miss counters as JSON.
+    -/manager/events: Streams gate admissions and booking changes as server-sent events, with live served and booked counters of the current week (see events.py).
+    -/manager/events.json: The same events for dashboards polling when every stream of the worker is taken.
     -/manager/menu/: Handles menu management by the manager.
-    -/manager/bookings/: Displays bookings for the current week.
+    -/manager/bookings/: Displays bookings for the coming week, a page at a time, filtered by meal, day and surname; ?year= and ?week= show an earlier week, read from the archive once it is closed (see week_archive.py).
+    -/manager/bookings.json: Returns the same pages as JSON, with a cursor to the next page.
+    -/manager/bookings/<id>/history/: Returns a booking's change log and its slots at a given time as JSON.
+    -/manager/bookings/export.csv, /manager/bookings/export.xlsx: Stream the week's student list and kitchen head-counts.
     -/accommodation/: Renders the accommodation page.
-    -/accommodation/delete/: Allows deletion of user accounts.
+    -/accommodation/delete/: Removes a user account and archives its dependent rows (see deletion.py).
     
 6. Route Functions:
-    -home(), student(), view_bookings(), modify(), manager(), menu(), bookings(), accommodation(), and delete(): These functions implement the logic for the corresponding routes.
+    -home(), student(), view_bookings(), modify(), view_menu(), view_menu_json(), standing_order(), manager(), forecast_json(), cache_stats(), manager_events(), manager_events_json(), menu(), bookings(), bookings_json(), booking_history(), export_bookings(), accommodation(), and delete(): These functions implement the logic for the corresponding routes.
 
 7. Form Processing:
     -The code processes form data submitted by users to book meals or modify bookings.
@@ -35,12 +44,26 @@ This code is a Flask application with a series of routes and functionalities for
 '''
 
 # Import necessary modules and components from Flask and extensions
-from flask import Blueprint, render_template, request, flash, redirect, url_for
+from flask import Blueprint, render_template, request, flash, redirect, url_for, jsonify, Response, stream_with_context, abort
 from flask_login import login_required, current_user
-from .models import User, Booking, Weekly_menu, Access_Card, Reminder, Booking_Modification_Log
-from datetime import datetime, date
+from .models import User, Booking, Weekly_menu, Access_Card, Reminder, Booking_Modification_Log, Standing_Order
+from datetime import datetime, date, timedelta
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm.exc import StaleDataError
 import copy
+import json
 from . import db
+from . import slots
+from . import headcount
+from . import gate
+from . import changelog
+from . import pagination
+from . import week_archive
+from . import capacity
+from . import events
+from .user_cache import users as user_cache
+from .menu_cache import menus as menu_cache
+from .forecast import forecasts
 
 # Function to calculate ISO week number for a given date
 def get_iso_week_number(year, month, day):
@@ -48,32 +71,10 @@ def get_iso_week_number(year, month, day):
     week_number = date_object.isocalendar()[1]
     return week_number
 
-# Function to organize booking statuses into chunks representing days of the week
-def get_list(booking_list):
-    # Define chunk sizes for days of the week
-    chunk_sizes = [5, 5, 2, 7]
-    days = ['Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday', 'Saturday', 'Sunday']
-
-    # Track the index for the current booking
-    current_index = 0
-    
-    # Initialize a list to store booking information
-    booking_info = []
-
-    # Loop through each chunk size
-    for size in chunk_sizes:
-        # Loop through each day in the chunk
-        for i in range(size):
-            # Determine if the booking for this day is 'Booked' or 'Not Booked'
-            if booking_list[current_index] == '1':
-                booking_info.append((days[i], 'Booked'))
-            else:
-                booking_info.append((days[i], 'Not Booked'))
-            
-            # Increment the index
-            current_index += 1
-
-    return booking_info
+# Function returning the ISO year and week open for booking, which is next week
+def get_booking_week():
+    year, week = (date.today() + timedelta(days=7)).isocalendar()[:2]
+    return year, week
 
 # Define a Blueprint named 'views' for organizing routes
 views = Blueprint('views', __name__)
@@ -90,34 +91,37 @@ def home():
 def student():
     # Processing form data for booking meals
     if request.method == 'POST':
-        # Get the ISO week number for the current date
-        date_m = date.today()
-        week =  get_iso_week_number(date_m.year, date_m.month, date_m.day) 
+        # Get the ISO year and week open for booking
+        booking_year, booking_week = get_booking_week()
         
-        # Check if a booking for the current week already exists
-        current_week_booking_check = Weekly_menu.query.filter(Weekly_menu.week == week).first()
+        # Convert the meal choices from the form into a slot bitmap
+        meal_slots = slots.from_form(request.form)
         
-        # Process the form data and add it to the database if booking for the week doesn't exist
-        if not current_week_booking_check:
-            # Retrieve meal choices from the form
-            breakfast = request.form.getlist('breakfast')
-            lunch = request.form.getlist('lunch')
-            brunch = request.form.getlist('brunch')
-            supper = request.form.getlist('supper')
-            
-            # Convert meal choices into a string representation
-            meal_type = str(breakfast + lunch + brunch + supper)
-            
-            # Create a new booking record in the database
-            new_booking = Booking(user_booking_id_fk=current_user.user_id, week=week+1, meal_type=meal_type, status='confirmed')
-            db.session.add(new_booking)
+        # Create the booking; the unique (user, year, week) index rejects a second booking for the week
+        new_booking = Booking(user_booking_id_fk=current_user.user_id, year=booking_year, week=booking_week, meal_slots=0, status='confirmed')
+        try:
+            with db.session.begin_nested():
+                db.session.add(new_booking)
+        except IntegrityError:
+            flash('You have already booked for this week!', category='error')
+        else:
+            # Take a seat in every chosen meal that has one left, waitlisting the full ones
+            booked, waiting, promoted = capacity.change(current_user.user_id, booking_year, booking_week, 0, meal_slots)
+            new_booking.meal_slots = booked
+            booking_id = new_booking.booking_id
             db.session.commit()
+            gate.entitlements.update_user(current_user.user_id, booking_year, booking_week, booked)
+            changelog.writer.record(booking_id, current_user.user_id, 0, booked)
+            events.booking_changed(booking_year, booking_week, current_user.user_id, booking_id, 0, booked)
+            capacity.after_commit(booking_year, booking_week, promoted)
             
             flash('Your booking was successful', category='success')
-        else:
-            flash('You have already booked for this week!', category='error')
+            flash_waitlist(waiting)
 
-    return render_template("student.html", user=current_user)
+    # Show whether the student's booking is repeated every week
+    order = Standing_Order.query.filter(Standing_Order.user_standing_fk == current_user.user_id).first()
+
+    return render_template("student.html", user=current_user, repeat_booking=bool(order and order.active))
 
 # Route for viewing student's bookings
 @views.route('/student/view_bookings/', methods=['GET', 'POST'])
@@ -126,52 +130,159 @@ def view_bookings():
     # Retrieve the student's bookings from the database
     my_bookings = Booking.query.filter(Booking.user_booking_id_fk == str(current_user.user_id)).all()
     
-    # Get the meal types for the last booking and organize them into days of the week
-    raw_list = (my_bookings[-1].meal_type).split(', ')
-    booking_list = get_list(raw_list)
+    # Organize the meal slots of the last booking into days of the week
+    booking_list = slots.booking_info(my_bookings[-1].meal_slots if my_bookings else 0)
 
     return render_template("view_bookings.html", user=current_user, booking_info=booking_list)
 
+# Function returning the student's booking of a week, locked for update and created empty if missing
+def get_locked_booking(user_id, year, week):
+    query = Booking.query.filter(Booking.user_booking_id_fk == user_id, Booking.year == year, Booking.week == week).with_for_update()
+    booking = query.first()
+    if booking is None:
+        booking = Booking(user_booking_id_fk=user_id, year=year, week=week, meal_slots=0, status='confirmed')
+        try:
+            with db.session.begin_nested():
+                db.session.add(booking)
+        except IntegrityError:
+            # A concurrent request created it first
+            booking = query.first()
+    return booking
+
+# Function applying a student's new meal choices to their locked booking and committing
+def update_booking(booking, meal_slots):
+    # Release dropped seats to the waitlist and reserve new ones, in the same transaction as the booking change
+    user_id, year, week, old_slots = booking.user_booking_id_fk, booking.year, booking.week, booking.meal_slots
+    booked, waiting, promoted = capacity.change(user_id, year, week, old_slots, meal_slots)
+    booking.meal_slots = booked
+    booking_id = booking.booking_id
+    db.session.commit()
+    gate.entitlements.update_user(user_id, year, week, booked)
+    
+    # Record the slots added and removed in the booking change log
+    changelog.writer.record(booking_id, user_id, old_slots, booked)
+    events.booking_changed(year, week, user_id, booking_id, old_slots, booked)
+    capacity.after_commit(year, week, promoted)
+    return waiting
+
+# Function telling the student which chosen meals are full and waitlisted
+def flash_waitlist(waiting):
+    if waiting:
+        meals = ', '.join(f'{meal} on {day}' for meal, day in slots.slots_of(waiting))
+        flash(f'These meals are full, you are on the waitlist: {meals}', category='error')
+
 # Route for modifying student's bookings
 @views.route('/student/modify_bookings/', methods=['GET', 'POST'])
 @login_required
 def modify():
     if request.method == 'POST':
-        # Get the ISO week number for the current date
-        date_m = date.today()
-        week =  get_iso_week_number(date_m.year, date_m.month, date_m.day)
+        # Get the ISO year and week open for booking
+        year, week = get_booking_week()
         
-        # Retrieve current booking for the week
-        current_booking = Booking.query.filter(Booking.week == week+1).first()
+        # Retrieve and lock the student's booking for the week, creating it if there is none yet
+        current_booking = get_locked_booking(current_user.user_id, year, week)
         
-        # Delete the current booking
-        db.session.delete(current_booking)
-        db.session.commit()
+        # Convert the modified meal choices from the form into a slot bitmap
+        meal_slots = slots.from_form(request.form)
         
-        # Process the form data for the modified booking
-        breakfast = request.form.getlist('breakfast')
-        lunch = request.form.getlist('lunch')
-        brunch = request.form.getlist('brunch')
-        supper = request.form.getlist('supper')
-        
-        # Convert meal choices into a string representation
-        meal_type = str(breakfast + lunch + brunch + supper)
-        
-        # Create a new booking record in the database
-        new_booking = Booking(user_booking_id_fk=current_user.user_id, week=week+1, meal_type=meal_type, status='confirmed')
-        db.session.add(new_booking)
-        db.session.commit()
+        # Update the booking, its seats and the waitlist; a concurrent change to the same booking is refused
+        try:
+            waiting = update_booking(current_booking, meal_slots)
+        except StaleDataError:
+            db.session.rollback()
+            flash('Your booking was changed at the same time, please try again', category='error')
+            return redirect(url_for('views.modify'))
         
         flash('Your booking was successfully Updated', category='success')
+        flash_waitlist(waiting)
         return redirect(url_for('views.student'))
 
     return render_template("modify.html", user=current_user)
 
+# Route for viewing the coming week's menu, served from the rendered-menu cache
+@views.route('/student/menu/')
+@login_required
+def view_menu():
+    year, week = get_report_week()
+    return render_template("view_menu.html", user=current_user, menu_html=menu_cache.get(year, week)['html'])
+
+# Route returning the coming week's menu as JSON from the rendered-menu cache
+@views.route('/student/menu.json')
+@login_required
+def view_menu_json():
+    year, week = get_report_week()
+    return menu_cache.get(year, week)['json'], 200, {'Content-Type': 'application/json'}
+
+# Route for opting in or out of repeating the last booking every week
+@views.route('/student/standing_order/', methods=['POST'])
+@login_required
+def standing_order():
+    repeat = request.form.get('repeat') == 'on'
+    
+    # Create or update the student's standing order
+    order = Standing_Order.query.filter(Standing_Order.user_standing_fk == current_user.user_id).first()
+    if order:
+        order.active = repeat
+    elif repeat:
+        db.session.add(Standing_Order(user_standing_fk=current_user.user_id, active=True))
+    db.session.commit()
+    
+    if repeat:
+        flash('Your last booking will be repeated every week', category='success')
+    else:
+        flash('Your booking will no longer be repeated', category='success')
+    return redirect(url_for('views.student'))
+
 # Route for manager's dashboard
 @views.route('/manager/', methods=["GET", "POST"])
 @login_required
 def manager():
-    return render_template("manager.html", user=current_user)
+    # Read next week's pre-aggregated head-counts for the dashboard
+    year, week = get_booking_week()
+    totals = zip(slots.SLOTS, headcount.weekly_totals(year, week))
+    
+    # Predicted head-counts and no-show rates from the booking history, if NumPy is installed
+    forecast = forecasts.get(year, week)
+    
+    return render_template("manager.html", totals=totals, forecast=forecast, user=current_user)
+
+# Route returning a week's kitchen forecast as JSON, next week by default
+@views.route('/manager/forecast.json')
+@login_required
+def forecast_json():
+    year, week = get_report_week()
+    forecast = forecasts.get(year, week)
+    if forecast is None:
+        return jsonify(error='Forecasts need NumPy installed'), 501
+    return jsonify(year=year, week=week, **forecast)
+
+# Route exposing the user cache hit and miss counters
+@views.route('/manager/cache-stats/')
+@login_required
+def cache_stats():
+    return jsonify(users=user_cache.stats(), menus=menu_cache.stats(), forecasts=forecasts.stats(),
+                   events={'subscribers': events.bus.subscribers, 'published': events.bus.published})
+
+# Route streaming gate admissions and booking changes to the live dashboard
+@views.route('/manager/events')
+@login_required
+def manager_events():
+    # A reconnecting EventSource sends the ID of the last event it received
+    last_id = request.headers.get('Last-Event-ID', type=int)
+    # Each stream holds a server thread, so only a few per worker; the others poll events.json
+    if not events.open_stream():
+        return Response('Too many live dashboards, poll /manager/events.json', status=503,
+                        mimetype='text/plain', headers={'Retry-After': '30'})
+    response = Response(stream_with_context(events.stream(last_id)), mimetype='text/event-stream',
+                        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+    response.call_on_close(events.close_stream)
+    return response
+
+# Route returning the live dashboard's events to clients polling instead of streaming
+@views.route('/manager/events.json')
+@login_required
+def manager_events_json():
+    return jsonify(events.poll(request.args.get('after', type=int)))
 
 # Route for menu management by the manager
 @views.route('/manager/menu/', methods=['GET', 'POST'])
@@ -202,41 +313,147 @@ def menu():
             }
         }
         
-        # Get the ISO week number for the current date
-        date_m = date.today()
-        week =  get_iso_week_number(date_m.year, date_m.month, date_m.day)
+        # Get the ISO year and week open for booking
+        year, week = get_booking_week()
         
-        # Add the weekly menu to the database
-        new_menu = Weekly_menu(week=week+1, menu_content=str(weekly_menu))
-        db.session.add(new_menu)
+        # Add or replace the weekly menu in the database
+        current_menu = Weekly_menu.query.filter(Weekly_menu.year == year, Weekly_menu.week == week).first()
+        if current_menu:
+            current_menu.menu_content = json.dumps(weekly_menu)
+        else:
+            db.session.add(Weekly_menu(year=year, week=week, menu_content=json.dumps(weekly_menu)))
         db.session.commit()
         
+        # Drop the cached rendering and forecast of the week's menu
+        menu_cache.invalidate(year, week)
+        forecasts.invalidate(year, week)
+        
         flash('Menu update was successful', category='success')
         return redirect(url_for('views.manager'))
         
     return render_template("menu.html", user=current_user)
 
-# Route for displaying bookings for the current week by the manager
+# Function reading the ISO year and week of a report from the query string, next week by default
+def get_report_week():
+    year, week = get_booking_week()
+    year, week = request.args.get('year', year, type=int), request.args.get('week', week, type=int)
+    # Only real ISO weeks, e.g. week 53 exists in some years only
+    if not is_iso_week(year, week):
+        abort(400)
+    return year, week
+
+# Function telling whether a year and week number name an ISO week
+def is_iso_week(year, week):
+    try:
+        date.fromisocalendar(year, week, 1)
+    except ValueError:
+        return False
+    return True
+
+# Function reading the week, filters and cursor of a bookings page from the query string
+def get_booking_page():
+    year, week = get_report_week()
+    filters = {name: request.args.get(name) or None for name in ('meal', 'day', 'surname')}
+    try:
+        page = pagination.booking_page(year, week, after=request.args.get('after') or None,
+                                       limit=request.args.get('limit', pagination.DEFAULT_PAGE_SIZE, type=int),
+                                       **filters)
+    except ValueError:
+        abort(400)
+    return year, week, filters, page
+
+# Route for displaying bookings for the current week by the manager, one page at a time
 @views.route('/manager/bookings/')
 @login_required
 def bookings():
-    # Get the ISO week number for the current date
-    date_m = date.today()
-    week =  get_iso_week_number(date_m.year, date_m.month, date_m.day)
-    
-    # Retrieve student bookings for the current week from the database
-    student_bookings = Booking.query.filter(Booking.week == week+1).order_by(Booking.user_booking_id_fk).all()
+    year, week, filters, page = get_booking_page()
     
-    # Organize booking information for display
+    # Combine the meal slots booked by each student on this page
     booking_info = {}
-    for booking in student_bookings:
-        booking_info.setdefault(booking.user_booking_id_fk, []).extend(booking.meal_type.split(', '))
+    for booking in page['bookings']:
+        key = (booking['user_id'], booking['surname'])
+        booking_info[key] = booking_info.get(key, 0) | booking['meal_slots']
 
     processed_bookings = {}
     for key, value in booking_info.items():
-        processed_bookings[key] = get_list(value)
+        processed_bookings[key] = slots.booking_info(value)
+
+    # Read the pre-aggregated head-count of every meal slot for the kitchen
+    if week_archive.is_archived(year, week):
+        totals = zip(slots.SLOTS, week_archive.weekly_totals(year, week))
+    else:
+        totals = zip(slots.SLOTS, headcount.weekly_totals(year, week))
+    
+    # Link to the following page, keeping the week and filters
+    next_url = url_for('views.bookings', after=page['next'], year=year, week=week,
+                       **{name: value for name, value in filters.items() if value}) if page['next'] else None
+
+    return render_template("bookings.html", bookings=processed_bookings, totals=totals, filters=filters,
+                           year=year, week=week, meals=slots.MEALS, days=slots.DAYS, next_url=next_url, user=current_user)
 
-    return render_template("bookings.html", bookings=processed_bookings, user=current_user)
+# Route returning one page of the week's bookings as JSON
+@views.route('/manager/bookings.json')
+@login_required
+def bookings_json():
+    year, week, filters, page = get_booking_page()
+    return jsonify(
+        year=year,
+        week=week,
+        bookings=[dict(booking, slots=[f'{meal} {day}' for meal, day in slots.slots_of(booking['meal_slots'])])
+                  for booking in page['bookings']],
+        next=page['next'],
+    )
+
+# Route returning a booking's change history and its slots at a given time
+@views.route('/manager/bookings/<int:booking_id>/history/')
+@login_required
+def booking_history(booking_id):
+    # Rebuild the booking as it was at ?at= (ISO date and time), defaulting to now
+    at = request.args.get('at')
+    try:
+        when = datetime.fromisoformat(at) if at else datetime.now()
+    except ValueError:
+        abort(400)
+    
+    state = changelog.state_at(booking_id, when)
+    if state is None:
+        abort(404)
+    
+    return jsonify(
+        booking_id=booking_id,
+        at=when.isoformat(),
+        slots=[f'{meal} {day}' for meal, day in slots.slots_of(state)],
+        history=[{
+            'date': entry.modification_date.isoformat(),
+            'user_id': entry.log_user_id_fk,
+            'added': [f'{meal} {day}' for meal, day in slots.slots_of(entry.slots_added)],
+            'removed': [f'{meal} {day}' for meal, day in slots.slots_of(entry.slots_removed)],
+        } for entry in changelog.history(booking_id)],
+    )
+
+# Route for streaming a week's bookings as CSV or a spreadsheet for the kitchen
+@views.route('/manager/bookings/export.<file_format>')
+@login_required
+def export_bookings(file_format):
+    # The export writers are imported on first use to keep them out of worker start-up
+    from . import exports
+    
+    # Export next week's bookings unless another week is requested
+    year, week = get_report_week()
+    sheet = request.args.get('sheet', 'students')
+    
+    if file_format == 'csv':
+        body, mimetype = exports.csv_stream(year, week, sheet), 'text/csv'
+        filename = f'{sheet}-{year}-week-{week}.csv'
+    elif file_format == 'xlsx':
+        body, mimetype = exports.xlsx_stream(year, week), 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+        filename = f'bookings-{year}-week-{week}.xlsx'
+    else:
+        abort(404)
+    
+    # Rows are generated while the response is sent, so memory stays flat for any number of bookings
+    return Response(stream_with_context(body), mimetype=mimetype,
+                    headers={'Content-Disposition': f'attachment; filename={filename}'})
 
 # Route for managing user accounts - accommodation page
 @views.route('/accommodation/')
@@ -249,16 +466,17 @@ def accommodation():
 @login_required
 def delete():
     if request.method =='POST':
+        # Imported on first use to keep account removal out of worker start-up
+        from . import deletion
+        
         # Get the user ID to be deleted from the form
         user_id = request.form.get("user_id")
         
-        # Retrieve the user to be deleted from the database
-        user_to_be_deleted = User.query.filter(User.user_id == user_id).first()
-        
-        # Delete the user from the database
-        db.session.delete(user_to_be_deleted)
-        db.session.commit()
-        
-        flash('Deletion successful', category='success')
+        # Remove the user with their bookings, cards, reminders and logs, archiving them
+        if user_id and user_id.isdigit() and deletion.select_users(user_ids=[int(user_id)]):
+            deletion.remove_users([int(user_id)])
+            flash('Deletion successful', category='success')
+        else:
+            flash('No account has that student number', category='error')
         
     return render_template("delete.html", user=current_user)
@@ -0,0 +1,322 @@
+"""
+Per-term archive of closed booking weeks.
+
+The Booking and Meal_Count tables only hold the weeks still in play: the
+current ISO week, whose meals are being served, and the next one, which is
+being booked. `archive_closed_weeks()`, run on a schedule with
+`flask archive-weeks`, moves every earlier week into a compact SQLite file per
+term, e.g. `2025-t1.sqlite` for ISO weeks 1-13 of 2025. A week is written to its
+archive file and committed there before it is deleted from the hot tables, and
+archiving a week again replaces what the file holds for it, so an interrupted
+run can simply be repeated.
+
+Each archive file holds three WITHOUT ROWID tables clustered by week:
+
+- booking (year, week, user_id, booking_id, meal_slots, status)
+- meal_count (year, week, slot, head_count), slot being the index in slots.SLOTS
+- modification_log (booking_id, log_entry_id, user_id, modification_date,
+  slots_added, slots_removed)
+
+Historical reports (the manager bookings pages and the exports) check
+`is_archived()` and read closed weeks from here, joining student names from the
+User table.
+
+Configuration (app.config):
+- ARCHIVE_DIR: Folder of the archive files (default `archive` in the instance folder),
+  with a subfolder per tenant other than the default one (see tenants.py).
+- ARCHIVE_TERM_WEEKS: ISO weeks per term file (default 13).
+
+Functions:
+- current_week(today=None): (ISO year, ISO week) of a date.
+- term_path(year, week): Archive file holding a week.
+- closed_weeks(): Weeks in the hot tables that are before the current week.
+- archive_week(year, week, chunk_size=5000): Moves one week into its archive file.
+- archive_closed_weeks(chunk_size=5000, progress=None): Moves every closed week.
+- is_archived(year, week): Whether a week is read from the archive.
+- weekly_totals(year, week): Per-slot head-counts of an archived week.
+- all_weekly_totals(): Per-slot head-counts of every archived week.
+- booking_rows(year, week, mask=None, user_ids=None, after=None, limit=None): Archived bookings by student.
+"""
+
+import os
+import sqlite3
+from contextlib import closing
+from datetime import date
+from time import perf_counter
+from flask import current_app
+from sqlalchemy import select
+from . import db
+from . import slots
+from . import tenants
+from .changelog import writer as changelog_writer
+from .models import Booking, Booking_Modification_Log, Meal_Count, Waitlist
+
+ARCHIVE_CHUNK_SIZE = 5000
+
+SCHEMA = (
+    'CREATE TABLE IF NOT EXISTS booking ('
+    'year INTEGER NOT NULL, week INTEGER NOT NULL, user_id INTEGER NOT NULL, booking_id INTEGER NOT NULL, '
+    'meal_slots INTEGER NOT NULL, status TEXT, '
+    'PRIMARY KEY (year, week, user_id, booking_id)) WITHOUT ROWID',
+    'CREATE TABLE IF NOT EXISTS meal_count ('
+    'year INTEGER NOT NULL, week INTEGER NOT NULL, slot INTEGER NOT NULL, head_count INTEGER NOT NULL, '
+    'PRIMARY KEY (year, week, slot)) WITHOUT ROWID',
+    'CREATE TABLE IF NOT EXISTS modification_log ('
+    'booking_id INTEGER NOT NULL, log_entry_id INTEGER NOT NULL, user_id INTEGER, modification_date TEXT, '
+    'slots_added INTEGER NOT NULL, slots_removed INTEGER NOT NULL, '
+    'PRIMARY KEY (booking_id, log_entry_id)) WITHOUT ROWID',
+)
+
+
+def current_week(today=None):
+    """
+    Returns the (ISO year, ISO week) of a date.
+
+    Args:
+        today (date, optional): Defaults to today.
+
+    Returns:
+        tuple: (year, week).
+    """
+    return tuple((today or date.today()).isocalendar()[:2])
+
+
+def _folder():
+    """Folder holding the archive files, with a subfolder per tenant other than the default one."""
+    folder = current_app.config.get('ARCHIVE_DIR') or os.path.join(current_app.instance_path, 'archive')
+    return folder if tenants.current() == tenants.default() else os.path.join(folder, tenants.current())
+
+
+def term_path(year, week):
+    """
+    Returns the archive file holding a week.
+
+    Args:
+        year (int): ISO year.
+        week (int): ISO week number.
+
+    Returns:
+        str: Path such as 'instance/archive/2025-t1.sqlite'.
+    """
+    term = (week - 1) // current_app.config.get('ARCHIVE_TERM_WEEKS', 13) + 1
+    return os.path.join(_folder(), f'{year}-t{term}.sqlite')
+
+
+def _connect(year, week, create=False):
+    """Opens the archive file of a week, or returns None if it does not exist and create is False."""
+    path = term_path(year, week)
+    if not create and not os.path.exists(path):
+        return None
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    connection = sqlite3.connect(path)
+    if create:
+        for statement in SCHEMA:
+            connection.execute(statement)
+    return connection
+
+
+def closed_weeks():
+    """
+    Lists the weeks still in the hot tables that are before the current week.
+
+    Returns:
+        list: (year, week) tuples in ascending order.
+    """
+    weeks = set(db.session.query(Booking.year, Booking.week).distinct().tuples())
+    weeks |= set(db.session.query(Meal_Count.year, Meal_Count.week).distinct().tuples())
+    current = current_week()
+    return sorted(key for key in weeks if None not in key and key < current)
+
+
+def archive_week(year, week, chunk_size=ARCHIVE_CHUNK_SIZE):
+    """
+    Moves one week's bookings, head-counts and booking change logs into its
+    archive file and drops the week's waitlist. Must be called inside an
+    application context.
+
+    Args:
+        year (int): ISO year.
+        week (int): ISO week number.
+        chunk_size (int, optional): Rows read from the database at a time.
+
+    Returns:
+        int: Number of bookings moved.
+    """
+    in_week = (Booking.year == year, Booking.week == week)
+    week_bookings = select(Booking.booking_id).where(*in_week)
+
+    # Log rows still queued for this week's bookings must land before they are moved
+    changelog_writer.flush()
+
+    with closing(_connect(year, week, create=True)) as archive:
+        with archive:
+            # Replace anything an earlier, interrupted run left for this week
+            archive.execute('DELETE FROM modification_log WHERE booking_id IN '
+                            '(SELECT booking_id FROM booking WHERE year = ? AND week = ?)', (year, week))
+            archive.execute('DELETE FROM booking WHERE year = ? AND week = ?', (year, week))
+            archive.execute('DELETE FROM meal_count WHERE year = ? AND week = ?', (year, week))
+
+            moved = 0
+            rows = db.session.execute(
+                select(Booking.user_booking_id_fk, Booking.booking_id, Booking.meal_slots, Booking.status)
+                .where(*in_week).execution_options(yield_per=chunk_size)
+            )
+            for chunk in rows.partitions():
+                archive.executemany(
+                    'INSERT INTO booking (year, week, user_id, booking_id, meal_slots, status) '
+                    'VALUES (?, ?, ?, ?, ?, ?)',
+                    [(year, week, user_id or 0, booking_id, meal_slots or 0, status)
+                     for user_id, booking_id, meal_slots, status in chunk])
+                moved += len(chunk)
+
+            counts = (db.session.query(Meal_Count.meal, Meal_Count.day, Meal_Count.head_count)
+                      .filter(Meal_Count.year == year, Meal_Count.week == week))
+            archive.executemany(
+                'INSERT INTO meal_count (year, week, slot, head_count) VALUES (?, ?, ?, ?)',
+                [(year, week, slots.SLOT_INDEX[(meal, day)], head_count)
+                 for meal, day, head_count in counts if (meal, day) in slots.SLOT_INDEX])
+
+            logs = db.session.execute(
+                select(Booking_Modification_Log.log_booking_fk, Booking_Modification_Log.log_entry_id,
+                       Booking_Modification_Log.log_user_id_fk, Booking_Modification_Log.modification_date,
+                       Booking_Modification_Log.slots_added, Booking_Modification_Log.slots_removed)
+                .where(Booking_Modification_Log.log_booking_fk.in_(week_bookings))
+                .execution_options(yield_per=chunk_size)
+            )
+            for chunk in logs.partitions():
+                archive.executemany(
+                    'INSERT INTO modification_log (booking_id, log_entry_id, user_id, modification_date, '
+                    'slots_added, slots_removed) VALUES (?, ?, ?, ?, ?, ?)',
+                    [(booking_id, entry_id, user_id, when.isoformat() if when else None, added, removed)
+                     for booking_id, entry_id, user_id, when, added, removed in chunk])
+
+    # The archive has committed; only now remove the week from the hot tables
+    db.session.execute(Booking_Modification_Log.__table__.delete()
+                       .where(Booking_Modification_Log.log_booking_fk.in_(week_bookings)))
+    db.session.execute(Booking.__table__.delete().where(*in_week))
+    db.session.execute(Meal_Count.__table__.delete().where(Meal_Count.year == year, Meal_Count.week == week))
+    db.session.execute(Waitlist.__table__.delete().where(Waitlist.year == year, Waitlist.week == week))
+    db.session.commit()
+    return moved
+
+
+def archive_closed_weeks(chunk_size=ARCHIVE_CHUNK_SIZE, progress=None):
+    """
+    Moves every week before the current one out of the hot tables. Must be
+    called inside an application context.
+
+    Args:
+        chunk_size (int, optional): Rows read from the database at a time.
+        progress (callable, optional): Called after each week with (year, week, bookings_moved).
+
+    Returns:
+        dict: 'weeks' archived as (year, week, bookings) tuples and 'seconds' taken.
+    """
+    started = perf_counter()
+    archived = []
+    for year, week in closed_weeks():
+        moved = archive_week(year, week, chunk_size)
+        archived.append((year, week, moved))
+        if progress:
+            progress(year, week, moved)
+    return {'weeks': archived, 'seconds': perf_counter() - started}
+
+
+def is_archived(year, week):
+    """
+    Tells whether a week is read from the archive: it is before the current
+    week and no longer in the hot Booking table.
+
+    Args:
+        year (int): ISO year.
+        week (int): ISO week number.
+
+    Returns:
+        bool: True if reports should read the week from its archive file.
+    """
+    if (year, week) >= current_week():
+        return False
+    return db.session.query(Booking.booking_id).filter(Booking.year == year, Booking.week == week).first() is None
+
+
+def weekly_totals(year, week):
+    """
+    Reads the head-count of every meal slot of an archived week.
+
+    Args:
+        year (int): ISO year.
+        week (int): ISO week number.
+
+    Returns:
+        list: SLOT_COUNT head-counts in slots.SLOTS order, zeros if the week was never archived.
+    """
+    totals = [0] * slots.SLOT_COUNT
+    connection = _connect(year, week)
+    if connection is None:
+        return totals
+    with closing(connection):
+        for slot, head_count in connection.execute(
+                'SELECT slot, head_count FROM meal_count WHERE year = ? AND week = ?', (year, week)):
+            if 0 <= slot < slots.SLOT_COUNT:
+                totals[slot] = head_count
+    return totals
+
+
+def all_weekly_totals():
+    """
+    Reads the head-counts of every week in every archive file, e.g. to train
+    the kitchen forecast.
+
+    Returns:
+        dict: (year, week) to SLOT_COUNT head-counts in slots.SLOTS order.
+    """
+    folder = _folder()
+    totals = {}
+    if not os.path.isdir(folder):
+        return totals
+    for name in sorted(os.listdir(folder)):
+        if not name.endswith('.sqlite'):
+            continue
+        with closing(sqlite3.connect(os.path.join(folder, name))) as connection:
+            for year, week, slot, head_count in connection.execute(
+                    'SELECT year, week, slot, head_count FROM meal_count'):
+                if 0 <= slot < slots.SLOT_COUNT:
+                    totals.setdefault((year, week), [0] * slots.SLOT_COUNT)[slot] = head_count
+    return totals
+
+
+def booking_rows(year, week, mask=None, user_ids=None, after=None, limit=None):
+    """
+    Yields an archived week's bookings ordered by (student ID, booking ID).
+
+    Args:
+        year (int): ISO year.
+        week (int): ISO week number.
+        mask (int, optional): Only bookings sharing a slot with this bitmap.
+        user_ids (list, optional): Only these students.
+        after (tuple, optional): (user_id, booking_id) key to continue after.
+        limit (int, optional): Maximum number of rows.
+
+    Yields:
+        tuple: (booking_id, user_id, meal_slots).
+    """
+    connection = _connect(year, week)
+    if connection is None:
+        return
+    sql = 'SELECT booking_id, user_id, meal_slots FROM booking WHERE year = ? AND week = ?'
+    parameters = [year, week]
+    if mask is not None:
+        sql += ' AND meal_slots & ? != 0'
+        parameters.append(mask)
+    if user_ids is not None:
+        sql += f" AND user_id IN ({','.join('?' * len(user_ids))})"
+        parameters.extend(user_ids)
+    if after is not None:
+        sql += ' AND (user_id, booking_id) > (?, ?)'
+        parameters.extend(after)
+    sql += ' ORDER BY user_id, booking_id'
+    if limit is not None:
+        sql += ' LIMIT ?'
+        parameters.append(limit)
+    with closing(connection):
+        yield from connection.execute(sql, parameters)
@@ -0,0 +1,16 @@
+"""
+Production WSGI entry point.
+
+Builds the app with the 'production' configuration profile (override with the
+SAMAM_CONFIG environment variable) for a multi-process WSGI server, e.g.:
+
+    SECRET_KEY=... gunicorn --workers 4 --threads 4 --bind 0.0.0.0:8000 wsgi:app
+
+See the README for the full list of settings and the multi-worker notes.
+"""
+import os
+
+from website import create_app
+
+# Creating the Flask application instance for the WSGI server
+app = create_app(os.environ.get('SAMAM_CONFIG', 'production'))